@@ -11,9 +11,30 @@ import fnmatch
 import Pyro
 import re
 import copy
+import math
 
 Pyro.config.PYRO_MOBILE_CODE=1
 
+# A-priori memory estimates (in G) from the MINC headers of the inputs, used until
+# there is a history of earlier runs (see pydpiper.resource_model). The tools 
+# work on float voxels; BASE_MEM covers the code and buffers of each process.
+FLOAT_BYTES = 4
+DOUBLE_BYTES = 8
+BASE_MEM = 0.25
+
+# Default weights of the stages that are limited by file server throughput rather than 
+# by the processor, for executors and pipelines given an "io" capacity (--resource, 
+# --global-resource): mincaverage streams all of its inputs, mincresample reads the
+# input volume and writes the resampled one.
+AVERAGE_IO = 2
+RESAMPLE_IO = 1
+
+def numVoxels(sizes):
+    return reduce(lambda x, y: x * y, sizes, 1)
+
+def memForVoxels(voxels, bytesPerVoxel=FLOAT_BYTES):
+    return BASE_MEM + float(voxels) * bytesPerVoxel / (1024 ** 3)
+
 class mincANTS(CmdStage):
     def __init__(self,
                  inSource,
@@ -93,10 +114,19 @@ class mincANTS(CmdStage):
         self.addDefaults()
         self.finalizeCommand()
         self.setName()
+        self.estimateMem(inSource if isFileHandler(inSource) else self.source[0])
         self.colour = "red"
         
     def setName(self):
         self.name = "mincANTS"
+    def estimateMem(self, sizeSource):
+        """Every similarity metric holds its source and target and their gradients 
+           at full resolution, and SyN keeps the forward and inverse displacement 
+           fields and their updates (4 fields of 3 components)"""
+        self.memEstimate = (rf.volumeSources(sizeSource),)
+        sizes = rf.getVolumeSizes(sizeSource)
+        if sizes:
+            self.setMem(memForVoxels(numVoxels(sizes) * (4 * len(self.similarity_metric) + 12)))
     def addDefaults(self):
         cmd = []
         for i in range(len(self.similarity_metric)):
@@ -236,6 +266,7 @@ class minctracc(CmdStage):
         self.finalizeCommand()
         self.setTransform()
         self.setName()
+        self.estimateMem(inSource if isFileHandler(inSource) else self.source)
         self.colour = "red"
 
     def setName(self):
@@ -243,6 +274,23 @@ class minctracc(CmdStage):
             self.name = "minctracc nlin step: " + self.step 
         else:
             self.name = "minctracc" + self.linearparam + " "
+    def estimateMem(self, sizeSource):
+        """minctracc holds source, target and masks, and for non-linear fits
+           a deformation grid of 3 components with a node every step mm"""
+        self.memEstimate = (rf.volumeSources(sizeSource),)
+        sizes = rf.getVolumeSizes(sizeSource)
+        if not sizes:
+            return
+        volumes = 2.0
+        if self.useMask:
+            volumes += len([m for m in [self.source_mask, self.target_mask] if m])
+        if self.linearparam == "nlin":
+            try:
+                nodesPerVoxel = (rf.getFinestResolution(sizeSource) / float(self.step)) ** 3
+                volumes += 3 * nodesPerVoxel
+            except:
+                pass
+        self.setMem(memForVoxels(numVoxels(sizes) * volumes))
     def addDefaults(self):
         self.cmd = ["minctracc",
                     "-clobber",
@@ -355,7 +403,22 @@ class blur(CmdStage):
                     self.inputFiles[0], self.base]
         if gradient:
             self.cmd += ["-gradient"]       
+        self.estimateMem(inFile, fwhm, gradient)
         self.colour="blue"
+    
+    def estimateMem(self, sizeSource, fwhm, gradient):
+        """mincblur holds the volume padded by the kernel width along every 
+           dimension, the blurred result and, optionally, the 3 gradient components"""
+        self.memEstimate = (rf.volumeSources(sizeSource), fwhm, gradient)
+        sizes = rf.getVolumeSizes(sizeSource)
+        if not sizes:
+            return
+        try:
+            padding = 2 * int(math.ceil(float(fwhm) / rf.getFinestResolution(sizeSource)))
+        except:
+            padding = 0
+        volumes = 2 + (3 if gradient else 0)
+        self.setMem(memForVoxels(numVoxels([n + padding for n in sizes]) * volumes))
 
 class autocrop(CmdStage):
     def __init__(self, 
@@ -581,8 +644,24 @@ class mincresample(CmdStage):
         self.addDefaults()
         self.finalizeCommand()
         self.setName()
+        self.estimateMem(inFile, targetFile)
+        self.setResource("io", RESAMPLE_IO)
         if isFileHandler(inFile, targetFile):
             self.setLastResampledFile()
+    
+    def estimateMem(self, inFile, targetFile):
+        """mincresample holds the input volume and the output volume, which is
+           sampled like the likeFile (or the target). Volumes that don't exist yet
+           are assumed to have the dimensions of their file handler's input."""
+        self.memEstimate = (rf.volumeSources(inFile), rf.volumeSources(targetFile))
+        inSizes = rf.getVolumeSizes(self.inFile)
+        if not inSizes and inFile != self.inFile:
+            inSizes = rf.getVolumeSizes(inFile)
+        outSizes = rf.getVolumeSizes(getattr(self, "likeFile", None) or self.targetFile)
+        if not outSizes and targetFile != self.targetFile:
+            outSizes = rf.getVolumeSizes(targetFile)
+        if inSizes and outSizes:
+            self.setMem(memForVoxels(numVoxels(inSizes) + numVoxels(outSizes)))
         
     def addDefaults(self):
         self.inputFiles += [self.inFile, self.targetFile]   
@@ -745,14 +824,27 @@ class mincAverage(CmdStage):
         self.addDefaults()
         self.finalizeCommand()
         self.setName()
+        self.estimateMem(inputArray[0] if len(inputArray) else None)
+        self.setResource("io", AVERAGE_IO)
         
+    def estimateMem(self, sizeSource):
+        """mincaverage reads as many inputs at a time as fit into its buffer,
+           and accumulates the sum and sum of squares as doubles"""
+        self.memEstimate = (rf.volumeSources(sizeSource),)
+        sizes = rf.getVolumeSizes(sizeSource) if sizeSource else None
+        if not sizes:
+            return
+        voxels = numVoxels(sizes)
+        inputBytes = min(len(self.filesToAvg) * voxels * FLOAT_BYTES, self.maxBufferKb * 1024)
+        self.setMem(memForVoxels(voxels, 2 * DOUBLE_BYTES) + float(inputBytes) / (1024 ** 3))
     def addDefaults(self):
         for i in range(len(self.filesToAvg)):
             self.inputFiles.append(self.filesToAvg[i]) 
         self.sd = splitext(self.output)[0] + "-sd.mnc"  
         self.outputFiles += [self.output, self.sd]       
+        self.maxBufferKb = 409620
         self.cmd += ["mincaverage",
-                     "-clobber", "-normalize", "-sdfile", self.sd, "-max_buffer_size_in_kb", str(409620)] 
+                     "-clobber", "-normalize", "-sdfile", self.sd, "-max_buffer_size_in_kb", str(self.maxBufferKb)] 
                  
     def finalizeCommand(self):
         for i in range(len(self.filesToAvg)):
@@ -778,6 +870,7 @@ class mincAverageDisp(mincAverage):
         for i in range(len(self.filesToAvg)):
             self.inputFiles.append(self.filesToAvg[i]) 
         self.outputFiles += [self.output]       
+        self.maxBufferKb = 4096 # mincaverage's default
         self.cmd += ["mincaverage", "-clobber"] 
 
 class RotationalMinctracc(CmdStage):
@@ -183,6 +183,49 @@ def setupInitModel(inputModel, pipeDir=None):
         sys.exit()
 
 
+def volumeSources(inSource):
+    """
+        The file names getVolumeSizes tries for inSource, as a list that can 
+        stand in for a file handler, or inSource itself if it is a file name.
+    """
+    if isFileHandler(inSource):
+        return [str(inSource.getLastBasevol()), str(inSource.inputFileName)]
+    return inSource
+
+# number of samples per dimension for each MINC file looked at by getVolumeSizes
+volumeSizes = {}
+
+def getVolumeSizes(inSource):
+    """
+        This function will return the number of samples along each dimension
+        (including a vector dimension, if present) of the inSource file, or 
+        None if its header can't be read, e.g. because the file will only be 
+        created by an earlier stage of the pipeline.  For file handlers the
+        original input file is used if the last base volume doesn't exist yet,
+        as it normally has the same dimensions.
+    """
+    if isFileHandler(inSource):
+        candidates = [inSource.getLastBasevol(), inSource.inputFileName]
+    elif isinstance(inSource, list):
+        candidates = inSource
+    else:
+        candidates = [inSource]
+    for filename in candidates:
+        filename = str(filename)
+        if filename not in volumeSizes:
+            if not exists(filename):
+                continue
+            try:
+                vol = volumeFromFile(filename)
+                volumeSizes[filename] = list(vol.sizes)
+                vol.closeVolume()
+            except:
+                logger.debug("Could not read the header of " + filename)
+                volumeSizes[filename] = None
+        if volumeSizes[filename]:
+            return volumeSizes[filename]
+    return None
+
 def getFinestResolution(inSource):
     """
         This function will return the highest (or finest) resolution 
@@ -191,6 +234,9 @@ def getFinestResolution(inSource):
     imageResolution = []
     if isFileHandler(inSource):
         imageResolution = volumeFromFile(inSource.getLastBasevol()).separations
+    elif isinstance(inSource, list):
+        # candidates as returned by volumeSources, the first one standing for the last base volume
+        imageResolution = volumeFromFile(inSource[0]).separations
     else: 
         imageResolution = volumeFromFile(inSource).separations
     
@@ -1,2 +1,2 @@
-__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application"]
+__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application", "journal", "autoscaler", "stage_stats", "resource_model", "memory_limits", "cpu_affinity", "output_cache", "output_manifest"]
 
@@ -1,8 +1,13 @@
 from optparse import OptionParser,OptionGroup
 from pydpiper.pipeline import Pipeline, pipelineDaemon
 from pydpiper.queueing import runOnQueueingSystem
+from pydpiper.memory_limits import LIMIT_MODES
+from pydpiper.output_manifest import STALENESS_MODES
 from pydpiper.file_handling import makedirsIgnoreExisting
 from datetime import datetime
+import cPickle as pickle
+import hashlib
+import glob
 import Pyro
 import logging
 import networkx as nx
@@ -11,6 +16,31 @@ import os
 
 logger = logging.getLogger(__name__)
 
+# modules whose code determines the stages an application builds (see planCacheKey)
+PLAN_MODULES = ["pydpiper", "atoms_and_modules", "applications"]
+
+def planCacheKey(argv):
+    """A digest of the command line and the working directory, of the times of modification
+       of the files and directories named on it (e.g. the inputs, a protocol or --mask-dir),
+       and of those of the modules that build the stages, so that any change to these gives
+       a different key. The inputs the stages read are checked when the plan is loaded
+       (see Pipeline.loadPlan), as they need not be named on the command line."""
+    digest = hashlib.sha256()
+    digest.update(os.getcwd() + "\0" + "\0".join(argv) + "\0")
+    files = []
+    for a in argv:
+        files.append(a)
+        if a.startswith("--") and "=" in a:
+            files.append(a.split("=", 1)[1])
+    for name, module in sorted(sys.modules.items()):
+        if module and name.split(".")[0] in PLAN_MODULES and getattr(module, "__file__", None):
+            # the source rather than the .pyc, which isn't rewritten on every change
+            files.append(os.path.splitext(module.__file__)[0] + ".py")
+    for f in files:
+        if os.path.exists(f):
+            digest.update("%s %r\0" % (os.path.abspath(f), os.path.getmtime(f)))
+    return digest.hexdigest()
+
 # Some sneakiness... Using the following lines, it's possible
 # to add an epilog to the parser that is written to screen
 # verbatim. That way in the help file you can show an example
@@ -61,6 +91,9 @@ class AbstractApplication(object):
         basic_group.add_option("--num-executors", dest="num_exec", 
                                type="int", default=0, 
                                help="Launch executors automatically without having to run pipeline_excutor.py independently.")
+        basic_group.add_option("--max-executors", dest="max_exec", 
+                               type="int", default=0, 
+                               help="Submit additional executors (up to this total) while many stages are waiting to run, and shut down idle ones. Only supported with --queue=sge. Default is 0 (disabled).")
         basic_group.add_option("--time", dest="time", 
                                type="string", default="2:00:00:00", 
                                help="Wall time to request for each executor in the format dd:hh:mm:ss")
@@ -79,9 +112,66 @@ class AbstractApplication(object):
         basic_group.add_option("--sge-queue-opts", dest="sge_queue_opts", 
                                type="string", default=None,
                                help="For --queue=sge, allows you to specify different queues. If not specified, default is used.")
+        basic_group.add_option("--mem-limit", dest="mem_limit",
+                               type="choice", choices=LIMIT_MODES, default="none",
+                               help="Limit each stage to the memory it declares, with RLIMIT_AS (rlimit) or a cgroup v2 per stage (cgroup, falls back to rlimit). Stages exceeding it are retried with more memory. One of: " + ", ".join(LIMIT_MODES) + ". Default is none.")
+        basic_group.add_option("--cpu-affinity", dest="cpu_affinity",
+                               action="store_true", default=False,
+                               help="Pin each stage to as many cores of its own as it has processors, preferring cores of one NUMA node. Only use this if each executor has its node (or its cpuset) to itself [default = %default]")
+        basic_group.add_option("--stage-timeout-factor", dest="stage_timeout_factor",
+                               type="float", default=0,
+                               help="Kill stages (and all processes they started) which run this many times as long as expected, but at least 10 minutes, and retry them. Default is 0 (never).")
+        basic_group.add_option("--max-stage-time", dest="max_stage_time",
+                               type="string", default=None,
+                               help="Kill stages which run longer than this, in the format dd:hh:mm:ss, and retry them. Default is no limit.")
+        basic_group.add_option("--speculation-factor", dest="speculation_factor",
+                               type="float", default=0,
+                               help="Once no stages are waiting to run, give idle executors a copy of stages that have run this many times as long as expected. Whichever copy finishes first is used and the other one is killed. Stages then write to private directories next to their outputs, which are only moved into place when they succeed. Default is 0 (disabled).")
+        basic_group.add_option("--backfill", dest="backfill",
+                               action="store_true", default=False,
+                               help="Have executors reserve resources for the first stage they claimed that doesn't fit, so that large stages aren't starved by a stream of small ones. Other stages are only started if they are expected to finish before the reservation or leave enough for it [default = %default]")
+        basic_group.add_option("--resource", dest="resources",
+                               action="append", default=[],
+                               help="Capacity of each executor for a consumable resource declared by stages, as name=amount (e.g. io=4 or scratch_gb=200). Can be given several times. Resources without a capacity are not limited.")
+        basic_group.add_option("--global-resource", dest="global_resources",
+                               action="append", default=[],
+                               help="Capacity of a consumable resource shared by all executors, e.g. io=20 for the stages that may access the file server at the same time. Same format as --resource.")
+        basic_group.add_option("--min-free-disk", dest="min_free_disk",
+                               type="float", default=1.0,
+                               help="Don't hand out stages whose predicted output would leave less than this many G free on the filesystem they write to. Stages wait (and low disk space is reported) until space is freed up. 0 disables the check. Default is 1G.")
+        basic_group.add_option("--output-cache", dest="output_cache",
+                               type="string", default=None,
+                               help="Directory (reachable from all executors) in which to cache stage outputs, shared by pipelines in different output directories. Stages whose command and input file contents match a cached entry are skipped and their outputs copied from the cache. Default is no cache.")
+        basic_group.add_option("--output-cache-size", dest="output_cache_size",
+                               type="float", default=100.0,
+                               help="Size in G beyond which the least recently used entries of --output-cache are removed. 0 means no limit. Default is 100G.")
+        basic_group.add_option("--output-checksums", dest="output_checksums",
+                               action="store_true", default=False,
+                               help="Record a checksum of each output in the output manifest (in the backup directory), in addition to its size and time of modification, so that outputs touched since can be recognized by --verify-outputs [default = %default]")
+        basic_group.add_option("--verify-outputs", dest="verify_outputs",
+                               action="store_true", default=False,
+                               help="With --restart, rerun stages whose outputs were changed or removed since they were recorded in the output manifest, rather than trusting the manifest. This looks at every output file, as is always done without --restart [default = %default]")
+        basic_group.add_option("--staleness", dest="staleness",
+                               type="choice", choices=STALENESS_MODES, default="none",
+                               help="Rerun stages whose inputs changed since they were run, and all stages depending on them, instead of skipping every stage whose outputs exist: mtime reruns stages with inputs newer than their outputs, digest those whose inputs have different contents than when they were run (falling back to mtime for stages run without it). One of: " + ", ".join(STALENESS_MODES) + ". Default is none.")
+        basic_group.add_option("--diff-plan", dest="diff_plan",
+                               action="store_true", default=False,
+                               help="Compare the stages with those that wrote the existing outputs (as recorded in the output manifest), and rerun the stages that changed, e.g. after editing a protocol, together with all stages depending on them. Unchanged stages whose outputs exist are skipped [default = %default]")
+        basic_group.add_option("--prefetch", dest="prefetch", 
+                               type="int", default=0,
+                               help="Number of stages each executor claims ahead of time, to start as soon as resources free up. Stages claimed ahead can't be run by other executors with free resources, so only use this with few executors or short stages. Default is 0.")
+        basic_group.add_option("--priority-scheduling", dest="priority_scheduling",
+                               action="store_true", default=False,
+                               help="Run stages on the longest remaining critical path first instead of in the order they become runnable [default = %default]")
+        basic_group.add_option("--no-resource-history", dest="resource_history",
+                               action="store_false", default=True,
+                               help="Don't set memory, processors and expected runtime of stages from the resource usage recorded in earlier runs.")
         basic_group.add_option("--restart", dest="restart", 
                                action="store_true",
                                help="Restart pipeline using backup files.")
+        basic_group.add_option("--no-plan-cache", dest="plan_cache",
+                               action="store_false", default=True,
+                               help="Always build the pipeline anew, rather than reusing the one built by an earlier launch with identical arguments, inputs and code (kept in the backup directory).")
         basic_group.add_option("--output-dir", dest="output_directory",
                                type="string", default=None,
                                help="Directory where output data and backups will be saved.")
@@ -96,6 +186,7 @@ class AbstractApplication(object):
     
     def _setup_pipeline(self):
         self.pipeline = Pipeline()
+        self.pipeline.setPriorityScheduling(self.options.priority_scheduling)
         
     def _setup_directories(self):
         """Output and backup directories setup here."""
@@ -105,12 +196,41 @@ class AbstractApplication(object):
             self.outputDir = makedirsIgnoreExisting(self.options.output_directory)
         self.pipeline.setBackupFileLocation(self.outputDir)
     
+    def estimateResources(self):
+        """Applies the resource usage of earlier runs (kept in the backup directory) to the stages"""
+        if self.options.resource_history:
+            self.pipeline.estimateResources(self.options.mem, self.options.proc)
+    
     def reconstructCommand(self):    
         reconstruct = ""
         for i in range(len(sys.argv)):
             reconstruct += sys.argv[i] + " "
         logger.info("Command is: " + reconstruct)
         
+    def buildPipeline(self):
+        """Calls run(), unless the stages it would add were saved by an earlier launch with
+           the same planCacheKey and their inputs are unchanged, in which case they are
+           loaded instead."""
+        if not self.options.plan_cache:
+            self.run()
+            return
+        planFile = os.path.join(self.pipeline.backupFileLocation, "plan-" + planCacheKey(sys.argv) + ".pkl")
+        if os.path.exists(planFile):
+            try:
+                if self.pipeline.loadPlan(planFile):
+                    logger.info("Loaded the pipeline built by an earlier launch from " + planFile)
+                    return
+                logger.info("The inputs of the pipeline in " + planFile + " have changed. Building it anew.")
+            except (IOError, EOFError, pickle.UnpicklingError):
+                logger.exception("Could not load the pipeline from " + planFile + ". Building it anew.")
+                self._setup_pipeline()
+                self._setup_directories()
+        self.run()
+        # only the plan of the latest launch is kept
+        for f in glob.glob(os.path.join(self.pipeline.backupFileLocation, "plan-*.pkl")):
+            os.remove(f)
+        self.pipeline.savePlan(planFile)
+        
     def start(self):
         self._setup_options()
         self.setup_options()
@@ -130,11 +250,13 @@ class AbstractApplication(object):
         if self.options.restart:
             logger.info("Restarting pipeline from pickled files.")
             self.pipeline.restart()
+            self.estimateResources()
             self.pipeline.initialize()
             self.pipeline.printStages(self.appName)
         else:
             self.reconstructCommand()
-            self.run()
+            self.buildPipeline()
+            self.estimateResources()
             self.pipeline.initialize()
             self.pipeline.printStages(self.appName)
                             
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import Pyro.core
+import time
+import math
+import pipeline_executor as pe
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""Adds and removes executors while a pipeline runs, based on the backlog of runnable stages.
+   Executors are submitted with sge_batch, so this requires --queue=sge (see pipelineDaemon)."""
+
+AUTOSCALE_INTERVAL = 30 # seconds between checks of the runnable backlog
+IDLE_TIMEOUT = 300 # executors holding no stages for this long are shut down when there is no backlog
+SUBMIT_TIMEOUT = 6*3600 # submitted executors that haven't registered after this long are written off
+
+class ExecutorAutoscaler():
+    def __init__(self, pipeline, options, programName=None):
+        self.pipeline = pipeline
+        self.options = options
+        self.programName = programName
+        self.maxExecutors = options.max_exec
+        # capacity of a single executor
+        self.mem = options.mem
+        self.proc = options.proc
+        # submission times of executors which have not registered yet
+        self.pending = []
+        # clients seen so far, and since when the idle ones have been idle
+        self.knownClients = set()
+        self.idleSince = {}
+        self.submitted = 0
+    def run(self):
+        """checks the backlog periodically until the pipeline is done"""
+        while self.pipeline.continueLoop():
+            time.sleep(AUTOSCALE_INTERVAL)
+            try:
+                self.check()
+            except:
+                logger.exception("Executor autoscaling check failed.")
+    def check(self):
+        """submits or shuts down executors according to the current backlog"""
+        now = time.time()
+        self.pipeline.synlock.acquire()
+        try:
+            backlog = self.pipeline.runnable.indices()
+            backlogMem = sum([self.pipeline.stages[i].getMem() for i in backlog])
+            backlogProcs = sum([self.pipeline.stages[i].getProcs() for i in backlog])
+            clients = [str(c) for c in self.pipeline.clients]
+            busy = set(self.pipeline.stageLeases.values())
+        finally:
+            self.pipeline.synlock.release()
+
+        # executors we submitted earlier which have registered are no longer pending
+        for c in clients:
+            if c not in self.knownClients:
+                self.knownClients.add(c)
+                if self.pending:
+                    self.pending.pop(0)
+        self.pending = [t for t in self.pending if now - t < SUBMIT_TIMEOUT]
+        idle = [c for c in clients if c not in busy]
+        for c in clients:
+            if c in busy:
+                self.idleSince.pop(c, None)
+            else:
+                self.idleSince.setdefault(c, now)
+
+        if backlog:
+            # executors needed to run the whole backlog at once, beyond those idle or on their way
+            needed = int(max(math.ceil(float(backlogMem) / self.mem), math.ceil(float(backlogProcs) / self.proc)))
+            additional = needed - len(idle) - len(self.pending)
+            additional = min(additional, self.maxExecutors - len(clients) - len(self.pending))
+            if additional > 0:
+                logger.info("%i runnable stages waiting (%.1fG, %i procs). Submitting %i more executor(s)."
+                            % (len(backlog), backlogMem, backlogProcs, additional))
+            for i in range(additional):
+                self.submitExecutor()
+                self.pending.append(now)
+        else:
+            for c in idle:
+                if now - self.idleSince[c] >= IDLE_TIMEOUT:
+                    self.shutdownExecutor(c)
+    def submitExecutor(self):
+        """submits one executor to SGE"""
+        self.submitted += 1
+        pe.pipelineExecutor(self.options).submitToQueue(self.programName)
+    def shutdownExecutor(self, c):
+        """tells an idle executor to exit and deregisters it"""
+        logger.info("Shutting down idle executor: " + c)
+        try:
+            clientObj = Pyro.core.getProxyForURI(c)
+            clientObj.serverShutdownCall()
+        except:
+            logger.exception("Failed to shut down executor " + c)
+        self.pipeline.synlock.acquire()
+        try:
+            self.pipeline.unregister(c)
+        finally:
+            self.pipeline.synlock.release()
+        self.idleSince.pop(c, None)
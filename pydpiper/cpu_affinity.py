@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""Gives every stage run by an executor a set of cores of its own, as many as the
+   stage declares processors, so that multi-threaded stages don't compete for the
+   same cores. Cores of one NUMA node are preferred for each stage."""
+
+def parseCpuList(cpuList):
+    """converts a kernel cpu list such as 0-3,8,10-11 to a list of cpu numbers"""
+    cpus = []
+    for part in cpuList.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def availableCpus():
+    """the cpus this process may run on"""
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("Cpus_allowed_list:"):
+                return parseCpuList(line.split(":", 1)[1])
+    except IOError:
+        pass
+    import multiprocessing
+    return range(multiprocessing.cpu_count())
+
+def numaNodes():
+    """the cpus of each NUMA node, as a list of lists (one node if unknown)"""
+    nodes = []
+    for cpulist in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+        try:
+            cpus = parseCpuList(open(cpulist).read())
+        except (IOError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+def setAffinity(cpus):
+    """restricts the calling process (and the threads and processes it starts) to cpus"""
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    maskType = ctypes.c_ulong * (max(cpus) / (8 * ctypes.sizeof(ctypes.c_ulong)) + 1)
+    mask = maskType()
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for cpu in cpus:
+        mask[cpu / bits] |= 1 << (cpu % bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise OSError(ctypes.get_errno(), "sched_setaffinity failed: " + os.strerror(ctypes.get_errno()))
+
+class CpuAllocator():
+    def __init__(self, cpus=None, nodes=None):
+        """hands out disjoint sets of cpus (all available ones by default), grouped by
+           NUMA node (all NUMA nodes of the machine by default)"""
+        if cpus == None:
+            cpus = availableCpus()
+        if nodes == None:
+            nodes = numaNodes()
+        self.nodes = [[c for c in node if c in cpus] for node in nodes]
+        self.nodes = [node for node in self.nodes if node]
+        # cpus not listed under any node (e.g. without NUMA information) form one node
+        remaining = [c for c in cpus if not any([c in node for node in self.nodes])]
+        if remaining:
+            self.nodes.append(remaining)
+        self.free = set(cpus)
+    def allocate(self, procs):
+        """Returns procs free cpus, or None if there aren't as many free. The cpus come
+           from the NUMA node with the fewest free cpus that can hold all of them, or,
+           if no node can, from the nodes with the most free cpus."""
+        if procs > len(self.free):
+            return None
+        freePerNode = [[c for c in node if c in self.free] for node in self.nodes]
+        fitting = [node for node in freePerNode if len(node) >= procs]
+        if fitting:
+            candidates = min(fitting, key=len)
+        else:
+            candidates = sum(sorted(freePerNode, key=len, reverse=True), [])
+        cpus = candidates[:procs]
+        self.free.difference_update(cpus)
+        return cpus
+    def release(self, cpus):
+        """returns cpus handed out by allocate"""
+        self.free.update(cpus)
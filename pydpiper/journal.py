@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""Append-only journal of stage state changes, used together with periodic
+   pipeline snapshots (see Pipeline.selfPickle) to allow restarts without
+   re-pickling the whole pipeline every time a stage finishes."""
+
+JOURNAL_FILE = "stages.journal"
+SYNC_BATCH = 50 # fsync after this many entries ...
+SYNC_INTERVAL = 5 # ... or after this many seconds, whichever comes first
+
+class StageJournal():
+    def __init__(self, backupDir, syncBatch=SYNC_BATCH, syncInterval=SYNC_INTERVAL):
+        self.filename = os.path.join(str(backupDir), JOURNAL_FILE)
+        self.syncBatch = syncBatch
+        self.syncInterval = syncInterval
+        self.journalFile = None # opened lazily, so the journal can cross a fork
+        self.unsynced = 0
+        self.lastSync = time.time()
+        # number of entries written since the last compaction
+        self.entries = 0
+    def open(self):
+        if not self.journalFile:
+            self.journalFile = open(self.filename, 'a')
+    def append(self, index, status):
+        """records a state change of stage index, syncing to disk in batches"""
+        self.open()
+        self.journalFile.write("%f %i %s\n" % (time.time(), index, status))
+        self.unsynced += 1
+        self.entries += 1
+        if (self.unsynced >= self.syncBatch
+            or time.time() - self.lastSync >= self.syncInterval):
+            self.sync()
+    def sync(self):
+        """flushes all buffered entries and forces them to disk"""
+        if self.journalFile and self.unsynced:
+            self.journalFile.flush()
+            os.fsync(self.journalFile.fileno())
+        self.unsynced = 0
+        self.lastSync = time.time()
+    def syncIfDue(self):
+        """syncs buffered entries once syncInterval has passed since the last sync - called
+           periodically so that entries don't linger in the buffer while no stage changes state"""
+        if self.unsynced and time.time() - self.lastSync >= self.syncInterval:
+            self.sync()
+    def truncate(self):
+        """discards all entries - called once a snapshot containing them has been written"""
+        self.close()
+        open(self.filename, 'w').close()
+        self.entries = 0
+    def close(self):
+        if self.journalFile:
+            self.sync()
+            self.journalFile.close()
+            self.journalFile = None
+    def replay(self):
+        """returns a list of (timestamp, index, status) tuples in the order they were written.
+           An incomplete final line (e.g. after a crash mid-write) is ignored."""
+        entries = []
+        if not os.path.exists(self.filename):
+            return entries
+        jf = open(self.filename, 'r')
+        for line in jf:
+            fields = line.split()
+            if not line.endswith("\n") or len(fields) != 3:
+                logger.warning("Ignoring incomplete journal entry: " + line.strip())
+                continue
+            entries.append((float(fields[0]), int(fields[1]), fields[2]))
+        jf.close()
+        return entries
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import os
+import errno
+import resource
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""Enforces the memory a stage declares on the process running it, so that a stage
+   using more than it declared fails (and is retried with more memory, see
+   Pipeline.retryStage) instead of starving the other stages on its node."""
+
+# none: no limits; rlimit: RLIMIT_AS; cgroup: a cgroup v2 per stage, falling back
+# to RLIMIT_AS if the executor has no cgroup to create it in; auto: same as cgroup,
+# but without the warning
+LIMIT_MODES = ["none", "rlimit", "cgroup", "auto"]
+CGROUP_MOUNT = "/sys/fs/cgroup"
+PROC_CGROUP = "/proc/self/cgroup"
+# the leaf the processes of the executor are moved into (see delegatedCgroup)
+EXECUTOR_CGROUP = "executor"
+
+def ownCgroup():
+    """the cgroup v2 directory of this process, or None"""
+    for line in open(PROC_CGROUP):
+        hierarchy, controllers, path = line.strip().split(":", 2)
+        if hierarchy == "0" and not controllers:
+            return os.path.join(CGROUP_MOUNT, path.lstrip("/"))
+    return None
+
+def controlsMemory(directory):
+    """True if the children of the cgroup directory have the memory controller, and it is writable"""
+    subtreeControl = open(os.path.join(directory, "cgroup.subtree_control")).read().split()
+    return "memory" in subtreeControl and os.access(directory, os.W_OK)
+
+def delegatedCgroup():
+    """Returns the cgroup v2 directory in which stages can be given cgroups of their own,
+       or None. This is the cgroup of the executor if it is writable (e.g. delegated by
+       the batch system) and has the memory controller. As cgroup v2 only enables
+       controllers for the children of cgroups without processes of their own, all of its
+       processes are moved into a leaf (EXECUTOR_CGROUP) first, which the processes started
+       later inherit."""
+    try:
+        directory = ownCgroup()
+        if not directory:
+            return None
+        if os.path.basename(directory) == EXECUTOR_CGROUP and controlsMemory(os.path.dirname(directory)):
+            return os.path.dirname(directory)
+        if controlsMemory(directory):
+            return directory
+        if ("memory" not in open(os.path.join(directory, "cgroup.controllers")).read().split()
+            or not os.access(directory, os.W_OK)):
+            return None
+        leaf = os.path.join(directory, EXECUTOR_CGROUP)
+        if not os.path.isdir(leaf):
+            os.mkdir(leaf)
+        for pid in open(os.path.join(directory, "cgroup.procs")).read().split():
+            try:
+                open(os.path.join(leaf, "cgroup.procs"), "w").write(pid)
+            except (IOError, OSError), e:
+                # the process has exited since
+                if e.errno != errno.ESRCH:
+                    raise
+        open(os.path.join(directory, "cgroup.subtree_control"), "w").write("+memory")
+        return directory
+    except (IOError, OSError, ValueError):
+        logger.debug("Could not set up a cgroup for the stages of this executor", exc_info=True)
+    return None
+
+def effectiveLimitMode(mode):
+    """Returns the mode stages are actually limited with, given the one asked for: cgroup
+       and auto become rlimit if the executor has no cgroup to create those of the stages
+       in (see delegatedCgroup). The mode is logged."""
+    if mode in ["cgroup", "auto"]:
+        parent = delegatedCgroup()
+        if parent:
+            logger.info("Limiting the memory of stages with cgroups in " + parent)
+            return "cgroup"
+        if mode == "cgroup":
+            logger.warning("No cgroup v2 with the memory controller delegated to this executor. "
+                           + "Limiting stage memory with RLIMIT_AS instead.")
+        mode = "rlimit"
+    if mode == "rlimit":
+        logger.info("Limiting the memory of stages with RLIMIT_AS")
+    return mode
+
+class MemoryLimit():
+    def __init__(self, mem, mode="auto"):
+        """limits the process started with preexec() to mem G"""
+        self.mem = mem
+        self.limit = int(mem * 1024 * 1024 * 1024)
+        self.cgroup = None
+        if mode in ["cgroup", "auto"]:
+            parent = delegatedCgroup()
+            if parent:
+                self.createCgroup(parent)
+            elif mode == "cgroup":
+                logger.warning("No cgroup v2 with the memory controller delegated to this executor. "
+                               + "Limiting stage memory with RLIMIT_AS instead.")
+    def createCgroup(self, parent):
+        # a pool process runs one stage at a time, so its pid makes the name unique
+        cgroup = os.path.join(parent, "pydpiper-stage-" + str(os.getpid()))
+        try:
+            if not os.path.isdir(cgroup):
+                os.mkdir(cgroup)
+            open(os.path.join(cgroup, "memory.max"), "w").write(str(self.limit))
+            if os.path.exists(os.path.join(cgroup, "memory.swap.max")):
+                open(os.path.join(cgroup, "memory.swap.max"), "w").write("0")
+            self.cgroup = cgroup
+        except (IOError, OSError):
+            logger.exception("Could not create cgroup " + cgroup + ". Limiting stage memory with RLIMIT_AS instead.")
+    def preexec(self):
+        """called in the child process before the stage's command is executed"""
+        if self.cgroup:
+            open(os.path.join(self.cgroup, "cgroup.procs"), "w").write(str(os.getpid()))
+        else:
+            resource.setrlimit(resource.RLIMIT_AS, (self.limit, self.limit))
+    def release(self):
+        """removes the stage's cgroup once its process has exited"""
+        if self.cgroup:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                logger.exception("Could not remove cgroup " + self.cgroup)
+            self.cgroup = None
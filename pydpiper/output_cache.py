@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import time
+import errno
+import shutil
+import socket
+import hashlib
+import logging
+from distutils.spawn import find_executable
+
+logger = logging.getLogger(__name__)
+
+"""A cache of stage outputs that can be shared by pipelines in different output
+   directories (e.g. runs of different studies over the same atlas). Entries are
+   keyed by a digest of the stage's command, with the output directories left out,
+   and of the contents of its input files, so that a stage whose outputs are in the
+   cache doesn't have to be run again."""
+
+DIGEST_BLOCK = 1024 * 1024 # bytes read at a time when computing digests
+EVICTION_INTERVAL = 600 # seconds between size checks of the cache by the processes storing into it
+EVICTION_MARKER = ".last-eviction"
+
+# digests of the files seen by this process, by (path, size, mtime)
+fileDigests = {}
+
+def fileDigest(path):
+    """digest of the contents of a file"""
+    info = os.stat(path)
+    memo = (os.path.abspath(path), info.st_size, info.st_mtime)
+    if memo not in fileDigests:
+        digest = hashlib.sha256()
+        f = open(path, "rb")
+        try:
+            for block in iter(lambda: f.read(DIGEST_BLOCK), ""):
+                digest.update(block)
+        finally:
+            f.close()
+        fileDigests[memo] = digest.hexdigest()
+    return fileDigests[memo]
+
+def outputDirectories(stage):
+    """the directories of the outputs of a stage, in the order of its outputs"""
+    directories = []
+    for f in stage.outputFiles:
+        directory = os.path.dirname(os.path.abspath(f))
+        if directory not in directories:
+            directories.append(directory)
+    return directories
+
+def commandSignature(stage):
+    """The command of a stage with its inputs and output directories replaced by
+       placeholders. Outputs keep their names, as files written next to them (e.g. the
+       grids of transforms) may refer to them by name. The executable's size and time
+       of modification are included, so that upgrading a tool invalidates its entries."""
+    directories = outputDirectories(stage)
+    parts = []
+    for a in stage.cmd:
+        if a in stage.inputFiles:
+            a = "<input>"
+        elif a in stage.outputFiles:
+            a = "<output dir %i>/%s" % (directories.index(os.path.dirname(os.path.abspath(a))), os.path.basename(a))
+        else:
+            for n in sorted(range(len(directories)), key=lambda n: -len(directories[n])):
+                a = a.replace(directories[n] + os.sep, "<output dir %i>/" % n)
+        parts.append(a)
+    if stage.cmd:
+        executable = find_executable(stage.cmd[0])
+        if executable:
+            info = os.stat(executable)
+            parts.append("<executable %i %i>" % (info.st_size, info.st_mtime))
+    return parts
+
+class StageOutputCache():
+    def __init__(self, directory, maxBytes=None):
+        """cache in directory, evicting the least recently used entries once its size exceeds maxBytes"""
+        self.directory = os.path.abspath(directory)
+        self.maxBytes = maxBytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+    def key(self, stage):
+        """digest of the command of a stage (see commandSignature) and of its input files"""
+        digest = hashlib.sha256()
+        for part in commandSignature(stage):
+            digest.update(part + "\0")
+        for f in stage.inputFiles:
+            digest.update(fileDigest(f) + "\0")
+        return digest.hexdigest()
+    def entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+    def restore(self, stage):
+        """Puts copies of the outputs of stage in place from the cache and returns True - or
+           returns False if they aren't cached. The outputs are copied rather than linked,
+           so that rewriting them in place can't change the cache."""
+        entry = self.entry(self.key(stage))
+        if not os.path.isdir(entry):
+            return False
+        directories = outputDirectories(stage)
+        for n in os.listdir(entry):
+            for name in os.listdir(os.path.join(entry, n)):
+                source = os.path.join(entry, n, name)
+                destination = os.path.join(directories[int(n)], name)
+                if os.path.lexists(destination):
+                    os.remove(destination)
+                shutil.copyfile(source, destination)
+        # marks the entry as recently used
+        os.utime(entry, None)
+        return True
+    def store(self, stage, privateDirs):
+        """Adds copies of everything a stage wrote into its private directories (see
+           CmdStage.privateCommand) to the cache, so that the outputs of the run stay
+           writable without affecting the cache. Cached files are made read-only."""
+        key = self.key(stage)
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+        directories = outputDirectories(stage)
+        temporary = os.path.join(self.directory, ".%s-%s-%i" % (key, socket.gethostname(), os.getpid()))
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary)
+        for privateDir, outputDir in privateDirs.items():
+            target = os.path.join(temporary, str(directories.index(outputDir)))
+            os.makedirs(target)
+            for name in os.listdir(privateDir):
+                source = os.path.join(privateDir, name)
+                if not os.path.isfile(source):
+                    continue
+                shutil.copyfile(source, os.path.join(target, name))
+                os.chmod(os.path.join(target, name), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        if not os.path.isdir(os.path.dirname(entry)):
+            try:
+                os.makedirs(os.path.dirname(entry))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            # complete entries appear at once; another process may have stored the same one
+            os.rename(temporary, entry)
+        except OSError:
+            shutil.rmtree(temporary, ignore_errors=True)
+            return
+        self.evictPeriodically()
+    def entries(self):
+        """returns (last use, bytes, path) for all entries"""
+        entries = []
+        for prefix in os.listdir(self.directory):
+            if prefix.startswith("."):
+                continue
+            for key in os.listdir(os.path.join(self.directory, prefix)):
+                path = os.path.join(self.directory, prefix, key)
+                size = 0
+                for (directory, subdirs, files) in os.walk(path):
+                    size += sum([os.path.getsize(os.path.join(directory, f)) for f in files])
+                entries.append((os.path.getmtime(path), size, path))
+        return entries
+    def evictPeriodically(self):
+        """Evicts (see evict) unless some process did within the last EVICTION_INTERVAL
+           seconds, as finding the size of the cache means looking at all of its files."""
+        marker = os.path.join(self.directory, EVICTION_MARKER)
+        try:
+            if time.time() - os.path.getmtime(marker) < EVICTION_INTERVAL:
+                return
+        except OSError:
+            pass
+        open(marker, "a").close()
+        os.utime(marker, None)
+        self.evict()
+    def evict(self):
+        """removes the least recently used entries until the cache fits into maxBytes"""
+        if self.maxBytes == None:
+            return
+        entries = sorted(self.entries())
+        total = sum([size for (used, size, path) in entries])
+        while entries and total > self.maxBytes:
+            used, size, path = entries.pop(0)
+            logger.info("Evicting %s (%i bytes, last used %s) from the output cache." % (path, size, time.ctime(used)))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import os
+import time
+import sqlite3
+import logging
+from output_cache import fileDigest
+
+logger = logging.getLogger(__name__)
+
+"""Records the outputs of finished stages (size, time of modification and, optionally,
+   a checksum), so that a restarted pipeline can tell which stages are complete without
+   looking at every output file (see skip_completed_stages). As outputs are moved into
+   place only once their stage has succeeded (see CmdStage.privateCommand), a recorded
+   output is a complete one. For --staleness=digest, the digests of the inputs each
+   stage was run with are recorded too (see isStale)."""
+
+MANIFEST_FILE = "output_manifest.db"
+# none: stages whose outputs exist are skipped; mtime, digest: see isStale
+STALENESS_MODES = ["none", "mtime", "digest"]
+
+def describeOutputs(files, checksums=False):
+    """returns (path, size, mtime, checksum) for those files that exist, the checksum
+       being None unless asked for"""
+    outputs = []
+    for f in files:
+        try:
+            info = os.stat(f)
+        except OSError:
+            continue
+        outputs.append((f, info.st_size, info.st_mtime, fileDigest(f) if checksums else None))
+    return outputs
+
+def matchesOutput(path, size, mtime, checksum):
+    """True if the file at path is still the one recorded. Files that were touched
+       (e.g. copied) since are accepted if they have the recorded checksum."""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    if info.st_size != size:
+        return False
+    if info.st_mtime == mtime:
+        return True
+    return checksum != None and fileDigest(path) == checksum
+
+def isStale(stage, mode, inputDigests=None):
+    """True if stage has to run again although its outputs exist, because of changes to its
+       inputs since. With mode "mtime", these are inputs newer than the oldest output. With
+       "digest", they are inputs whose contents differ from inputDigests, the digests they
+       had when the stage was run (path -> digest, see OutputManifest.inputDigests); mtimes
+       are compared for stages without recorded digests."""
+    if mode == "digest" and inputDigests:
+        for f in stage.inputFiles:
+            if f not in inputDigests or not os.path.exists(f) or fileDigest(f) != inputDigests[f]:
+                return True
+        return False
+    try:
+        inputTimes = [os.path.getmtime(f) for f in stage.inputFiles]
+        outputTimes = [os.path.getmtime(f) for f in stage.outputFiles]
+    except OSError:
+        # missing files are up to the completeness checks
+        return False
+    return bool(inputTimes and outputTimes) and max(inputTimes) > min(outputTimes)
+
+class OutputManifest():
+    def __init__(self, backupDir):
+        self.filename = os.path.join(str(backupDir), MANIFEST_FILE)
+        self.connection = None # opened lazily, so the manifest can cross a fork
+    def open(self):
+        if not self.connection:
+            # the server uses the manifest from different request threads, one at a time
+            self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, stage INTEGER, "
+                                    + "size INTEGER, mtime REAL, checksum TEXT, time REAL, fingerprint TEXT)")
+            # manifests written by older versions lack the fingerprint of the writing stage
+            existing = [row[1] for row in self.connection.execute("PRAGMA table_info(outputs)")]
+            if "fingerprint" not in existing:
+                self.connection.execute("ALTER TABLE outputs ADD COLUMN fingerprint TEXT")
+            # stages are identified by their command, which stays the same across runs
+            self.connection.execute("CREATE TABLE IF NOT EXISTS inputs (command TEXT, path TEXT, checksum TEXT, "
+                                    + "PRIMARY KEY (command, path))")
+    def record(self, index, outputs, fingerprint=None):
+        """records the outputs of stage index as returned by describeOutputs, together with
+           the fingerprint of the stage (see PipelineStage.getHash) - call commit() to make
+           them persistent"""
+        self.open()
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO outputs (path, stage, size, mtime, checksum, time, fingerprint) "
+                                    + "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(path, index, size, mtime, checksum, now, fingerprint)
+                                     for (path, size, mtime, checksum) in outputs])
+    def recordInputs(self, command, digests):
+        """records the digests of the inputs (as (path, digest)) the stage with command was
+           run with - call commit() to make them persistent"""
+        self.open()
+        self.connection.execute("DELETE FROM inputs WHERE command = ?", [command])
+        self.connection.executemany("INSERT INTO inputs VALUES (?, ?, ?)",
+                                    [(command, path, digest) for (path, digest) in digests])
+    def inputDigests(self):
+        """returns the recorded input digests as a dict of command -> {path : digest}"""
+        if not os.path.exists(self.filename):
+            return {}
+        self.open()
+        digests = {}
+        for (command, path, checksum) in self.connection.execute("SELECT command, path, checksum FROM inputs"):
+            digests.setdefault(command, {})[path] = checksum
+        return digests
+    def commit(self):
+        if self.connection:
+            self.connection.commit()
+    def entries(self):
+        """returns all recorded outputs as a dict of path -> (size, mtime, checksum, fingerprint)"""
+        if not os.path.exists(self.filename):
+            return {}
+        self.open()
+        cursor = self.connection.execute("SELECT path, size, mtime, checksum, fingerprint FROM outputs")
+        return dict([(row[0], tuple(row[1:])) for row in cursor])
+    def close(self):
+        if self.connection:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
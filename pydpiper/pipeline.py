@@ -7,19 +7,85 @@ import cPickle as pickle
 import os
 import sys
 import socket
+import errno
+import shutil
+import signal
 import time
+import heapq
+import hashlib
 from datetime import datetime
-from subprocess import call
+from subprocess import call, Popen
 from shlex import split
 from multiprocessing import Process, Event
+import threading
 import file_handling as fh
 import pipeline_executor as pe
+from journal import StageJournal
+from stage_stats import StageStatsStore, fileBytes
+from resource_model import StageResourceModel
+from output_cache import StageOutputCache, fileDigest
+from output_manifest import OutputManifest, describeOutputs, matchesOutput, isStale
+from memory_limits import MemoryLimit
+from cpu_affinity import setAffinity
+from autoscaler import ExecutorAutoscaler
 import logging
 
 logger = logging.getLogger(__name__)
 
 Pyro.config.PYRO_MOBILE_CODE=1 
 
+# pipeline attributes written to the backup directory on every snapshot
+BACKUP_ATTRIBUTES = ["G", "stages", "nameArray", "counter", "outputhash", "stagehash", "processedStages"]
+# what an application builds, kept to spare rebuilding it on an identical relaunch (see savePlan)
+PLAN_ATTRIBUTES = ["G", "stages", "nameArray", "counter", "outputhash", "stagehash", "skipped_stages"]
+
+# seconds without a heartbeat after which a client is considered dead, and
+# the stages it claimed are returned to the runnable queue
+LEASE_TIMEOUT = 120
+
+# expected runtime in seconds per stage type, used to rank runnable stages
+# by their remaining critical path. Unknown stage types use DEFAULT_RUNTIME.
+DEFAULT_RUNTIME = 60
+DEFAULT_STAGE_RUNTIMES = {"mincANTS" : 7200,
+                          "minctracc" : 1200,
+                          "rotational_minctracc.py" : 1800,
+                          "nu_estimate" : 300,
+                          "nu_evaluate" : 120,
+                          "mincaverage" : 300,
+                          "mincresample" : 120,
+                          "mincblur" : 60,
+                          "autocrop" : 60,
+                          "voxel_vote.py" : 300,
+                          "mincblob" : 120,
+                          "smooth_vector" : 120,
+                          "mincmath" : 30,
+                          "scale_voxels" : 30,
+                          "xfmavg" : 5,
+                          "xfmconcat" : 5,
+                          "xfminvert" : 5}
+
+# retry policy for failed stages (see Pipeline.retryStage): stages killed for lack
+# of memory are retried with OOM_MEM_FACTOR times their memory (up to the capacity
+# of an executor), stages killed for running too long right away, expecting them to
+# take TIMEOUT_RUNTIME_FACTOR times as long, other transient failures after RETRY_BACKOFF
+# seconds, doubling with every attempt. Ordinary non-zero exits are not retried.
+OOM_MEM_FACTOR = 2.0
+MAX_OOM_RETRIES = 3
+MAX_RETRIES = 2
+RETRY_BACKOFF = 60
+TIMEOUT_RUNTIME_FACTOR = 2.0
+
+# minimum interval (seconds) between reports of low disk space, and bytes per G
+DISK_ALERT_INTERVAL = 600
+GB = 1024.0 ** 3
+
+# seconds between terminating a timed out stage and killing it, and between checks of the watchdog
+KILL_GRACE = 10
+WATCH_INTERVAL = 1
+
+# environment variables telling multi-threaded tools how many threads to use
+THREAD_VARIABLES = ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "OMP_NUM_THREADS"]
+
 class PipelineFile():
     def __init__(self, filename):
         self.filename = filename
@@ -45,6 +111,13 @@ class PipelineStage():
     def __init__(self):
         self.mem = 2.0 # default memory allotted per stage
         self.procs = 1 # default number of processors per stage
+        self.resources = {} # amounts of other consumable resources (e.g. "io"), by name
+        self.expectedRuntime = None # seconds, set by the server when the stage is handed out
+        self.privateOutputs = False # set by the server: outputs are written elsewhere, then moved into place
+        self.outputCache = None # the StageOutputCache of the pipeline, if any, set by the server
+        self.outputChecksums = False # set by the server if outputs are recorded with checksums
+        self.inputDigests = False # set by the server if the digests of the inputs are recorded
+        self.rerun = False # set by the server if the stage has to run even though its outputs exist
         self.inputFiles = [] # the input files for this stage
         self.outputFiles = [] # the output files for this stage
         self.logFile = None # each stage should have only one log file
@@ -73,8 +146,19 @@ class PipelineStage():
         self.procs = num
     def getProcs(self):
         return self.procs
+    def setResource(self, name, amount):
+        """declares that the stage uses amount of the named consumable resource 
+           (e.g. io=1 or scratch_gb=20) while it runs"""
+        self.resources[name] = amount
+    def getResources(self):
+        return self.resources
+    def getType(self):
+        """the kind of stage, used to look up per stage type estimates"""
+        return self.name.split()[0] if self.name.split() else self.name
     def getHash(self):
-        return(hash("".join(self.outputFiles) + "".join(self.inputFiles)))
+        """fingerprint of the stage, from its inputs and outputs (see fingerprint)"""
+        return fingerprint(["output"] + [normalizedPath(f) for f in self.outputFiles]
+                           + ["input"] + [normalizedPath(f) for f in self.inputFiles])
     def __eq__(self, other):
         if self.inputFiles == other.inputFiles and self.outputFiles == other.outputFiles:
             return True
@@ -108,21 +192,165 @@ class CmdStage(PipelineStage):
             self.logFile = self.name + "." + datetime.isoformat(datetime.now()) + ".log"
     def setLogFile(self, logFileName): 
         self.logFile = str(logFileName)
-    def execStage(self):
-        of = open(self.logFile, 'w')
+    def reestimateMem(self):
+        """Repeats the estimate of the stage's memory from the headers of its inputs (see
+           the estimateMem methods in minc_atoms, which keep their arguments in memEstimate),
+           e.g. for a stage loaded from a saved plan"""
+        memEstimate = getattr(self, "memEstimate", None)
+        if memEstimate:
+            self.estimateMem(*memEstimate)
+    def execStage(self, memLimit=None, cpus=None, timeout=None, cancelFile=None):
+        """Runs the command and returns its exit status. Resource usage of the command
+           is written to the log file and kept in self.stats for the executor. Unless
+           memLimit is None or "none", the command is limited to the stage's memory
+           (see memory_limits for the modes). If cpus are given, the command is 
+           restricted to them. Multi-threaded tools are told to use as many threads
+           as the stage has processors. If the command is still running after timeout
+           seconds, or once cancelFile exists, it is killed together with all processes
+           it started. With privateOutputs, the command writes into private directories,
+           whose contents are only moved to the output directories if it succeeds. With an
+           outputCache, outputs are taken from the cache if they are in it, and added to it
+           otherwise (see output_cache)."""
+        logFile = self.logFile
+        if self.privateOutputs:
+            # another copy of the stage may be writing the same log
+            logFile = "%s.%s-%i" % (self.logFile, socket.gethostname(), os.getpid())
+        of = open(logFile, 'w')
+        start = time.time()
         of.write("Running on: " + socket.gethostname() + " at " + datetime.isoformat(datetime.now(), " ") + "\n")
         of.write(repr(self) + "\n")
         of.flush()
+        self.stats = {"host" : socket.gethostname(), "start" : start, 
+                      "input_bytes" : fileBytes(self.inputFiles)}
 
-        if self.is_effectively_complete():
+        if not self.rerun and self.is_effectively_complete():
             of.write("All output files exist. Skipping stage.\n")
             returncode = 0
+        elif self.outputCache and self.hasOutputsInCommand() and self.outputCache.restore(self):
+            of.write("Output files restored from the output cache in " + self.outputCache.directory + ". Skipping stage.\n")
+            self.stats["cached"] = 1
+            returncode = 0
         else:
-            args = split(repr(self)) 
-            returncode = call(args, stdout=of, stderr=of, shell=False) 
+            cmd, privateDirs = self.cmd, {}
+            if (self.privateOutputs or self.outputCache) and self.hasOutputsInCommand():
+                # a cache entry holds everything the command wrote
+                cmd, privateDirs = self.privateCommand()
+            args = split(" ".join(cmd))
+            limit = None
+            if memLimit and memLimit != "none":
+                limit = MemoryLimit(self.mem, memLimit)
+                self.stats["mem_limit"] = self.mem
+            def preexec():
+                if timeout or cancelFile:
+                    # a process group of its own, so that the whole tree can be killed
+                    os.setpgrp()
+                if limit:
+                    limit.preexec()
+                if cpus:
+                    setAffinity(cpus)
+            env = dict(os.environ)
+            for variable in THREAD_VARIABLES:
+                env[variable] = str(self.procs)
+            if timeout:
+                self.stats["timeout"] = timeout
+            done = threading.Event()
+            returncode = None
+            try:
+                process = Popen(args, stdout=of, stderr=of, shell=False, env=env,
+                                preexec_fn=preexec)
+                if timeout or cancelFile:
+                    watchdog = threading.Thread(target=self.watch, args=(process.pid, of, timeout, cancelFile, done))
+                    watchdog.setDaemon(True)
+                    watchdog.start()
+                returncode, usage = waitWithUsage(process)
+            finally:
+                done.set()
+                if limit:
+                    limit.release()
+                if privateDirs and returncode == 0 and self.outputCache:
+                    try:
+                        self.outputCache.store(self, privateDirs)
+                    except (IOError, OSError):
+                        logger.exception("Could not add the outputs of " + repr(self) + " to the output cache")
+                if privateDirs:
+                    commitOutputs(privateDirs, returncode == 0)
+            self.stats.update({"utime" : usage.ru_utime, "stime" : usage.ru_stime, 
+                               "maxrss" : usage.ru_maxrss})
+        self.stats.update({"walltime" : time.time() - start, "returncode" : returncode,
+                           "output_bytes" : fileBytes(self.outputFiles)})
+        of.write("Stage statistics: " + " ".join(["%s=%s" % (k, self.stats[k]) for k in sorted(self.stats.keys())]) + "\n")
+        if returncode == 0:
+            # for the output manifest of the server
+            self.stats["outputs"] = describeOutputs(self.outputFiles, self.outputChecksums)
+            if self.inputDigests:
+                self.stats["input_digests"] = [(f, fileDigest(f)) for f in self.inputFiles if os.path.exists(f)]
         of.close()
+        if logFile != self.logFile:
+            if self.stats.get("cancelled"):
+                os.remove(logFile)
+            else:
+                os.rename(logFile, self.logFile)
         return(returncode)
     
+    def watch(self, pgid, of, timeout, cancelFile, done):
+        """watchdog of execStage: waits until the stage's process group is done, has run for
+           timeout seconds or cancelFile exists. In the latter two cases, it terminates the
+           process group, and kills what is left of it after KILL_GRACE seconds."""
+        start = time.time()
+        while not done.wait(WATCH_INTERVAL):
+            if timeout and time.time() - start > timeout:
+                self.stats["timed_out"] = 1
+                of.write("Stage timed out after %i seconds. Killing it.\n" % timeout)
+                break
+            if cancelFile and os.path.exists(cancelFile):
+                self.stats["cancelled"] = 1
+                of.write("Another copy of the stage has finished. Killing this one.\n")
+                break
+        else:
+            return
+        of.flush()
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+            time.sleep(KILL_GRACE)
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError, e:
+            # the whole group has exited
+            if e.errno != errno.ESRCH:
+                raise
+    def namesOutput(self, a, f):
+        """True if argument a of the command is the output file f or, for outputs that
+           aren't arguments, a prefix the command adds a suffix to for writing f (e.g. the
+           base mincblur writes <base>_blur.mnc for)"""
+        if a == f or f in self.cmd:
+            return a == f
+        if not isinstance(a, basestring) or a.startswith("-") or a in self.inputFiles:
+            return False
+        directory, name = os.path.split(os.path.abspath(a))
+        return (name != "" and os.path.dirname(os.path.abspath(f)) == directory
+                and os.path.basename(f).startswith(name))
+    def hasOutputsInCommand(self):
+        """True if every output file is named by an argument of the command (see namesOutput),
+           so that the command can be made to write elsewhere (see privateCommand)"""
+        return all([any([self.namesOutput(a, f) for a in self.cmd]) for f in self.outputFiles])
+    def privateCommand(self):
+        """Returns the command with its outputs (and the prefixes of outputs, see namesOutput)
+           in private directories of this process (one in each output directory), and these
+           directories mapped to the output directories. Outputs keep their names, so that
+           files referring to each other by name (e.g. transforms and their grids) stay valid."""
+        privateDirs = {}
+        cmd = []
+        for a in self.cmd:
+            if any([self.namesOutput(a, f) for f in self.outputFiles]):
+                outputDir = os.path.dirname(os.path.abspath(a))
+                privateDir = os.path.join(outputDir, ".pydpiper-%s-%i" % (socket.gethostname(), os.getpid()))
+                if privateDir not in privateDirs:
+                    if os.path.isdir(privateDir):
+                        shutil.rmtree(privateDir)
+                    os.mkdir(privateDir)
+                    privateDirs[privateDir] = outputDir
+                a = os.path.join(privateDir, os.path.basename(a))
+            cmd.append(a)
+        return cmd, privateDirs
     def is_effectively_complete(self):
         """check if this stage is effectively complete (if output files already exist)"""
         all_files_exist = True
@@ -132,11 +360,121 @@ class CmdStage(PipelineStage):
                 break
         return all_files_exist
 
+    def getType(self):
+        if self.cmd:
+            return os.path.basename(self.cmd[0])
+        return PipelineStage.getType(self)
     def getHash(self):
-        return(hash(" ".join(self.cmd)))
+        """fingerprint of the stage, from its command with the paths of inputs and outputs
+           normalized (see fingerprint)"""
+        files = set(self.inputFiles + self.outputFiles)
+        return fingerprint([normalizedPath(a) if a in files else a for a in self.cmd])
     def __repr__(self):
         return(" ".join(self.cmd))
 
+def normalizedPath(path):
+    return os.path.normpath(os.path.abspath(path))
+
+def fingerprint(parts):
+    """A sha256 digest of a list of strings. Unlike hash(), it is the same for every run and
+       interpreter, so that stages can be compared across runs (see skip_completed_stages)."""
+    return hashlib.sha256("\0".join(parts)).hexdigest()
+
+def commitOutputs(privateDirs, succeeded):
+    """Moves everything written into the private directories of a command (see 
+       CmdStage.privateCommand) to the output directories if the command succeeded, with
+       a rename per file, so that each output appears complete or not at all. The
+       private directories are removed."""
+    for privateDir, outputDir in privateDirs.items():
+        if succeeded:
+            for name in os.listdir(privateDir):
+                os.rename(os.path.join(privateDir, name), os.path.join(outputDir, name))
+        shutil.rmtree(privateDir, ignore_errors=True)
+
+def freeDiskSpace(directory):
+    """returns (device, bytes available to unprivileged users) for the filesystem of directory,
+       or of its closest existing parent if it doesn't exist yet"""
+    while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+    stats = os.statvfs(directory)
+    return (os.stat(directory).st_dev, stats.f_bavail * stats.f_frsize)
+
+def waitWithUsage(process):
+    """Waits for a Popen process and returns its exit status (negative signal number
+       if it was killed, as for subprocess) together with its resource usage, which
+       covers the process and all of its waited for descendants."""
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, usage
+
+class RunnableQueue(Queue.Queue):
+    """FIFO queue of runnable stage indices which, in addition to the usual
+       Queue.Queue interface, can hand out the first stage meeting a condition."""
+    def getFirst(self, condition):
+        """removes and returns the first index (in hand-out order) for which
+           condition(index) is true, or None. All other indices stay in place."""
+        self.mutex.acquire()
+        try:
+            for index in self.queue:
+                if condition(index):
+                    self.queue.remove(index)
+                    return index
+            return None
+        finally:
+            self.mutex.release()
+    def indices(self):
+        """returns a list of the queued indices"""
+        self.mutex.acquire()
+        try:
+            return list(self.queue)
+        finally:
+            self.mutex.release()
+
+class PriorityRunnableQueue(RunnableQueue):
+    """Queue of runnable stage indices which hands out the stage with the highest
+       priority first (ties are broken by stage index). Used like Queue.Queue."""
+    def __init__(self, priorities):
+        RunnableQueue.__init__(self)
+        self.priorities = priorities
+    def _init(self, maxsize):
+        self.queue = []
+    def _put(self, index):
+        heapq.heappush(self.queue, (-self.priorities[index], index))
+    def _get(self):
+        return heapq.heappop(self.queue)[1]
+    def getFirst(self, condition):
+        self.mutex.acquire()
+        try:
+            # pop in priority order until a match is found, then restore the rest
+            skipped = []
+            found = None
+            while self.queue:
+                item = heapq.heappop(self.queue)
+                if condition(item[1]):
+                    found = item[1]
+                    break
+                skipped.append(item)
+            for item in skipped:
+                heapq.heappush(self.queue, item)
+            return found
+        finally:
+            self.mutex.release()
+    def indices(self):
+        self.mutex.acquire()
+        try:
+            return [item[1] for item in self.queue]
+        finally:
+            self.mutex.release()
+
 class Pipeline(Pyro.core.SynchronizedObjBase):
     def __init__(self):
         # initialize the remote objects bits
@@ -148,7 +486,21 @@ class Pipeline(Pyro.core.SynchronizedObjBase):
         self.stages = []
         self.nameArray = []
         # a queue of the stages ready to be run - contains indices
-        self.runnable = Queue.Queue()
+        self.runnable = RunnableQueue()
+        # if set, runnable stages are handed out by longest remaining critical path
+        # rather than in the order in which they became runnable
+        self.priorityScheduling = False
+        # expected runtime (seconds) per stage type, and the resulting priority per stage
+        self.stageRuntimes = dict(DEFAULT_STAGE_RUNTIMES)
+        self.priorities = []
+        # expected runtime (seconds) per stage index learned from past runs, see estimateResources
+        self.learnedRuntimes = {}
+        # earlier failures per stage index as (time, kind, mem) and the stages waiting to be 
+        # retried as a heap of (due time, index), see retryStage
+        self.retryHistory = {}
+        self.delayedStages = []
+        # memory of a single executor, the most a stage can be given when it is retried
+        self.maxStageMem = None
         # the current stage counter
         self.counter = 0
         # hash to keep the output to stage association
@@ -157,10 +509,59 @@ class Pipeline(Pyro.core.SynchronizedObjBase):
         self.stagehash = {}
         # an array containing the status per stage
         self.processedStages = []
+        # number of unfinished predecessors per stage - a stage is runnable at 0
+        self.unfinishedPredecessors = []
         # location of backup files for restart if needed
         self.backupFileLocation = None
+        # journal of stage state changes since the last snapshot
+        self.journal = None
+        # resource usage measured for each stage that was run
+        self.statsStore = None
+        # minimum number of journal entries before a new snapshot is written
+        self.snapshotInterval = 1000
         # list of registered clients
         self.clients = []
+        # set whenever stages become runnable, so that waiting clients can be notified
+        self.workAvailable = threading.Event()
+        # time of the last heartbeat per client, and the client holding each claimed stage
+        # (clients are identified by their URI string)
+        self.clientHeartbeats = {}
+        self.stageLeases = {}
+        # heartbeats bypass synlock, so clientHeartbeats has its own lock
+        self.heartbeatLock = threading.Lock()
+        self.leaseTimeout = LEASE_TIMEOUT
+        # capacity of consumable resources shared by all executors (e.g. the file server's
+        # "io"), by name, and the amounts held by each claimed stage, see getRunnableStagesFor
+        self.globalResources = {}
+        self.heldResources = {}
+        # free space (in bytes) to keep on the filesystems stages write to (None: not checked), 
+        # the predicted output size of each claimed stage as (device, bytes) and their total
+        # per device, the predicted output size per stage whose inputs exist, the model used 
+        # to predict it (see estimateResources) and when low disk space was last reported
+        self.minFreeDisk = None
+        self.pendingOutputBytes = {}
+        self.pendingDeviceBytes = {}
+        self.outputBytes = {}
+        # if set, idle executors get copies of stages running speculationFactor times as long as
+        # expected (see getStragglerFor). Also kept: when each stage was started, the client 
+        # running the copy of each stage that has one, and the stages each client should cancel
+        self.speculationFactor = None
+        self.stageStarts = {}
+        self.speculated = {}
+        self.cancellations = {}
+        self.outputModel = None
+        self.diskAlert = None
+        # shared with other pipelines, handed to the stages (see output_cache), or None
+        self.outputCache = None
+        # records the outputs of finished stages (see output_manifest), optionally with checksums
+        self.outputManifest = None
+        self.outputChecksums = False
+        # stages to run even though their outputs exist, as their inputs changed since they
+        # were run (see invalidateStage), and whether to record input digests to tell
+        self.invalidated = set()
+        self.inputDigests = False
+        # longest runtime an executor that has just started is sure to accept (None: unlimited)
+        self.maxStageRuntime = None
         # Initially set number of skipped stages to be 0
         self.skipped_stages = 0
     def addStage(self, stage):
@@ -188,50 +589,135 @@ class Pipeline(Pyro.core.SynchronizedObjBase):
             # increment the counter for the next stage
             self.counter += 1
     def selfPickle(self):
-        """Pickles pipeline in case future restart is needed"""
+        """Writes a snapshot of the pipeline in case future restart is needed.
+           State changes after the snapshot are recorded in the stage journal."""
         if (self.backupFileLocation == None):
             self.setBackupFileLocation()
-        pickle.dump(self.G, open(str(self.backupFileLocation) + '/G.pkl', 'wb'))
-        pickle.dump(self.stages, open(str(self.backupFileLocation) + '/stages.pkl', 'wb'))
-        pickle.dump(self.nameArray, open(str(self.backupFileLocation) + '/nameArray.pkl', 'wb'))
-        pickle.dump(self.counter, open(str(self.backupFileLocation) + '/counter.pkl', 'wb'))
-        pickle.dump(self.outputhash, open(str(self.backupFileLocation) + '/outputhash.pkl', 'wb'))
-        pickle.dump(self.stagehash, open(str(self.backupFileLocation) + '/stagehash.pkl', 'wb'))
-        pickle.dump(self.processedStages, open(str(self.backupFileLocation) + '/processedStages.pkl', 'wb'))
+        for attr in BACKUP_ATTRIBUTES:
+            # write to a temporary file first, so a crash never leaves a truncated backup
+            backupFile = str(self.backupFileLocation) + '/' + attr + '.pkl'
+            bf = open(backupFile + '.tmp', 'wb')
+            pickle.dump(getattr(self, attr), bf, pickle.HIGHEST_PROTOCOL)
+            bf.flush()
+            os.fsync(bf.fileno())
+            bf.close()
+            os.rename(backupFile + '.tmp', backupFile)
+        # everything in the journal is now part of the snapshot
+        self.getJournal().truncate()
         logger.info("Pipeline pickled")
+    def getStatsStore(self):
+        if self.statsStore == None:
+            if (self.backupFileLocation == None):
+                self.setBackupFileLocation()
+            self.statsStore = StageStatsStore(self.backupFileLocation)
+        return self.statsStore
+    def recordStageStats(self, index, stats):
+        """stores the resource usage measured by an executor for stage index"""
+        stage = self.stages[index]
+        self.getStatsStore().record(index, stage.getType(), repr(stage), stats)
+    def getOutputManifest(self):
+        if self.outputManifest == None:
+            if (self.backupFileLocation == None):
+                self.setBackupFileLocation()
+            self.outputManifest = OutputManifest(self.backupFileLocation)
+        return self.outputManifest
+    def getJournal(self):
+        if self.journal == None:
+            if (self.backupFileLocation == None):
+                self.setBackupFileLocation()
+            self.journal = StageJournal(self.backupFileLocation)
+        return self.journal
+    def journalStage(self, index, status):
+        """Records a stage state change in the journal, compacting it into a new snapshot
+           once it has grown as large as the pipeline itself."""
+        journal = self.getJournal()
+        journal.append(index, status)
+        if journal.entries >= max(self.snapshotInterval, len(self.stages)):
+            self.selfPickle()
     def restart(self):
-        """Restarts the pipeline from previously pickled backup files."""
+        """Restarts the pipeline from the last snapshot and the stage journal."""
         if (self.backupFileLocation == None):
             self.setBackupFileLocation()
             logger.info("Backup location not specified. Looking in the current directory.")
         try:
-            self.G = pickle.load(open(str(self.backupFileLocation) + '/G.pkl', 'rb'))
-            self.stages = pickle.load(open(str(self.backupFileLocation) + '/stages.pkl', 'rb'))
-            self.nameArray = pickle.load(open(str(self.backupFileLocation) + '/nameArray.pkl', 'rb'))
-            self.counter = pickle.load(open(str(self.backupFileLocation) + '/counter.pkl', 'rb'))
-            self.outputhash = pickle.load(open(str(self.backupFileLocation) + '/outputhash.pkl', 'rb'))
-            self.stagehash = pickle.load(open(str(self.backupFileLocation) + '/stagehash.pkl', 'rb'))
-            self.processedStages = pickle.load(open(str(self.backupFileLocation) + '/processedStages.pkl', 'rb'))
+            for attr in BACKUP_ATTRIBUTES:
+                setattr(self, attr, pickle.load(open(str(self.backupFileLocation) + '/' + attr + '.pkl', 'rb')))
             logger.info('Successfully reimported old data from backups.')
         except:
             logger.exception("Backup files are not recoverable.  Pipeline restart required.")
             sys.exit()
 
-        done = []
-        for i in self.G.nodes_iter():
-            if self.stages[i].isFinished():
-                done.append(i)
-            else:
-                if i in self.processedStages:
-                    self.processedStages.remove(i)
+        # replay the stage state changes made since the snapshot was written
+        replayed = self.getJournal().replay()
+        for (timestamp, i, status) in replayed:
+            if status == "finished":
+                self.stages[i].setFinished()
+            elif status == "failed":
+                self.stages[i].setFailed()
+            elif status == "running":
+                self.stages[i].setRunning()
+        logger.info('Replayed ' + str(len(replayed)) + ' journal entries.')
+
+        done = [i for i in self.G.nodes_iter() if self.stages[i].isFinished()]
+        self.processedStages = done
         logger.info('Previously completed stages (of ' + str(len(self.stages)) + ' total): ' + str(len(done)))
 
+    def getPlanInputs(self):
+        """the input files of the stages that no stage produces, i.e. those read from outside
+           of the pipeline (wherever the application found them, e.g. listed in a csv file)"""
+        inputs = set()
+        for s in self.stages:
+            inputs.update([f for f in s.inputFiles if f not in self.outputhash])
+        return sorted(inputs)
+    def savePlan(self, filename):
+        """Writes the stages added so far, before initialize(), to filename, together with
+           a description (see describeOutputs) of the inputs they read from outside of the
+           pipeline. A crash never leaves a truncated file behind."""
+        plan = dict([(attr, getattr(self, attr)) for attr in PLAN_ATTRIBUTES])
+        inputs = self.getPlanInputs()
+        plan["inputs"] = (describeOutputs(inputs, checksums=True), 
+                          [f for f in inputs if not os.path.exists(f)])
+        f = open(filename + ".tmp", "wb")
+        pickle.dump(plan, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(filename + ".tmp", filename)
+    def loadPlan(self, filename):
+        """Adds the stages saved with savePlan and returns True - or returns False, adding
+           nothing, if any of their inputs from outside of the pipeline changed since (see
+           matchesOutput), or appeared. The memory of the stages is estimated anew (see
+           CmdStage.reestimateMem), and the directories of their outputs and log files are
+           recreated where they have been removed since."""
+        plan = pickle.load(open(filename, "rb"))
+        described, missing = plan.pop("inputs")
+        for (path, size, mtime, checksum) in described:
+            if not matchesOutput(path, size, mtime, checksum):
+                logger.info("The input " + path + " of the saved plan has changed.")
+                return False
+        for path in missing:
+            if os.path.exists(path):
+                logger.info("The input " + path + " of the saved plan has appeared.")
+                return False
+        for attr, value in plan.items():
+            setattr(self, attr, value)
+        for s in self.stages:
+            if isinstance(s, CmdStage):
+                s.reestimateMem()
+        directories = set()
+        for s in self.stages:
+            for f in s.outputFiles + ([s.logFile] if s.logFile else []):
+                directories.add(os.path.dirname(os.path.abspath(f)))
+        for d in directories:
+            fh.makedirsIgnoreExisting(d)
+        return True
     def setBackupFileLocation(self, outputDir=None):
         """Sets location of backup files."""
         if (outputDir == None):
             # set backups in current directory if directory doesn't currently exist
             outputDir = os.getcwd() 
         self.backupFileLocation = fh.createBackupDir(outputDir)   
+        self.journal = None
+        self.statsStore = None
+        self.outputManifest = None
     def addPipeline(self, p):
         if p.skipped_stages > 0:
             self.skipped_stages += p.skipped_stages
@@ -261,21 +747,14 @@ class Pipeline(Pyro.core.SynchronizedObjBase):
     def computeGraphHeads(self):
         """adds stages with no incomplete predecessors to the runnable queue"""
         graphHeads = []
+        self.unfinishedPredecessors = [0] * len(self.stages)
         for i in self.G.nodes_iter():
-            if self.stages[i].isFinished() == False:
-                """ either it has 0 predecessors """
-                if len(self.G.predecessors(i)) == 0:
-                    self.runnable.put(i)
-                    graphHeads.append(i)
-                """ or all of its predecessors are finished """
-                if len(self.G.predecessors(i)) != 0:
-                    predfinished = True
-                    for j in self.G.predecessors(i):
-                        if self.stages[j].isFinished() == False:
-                            predfinished = False
-                    if predfinished == True:
-                        self.runnable.put(i) 
-                        graphHeads.append(i)
+            for j in self.G.predecessors_iter(i):
+                if not self.stages[j].isFinished():
+                    self.unfinishedPredecessors[i] += 1
+            if not self.stages[i].isFinished() and self.unfinishedPredecessors[i] == 0:
+                self.runnable.put(i)
+                graphHeads.append(i)
         logger.info("Graph heads: " + str(graphHeads))
     def getStage(self, i):
         """given an index, return the actual pipelineStage object"""
@@ -288,56 +767,523 @@ class Pipeline(Pyro.core.SynchronizedObjBase):
             index = self.runnable.get()
             self.stages[index].setRunning()
             return index
-        
-    def setStageStarted(self, index, clientURI=None):
+    def getRunnableStageFor(self, freeMem, freeProcs):
+        """returns (index, stage) for the first runnable stage (in queue order) that
+           fits into the given memory and processors, or None. Stages that do not fit
+           keep their place in the queue."""
+        claimed = self.getRunnableStagesFor(freeMem, freeProcs, maxStages=1)
+        if not claimed:
+            return None
+        return claimed[0]
+    def getRunnableStagesFor(self, freeMem, freeProcs, prefetch=0, maxMem=None, maxProcs=None, 
+                             maxStages=None, clientURI=None, maxRuntime=None, 
+                             freeResources=None, maxResources=None):
+        """Claims runnable stages for an executor in one call, returning a list of (index, stage).
+           Stages are taken in queue order as long as they fit into freeMem/freeProcs together.
+           After that, up to prefetch more stages are claimed that fit into the executor's
+           total capacity (maxMem/maxProcs), to be started once its resources free up.
+           If clientURI is given, the client holds a lease on the claimed stages as long 
+           as it keeps sending heartbeats. If maxRuntime is given, only stages expected to
+           finish within that many seconds are claimed.
+           freeResources and maxResources do the same as freeMem and maxMem for the other
+           consumable resources of the executor, by name. Resources the executor has no
+           capacity for are not limited by it, but claimed stages always have to fit into
+           what is left of the global resources (see globalResources)."""
+        claimed = []
+        budget = [freeMem, freeProcs, dict(freeResources or {})]
+        # free disk space per output directory, looked up once per call
+        diskSpace = {}
+        def fitsTime(i):
+            return maxRuntime == None or self.getBoundedRuntime(i) <= maxRuntime
+        def fitsBudget(i):
+            return (self.stages[i].getMem() <= budget[0] and self.stages[i].getProcs() <= budget[1]
+                    and pe.fitsResources(self.stages[i].getResources(), budget[2])
+                    and fitsGlobalResources(i) and fitsTime(i) and self.fitsDisk(i, diskSpace))
+        def fitsExecutor(i):
+            return ((maxMem == None or self.stages[i].getMem() <= maxMem) 
+                    and (maxProcs == None or self.stages[i].getProcs() <= maxProcs)
+                    and pe.fitsResources(self.stages[i].getResources(), maxResources or {})
+                    and fitsGlobalResources(i) and fitsTime(i) and self.fitsDisk(i, diskSpace))
+        def fitsGlobalResources(i):
+            return pe.fitsResources(self.stages[i].getResources(), self.getFreeGlobalResources())
+        while maxStages == None or len(claimed) < maxStages:
+            index = self.runnable.getFirst(fitsBudget)
+            if index == None:
+                break
+            budget[0] -= self.stages[index].getMem()
+            budget[1] -= self.stages[index].getProcs()
+            budget[2] = pe.subtractResources(budget[2], self.stages[index].getResources())
+            self.holdGlobalResources(index)
+            self.holdDiskSpace(index, diskSpace)
+            claimed.append(index)
+        for k in range(prefetch):
+            if maxStages != None and len(claimed) >= maxStages:
+                break
+            index = self.runnable.getFirst(fitsExecutor)
+            if index == None:
+                break
+            self.holdGlobalResources(index)
+            self.holdDiskSpace(index, diskSpace)
+            claimed.append(index)
+        if not claimed and clientURI and self.speculationFactor and self.runnable.empty():
+            return self.getStragglerFor(freeMem, freeProcs, freeResources, clientURI)
+        for index in claimed:
+            self.stages[index].setRunning()
+            # executors plan around it when backfilling (see pipelineExecutor.startClaimedStages)
+            self.stages[index].expectedRuntime = self.getExpectedRuntime(index)
+            # outputs are moved into place once complete, so those in the manifest are whole
+            self.stages[index].privateOutputs = True
+            self.stages[index].outputCache = self.outputCache
+            self.stages[index].outputChecksums = self.outputChecksums
+            self.stages[index].inputDigests = self.inputDigests
+            self.stages[index].rerun = index in self.invalidated
+            if clientURI:
+                self.stageLeases[index] = str(clientURI)
+        return [(index, self.stages[index]) for index in claimed]
+    def setOutputCache(self, cache):
+        """has the stages take their outputs from cache (a StageOutputCache) where they can,
+           and add them to it otherwise"""
+        self.outputCache = cache
+    def setSpeculation(self, factor):
+        """hands out copies of stages running factor times as long as expected to idle executors"""
+        self.speculationFactor = factor
+    def getStragglerFor(self, freeMem, freeProcs, freeResources, clientURI):
+        """Once no stages are runnable, returns [(index, stage)] for the running stage that is 
+           the furthest past speculationFactor times its expected runtime, and fits into the
+           free resources of clientURI, which is then to run a copy of it - or [] if there is 
+           none. Only stages that write their outputs into private directories (see 
+           CmdStage.privateCommand) are copied, and only once."""
+        now = time.time()
+        stragglers = []
+        for i, start in self.stageStarts.items():
+            s = self.stages[i]
+            overdue = now - start - self.speculationFactor * self.getExpectedRuntime(i)
+            if (s.status == "running" and overdue > 0 and i not in self.speculated 
+                and self.stageLeases.get(i) not in [None, str(clientURI)]
+                and s.privateOutputs and isinstance(s, CmdStage) and s.hasOutputsInCommand()
+                and s.getMem() <= freeMem and s.getProcs() <= freeProcs
+                and pe.fitsResources(s.getResources(), freeResources or {})):
+                stragglers.append((overdue, i))
+        if not stragglers:
+            return []
+        overdue, index = max(stragglers)
+        logger.info("Stage %i has been running for %i seconds longer than expected. Running a copy on %s: %s" 
+                    % (index, overdue, clientURI, self.stages[index]))
+        self.speculated[index] = str(clientURI)
+        return [(index, self.stages[index])]
+    def settleCopies(self, index, clientURI, finished):
+        """Called for every stage reported as finished or failed by clientURI. Returns
+           False if the report is to be ignored: it comes from the loser of a stage that
+           had a copy, or from a copy which failed while the other one still runs. If a 
+           copy finished, the other one is cancelled."""
+        if self.stages[index].isFinished():
+            return False
+        if index not in self.speculated:
+            return True
+        holders = [self.stageLeases.get(index), self.speculated[index]]
+        if finished:
+            for c in holders:
+                if c and c != str(clientURI):
+                    self.cancellations.setdefault(c, set()).add(index)
+                    self.workAvailable.set()
+            del self.speculated[index]
+            return True
+        logger.info("A copy of stage %i failed on %s. Waiting for the other one." % (index, clientURI))
+        if self.speculated[index] != str(clientURI):
+            self.stageLeases[index] = self.speculated[index]
+        del self.speculated[index]
+        return False
+    def takeCancellations(self, clientURI):
+        """returns the stages clientURI should cancel, once"""
+        return sorted(self.cancellations.pop(str(clientURI), []))
+    def setGlobalResource(self, name, capacity):
+        """limits the total amount of the named resource held by the stages of all executors"""
+        self.globalResources[name] = capacity
+    def getStagesExceedingResources(self, capacities):
+        """unfinished stages that require more of a resource than its capacity"""
+        return [i for i in range(len(self.stages)) if not self.stages[i].isFinished()
+                and not pe.fitsResources(self.stages[i].getResources(), capacities)]
+    def getFreeGlobalResources(self):
+        free = dict(self.globalResources)
+        for resources in self.heldResources.values():
+            free = pe.subtractResources(free, resources)
+        return free
+    def holdGlobalResources(self, index):
+        """global resources are held from the time a stage is claimed until it is
+           finished, failed or returned to the queue"""
+        held = dict([(name, amount) for (name, amount) in self.stages[index].getResources().items() 
+                     if name in self.globalResources])
+        if held:
+            self.heldResources[index] = held
+    def setMinFreeDisk(self, minFreeDisk):
+        """stages are only handed out if their predicted output leaves minFreeDisk bytes free"""
+        self.minFreeDisk = minFreeDisk
+        self.predictAllOutputBytes()
+    def predictAllOutputBytes(self):
+        """predicts the output size of all unfinished stages whose inputs exist already, so that
+           handing out stages doesn't have to look at their inputs"""
+        for i in range(len(self.stages)):
+            if not self.stages[i].isFinished():
+                self.predictOutputBytes(i)
+    def predictOutputBytes(self, index):
+        """Predicted size of the outputs of a stage whose inputs exist: from the history of its 
+           stage type if there is enough (see StageResourceModel), otherwise each output is 
+           assumed to be as large as the largest input, as for most MINC tools. Predictions
+           are kept once all inputs exist."""
+        if index in self.outputBytes:
+            return self.outputBytes[index]
+        s = self.stages[index]
+        inputSizes = [os.path.getsize(f) for f in s.inputFiles if os.path.isfile(f)]
+        estimate = None
+        if self.outputModel:
+            estimate = self.outputModel.estimateOutputBytes(s.getType(), sum(inputSizes))
+        if estimate == None:
+            estimate = max(inputSizes + [0]) * len(s.outputFiles)
+        if len(inputSizes) == len(s.inputFiles):
+            self.outputBytes[index] = estimate
+        return estimate
+    def fitsDisk(self, index, diskSpace):
+        """True if the predicted output of a stage fits into the free space of the filesystem
+           it is written to, less the predicted output of the claimed stages writing to the same
+           filesystem and minFreeDisk. diskSpace caches the free space per directory."""
+        s = self.stages[index]
+        if self.minFreeDisk == None or not s.outputFiles:
+            return True
+        directory = os.path.dirname(os.path.abspath(s.outputFiles[0]))
+        if directory not in diskSpace:
+            diskSpace[directory] = freeDiskSpace(directory)
+        device, free = diskSpace[directory]
+        pending = self.pendingDeviceBytes.get(device, 0)
+        needed = self.predictOutputBytes(index)
+        if free - pending - needed >= self.minFreeDisk:
+            if self.diskAlert:
+                logger.warning("Enough disk space in " + directory + " again. Handing out stages writing to it.")
+                self.diskAlert = None
+            return True
+        if not self.diskAlert or time.time() - self.diskAlert > DISK_ALERT_INTERVAL:
+            # only logged, as this runs while stages are handed out
+            logger.error("LOW DISK SPACE: %.2fG free in %s, %.2fG of which is expected to be written by claimed stages. "
+                         % (free / GB, directory, pending / GB)
+                         + "Not handing out stage %i, expected to write %.2fG, until at least %.2fG would be left: %s"
+                         % (index, needed / GB, self.minFreeDisk / GB, s))
+            self.diskAlert = time.time()
+        return False
+    def holdDiskSpace(self, index, diskSpace):
+        """space for the predicted output of a stage is held until it is finished, failed or returned"""
+        if self.minFreeDisk == None or not self.stages[index].outputFiles:
+            return
+        directory = os.path.dirname(os.path.abspath(self.stages[index].outputFiles[0]))
+        device, needed = diskSpace[directory][0], self.predictOutputBytes(index)
+        if index in self.pendingOutputBytes:
+            oldDevice, oldNeeded = self.pendingOutputBytes[index]
+            self.pendingDeviceBytes[oldDevice] -= oldNeeded
+        self.pendingOutputBytes[index] = (device, needed)
+        self.pendingDeviceBytes[device] = self.pendingDeviceBytes.get(device, 0) + needed
+    def releaseHeldResources(self, index):
+        """releases the global resources and disk space held by a claimed stage"""
+        self.heldResources.pop(index, None)
+        if index in self.pendingOutputBytes:
+            device, needed = self.pendingOutputBytes.pop(index)
+            self.pendingDeviceBytes[device] -= needed
+        self.stageStarts.pop(index, None)
+    def hasRunnableStagesLongerThan(self, runtime):
+        """True if any runnable stage is expected to take longer than runtime seconds,
+           but could still be run by an executor that has just started"""
+        for i in self.runnable.indices():
+            if self.getBoundedRuntime(i) > runtime:
+                return True
+        return False
+    def returnStages(self, indices):
+        """stages claimed by an executor but never started are put back into the runnable queue"""
+        for i in indices:
+            self.stageLeases.pop(i, None)
+            self.requeue(i)
+    def reportStages(self, started, finished, failed, clientURI=None, stats=None, failures=None):
+        """batched form of setStageStarted, setStageFinished and setStageFailed for executors.
+           stats maps stage indices to the resource usage measured while running them,
+           failures maps failed stage indices to the kind of failure (see pipeline_executor.classifyFailure)."""
+        if stats:
+            for i, stageStats in stats.items():
+                self.recordStageStats(i, stageStats)
+                if i in finished and stageStats.get("outputs"):
+                    self.getOutputManifest().record(i, stageStats["outputs"], self.stages[i].getHash())
+                if i in finished and stageStats.get("input_digests"):
+                    self.getOutputManifest().recordInputs(repr(self.stages[i]), stageStats["input_digests"])
+            self.getStatsStore().commit()
+            self.getOutputManifest().commit()
+        for i in started:
+            if not self.stages[i].isFinished():
+                self.setStageStarted(i, clientURI)
+        for i in finished:
+            if self.settleCopies(i, clientURI, True):
+                self.stageLeases.pop(i, None)
+                self.setStageFinished(i)
+        for i in failed:
+            if self.settleCopies(i, clientURI, False):
+                self.stageLeases.pop(i, None)
+                self.setStageFailed(i, (failures or {}).get(i))
+    def Pyro_dyncall(self, method, flags, args):
+        # heartbeats must get through even while the server is busy with other
+        # calls (e.g. writing a snapshot), or live clients could lose their leases
+        if method == "heartbeat":
+            return Pyro.core.ObjBase.Pyro_dyncall(self, method, flags, args)
+        return Pyro.core.SynchronizedObjBase.Pyro_dyncall(self, method, flags, args)
+    def heartbeat(self, clientURI):
+        """called periodically by each client to renew the leases on its stages.
+           Returns False if the client is not registered (e.g. because its leases 
+           have expired), in which case the client should shut down."""
+        self.heartbeatLock.acquire()
+        try:
+            if str(clientURI) not in self.clientHeartbeats:
+                logger.warning("Heartbeat from unknown client " + str(clientURI) + " refused.")
+                return False
+            self.clientHeartbeats[str(clientURI)] = time.time()
+            return True
+        finally:
+            self.heartbeatLock.release()
+    def expireLeases(self):
+        """Requeues the stages held by clients which have stopped sending heartbeats, and
+           removes those clients. Must be called with the pipeline's lock held."""
+        now = time.time()
+        for c, lastHeartbeat in self.clientHeartbeats.items():
+            if now - lastHeartbeat <= self.leaseTimeout:
+                continue
+            self.heartbeatLock.acquire()
+            try:
+                # the client may have sent a heartbeat in the meantime
+                if now - self.clientHeartbeats[c] <= self.leaseTimeout:
+                    continue
+                del self.clientHeartbeats[c]
+            finally:
+                self.heartbeatLock.release()
+            logger.warning("No heartbeat from client " + str(c) + " for " + str(int(now - lastHeartbeat))
+                           + " seconds. Returning its stages to the runnable queue.")
+            self.clients = [x for x in self.clients if str(x) != c]
+            self.cancellations.pop(c, None)
+            for i, holder in self.speculated.items():
+                if holder == c:
+                    del self.speculated[i]
+            for i, holder in self.stageLeases.items():
+                if holder == c:
+                    del self.stageLeases[i]
+                    if i in self.speculated:
+                        # the copy of the stage carries on
+                        self.stageLeases[i] = self.speculated.pop(i)
+                    elif self.stages[i].status == "running":
+                        logger.info("Requeueing orphaned stage " + str(i) + ": " + str(self.stages[i]))
+                        self.requeue(i)
+    def setStageStarted(self, index, clientURI=None, save_state = True):
         URIstring = " "
         if clientURI:
             URIstring = "(" + str(clientURI) + ")"
         logger.debug("Starting Stage " + str(index) + ": " + str(self.stages[index]) +
                      URIstring)
+        # a copy of the stage (see getStragglerFor) doesn't start the clock again
+        self.stageStarts.setdefault(index, time.time())
+        if save_state:
+            self.journalStage(index, "running")
 
     def checkIfRunnable(self, index):
         """stage added to runnable queue if all predecessors finished"""
-        canRun = True
-        logger.debug("Checking if stage " + str(index) + " is runnable ...")
-        if self.stages[index].isFinished() == True:
-            canRun = False
-        else:
-            for i in self.G.predecessors(index):              
-                s = self.getStage(i)
-                if s.isFinished() == False:
-                    canRun = False
+        canRun = (not self.stages[index].isFinished()) and self.unfinishedPredecessors[index] == 0
         logger.debug("Stage " + str(index) + " Runnable: " + str(canRun))
         return canRun
 
     def setStageFinished(self, index, save_state = True):
         """given an index, sets corresponding stage to finished and adds successors to the runnable queue"""
+        if self.stages[index].isFinished():
+            logger.warning("Stage " + str(index) + " was already finished.")
+            return
         logger.info("Finished Stage " + str(index) + ": " + str(self.stages[index]))
+        self.releaseHeldResources(index)
         self.stages[index].setFinished()
         self.processedStages.append(index)
         if save_state: 
-            self.selfPickle()
-        for i in self.G.successors(index):
+            self.journalStage(index, "finished")
+        for i in self.G.successors_iter(index):
+            self.unfinishedPredecessors[i] -= 1
             if self.checkIfRunnable(i):
                 self.runnable.put(i)
+                self.workAvailable.set()
 
-    def setStageFailed(self, index):
-        """given an index, sets stage to failed, adds to processed stages array"""
+    def setStageFailed(self, index, failure=None):
+        """given an index, sets stage to failed, adds to processed stages array. 
+           failure is the kind of failure (see pipeline_executor.classifyFailure): stages which may 
+           succeed on another attempt are retried instead (see retryStage)."""
+        self.releaseHeldResources(index)
+        if failure and self.retryStage(index, failure):
+            return
         self.stages[index].setFailed()
         logger.info("ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
         self.processedStages.append(index)
+        self.journalStage(index, "failed")
         for i in nx.dfs_successor(self.G, index).keys():
             self.processedStages.append(i)
 
+    def retryStage(self, index, failure):
+        """Requeues a failed stage according to the retry policy and returns True,
+           or returns False if it should not be retried"""
+        stage = self.stages[index]
+        history = self.retryHistory.setdefault(index, [])
+        attempts = len([h for h in history if h[1] == failure 
+                        or h[1] in ["oom", "memlimit"] and failure in ["oom", "memlimit"]])
+        history.append((time.time(), failure, stage.getMem()))
+        delay = 0
+        if failure in ["oom", "memlimit"]:
+            mem = stage.getMem() * OOM_MEM_FACTOR
+            if self.maxStageMem != None:
+                mem = min(mem, self.maxStageMem)
+            if attempts >= MAX_OOM_RETRIES or mem <= stage.getMem():
+                return False
+            if failure == "memlimit":
+                logger.warning("Stage %i exceeded its memory limit of %.2fG. Retrying with %.2fG: %s"
+                               % (index, stage.getMem(), mem, stage))
+            else:
+                logger.warning("Stage %i ran out of memory with %.2fG. Retrying with %.2fG: %s"
+                               % (index, stage.getMem(), mem, stage))
+            stage.setMem(mem)
+        elif failure == "timeout":
+            if attempts >= MAX_RETRIES:
+                return False
+            runtime = self.getExpectedRuntime(index) * TIMEOUT_RUNTIME_FACTOR
+            logger.warning("Stage %i timed out. Retrying, expecting it to take %i seconds: %s" % (index, runtime, stage))
+            self.learnedRuntimes[index] = runtime
+        elif failure == "transient":
+            if attempts >= MAX_RETRIES:
+                return False
+            delay = RETRY_BACKOFF * 2 ** attempts
+            logger.warning("Stage %i failed (%s). Retrying in %i seconds: %s" % (index, failure, delay, stage))
+        else:
+            return False
+        self.getStatsStore().recordRetry(index, stage.getType(), repr(stage), failure, len(history), stage.getMem(), delay)
+        self.getStatsStore().commit()
+        stage.setNone()
+        if delay:
+            heapq.heappush(self.delayedStages, (time.time() + delay, index))
+        else:
+            self.requeue(index)
+        return True
+    def requeueDelayedStages(self):
+        """requeues the stages whose retry delay has passed"""
+        now = time.time()
+        while self.delayedStages and self.delayedStages[0][0] <= now:
+            due, index = heapq.heappop(self.delayedStages)
+            self.requeue(index)
+    def setPriorityScheduling(self, priorityScheduling=True):
+        self.priorityScheduling = priorityScheduling
+    def setStageRuntime(self, stageType, runtime):
+        """overrides the expected runtime (in seconds) for all stages of the given type"""
+        self.stageRuntimes[stageType] = runtime
+        for i in self.learnedRuntimes.keys():
+            if self.stages[i].getType() == stageType:
+                del self.learnedRuntimes[i]
+    def getExpectedRuntime(self, index):
+        if index in self.learnedRuntimes:
+            return self.learnedRuntimes[index]
+        return self.stageRuntimes.get(self.stages[index].getType(), DEFAULT_RUNTIME)
+    def estimateResources(self, maxMem=None, maxProcs=None):
+        """Sets memory, processors and expected runtime of all stages whose type has enough
+           history in the stage statistics of earlier runs (see StageResourceModel). Other
+           stages keep their defaults. Estimates are capped at maxMem/maxProcs, the capacity
+           of a single executor, so that every stage can still be run."""
+        model = StageResourceModel(self.getStatsStore().query())
+        # output sizes can only be predicted once the inputs exist (see predictOutputBytes)
+        self.outputModel = model
+        self.outputBytes = {}
+        estimated = 0
+        for i in range(len(self.stages)):
+            s = self.stages[i]
+            estimate = model.estimate(s.getType(), fileBytes(s.inputFiles))
+            if not estimate:
+                continue
+            mem, procs, runtime = estimate
+            if maxMem:
+                mem = min(mem, maxMem)
+            if maxProcs:
+                procs = min(procs, maxProcs)
+            s.setMem(mem)
+            s.setProcs(procs)
+            self.learnedRuntimes[i] = runtime
+            estimated += 1
+        logger.info("Estimated resources of %i of %i stages from earlier runs." % (estimated, len(self.stages)))
+    def setMaxStageMem(self, mem):
+        """Sets the memory of a single executor, the most stages are retried with (see 
+           retryStage). Stages declaring more (e.g. estimated from the MINC headers of large
+           inputs) could never be run, so they are capped at mem with a warning."""
+        self.maxStageMem = mem
+        capped = {}
+        for s in self.stages:
+            if not s.isFinished() and s.getMem() > mem:
+                capped.setdefault(s.getType(), []).append(s.getMem())
+                s.setMem(mem)
+        for stageType, mems in sorted(capped.items()):
+            logger.warning("%i %s stage(s) declare up to %.1fG of memory, more than an executor has (--mem=%.1fG). "
+                           "Running them with %.1fG." % (len(mems), stageType, max(mems), mem, mem))
+    def setMaxStageRuntime(self, runtime):
+        """sets the longest runtime (in seconds) a newly started executor is sure to accept"""
+        self.maxStageRuntime = runtime
+    def getBoundedRuntime(self, index):
+        """expected runtime used when handing out stages: stages expected to run longer than
+           maxStageRuntime are treated as taking exactly that long, so that they still go to
+           newly started executors instead of making every executor drain in turn"""
+        runtime = self.getExpectedRuntime(index)
+        if self.maxStageRuntime != None:
+            runtime = min(runtime, self.maxStageRuntime)
+        return runtime
+    def getStagesExceedingWalltime(self, learnedOnly=False):
+        """indices of unfinished stages expected to run longer than maxStageRuntime - with
+           learnedOnly, only of those whose runtime was learned from earlier runs (see
+           estimateResources) rather than guessed from their type"""
+        if self.maxStageRuntime == None:
+            return []
+        return [i for i in range(len(self.stages)) 
+                if not self.stages[i].isFinished() and self.getExpectedRuntime(i) > self.maxStageRuntime
+                and (i in self.learnedRuntimes or not learnedOnly)]
+    def computePriorities(self):
+        """priority of a stage is the expected runtime of the longest downstream path
+           starting at that stage, including the stage itself"""
+        self.priorities = [0] * len(self.stages)
+        for i in reversed(nx.topological_sort(self.G)):
+            longestSuccessor = 0
+            for j in self.G.successors_iter(i):
+                longestSuccessor = max(longestSuccessor, self.priorities[j])
+            self.priorities[i] = self.getExpectedRuntime(i) + longestSuccessor
     def requeue(self, i):
         """If stage cannot be run due to insufficient mem/procs, executor returns it to the queue"""
+        self.releaseHeldResources(i)
         self.stages[i].setNone()
         self.runnable.put(i)            
+        self.workAvailable.set()
+    def invalidateStage(self, index):
+        """Has stage index and all stages depending on it run again, even though their outputs
+           exist (see CmdStage.execStage). Those that were finished are reset."""
+        reset = []
+        for i in nx.dfs_successor(self.G, index).keys():
+            self.invalidated.add(i)
+            # their inputs are written anew
+            self.outputBytes.pop(i, None)
+            if self.stages[i].isFinished():
+                self.stages[i].setNone()
+                reset.append(i)
+        for i in reset:
+            for j in self.G.successors_iter(i):
+                self.unfinishedPredecessors[j] += 1
+        if reset:
+            self.processedStages = [i for i in self.processedStages if i not in set(reset)]
+        if index in reset and self.unfinishedPredecessors[index] == 0:
+            self.runnable.put(index)
+            self.workAvailable.set()
     def initialize(self):
         """called once all stages have been added - computes dependencies and adds graph heads to runnable queue"""
-        self.runnable = Queue.Queue()
         self.createEdges()
+        if self.priorityScheduling:
+            self.computePriorities()
+            self.runnable = PriorityRunnableQueue(self.priorities)
+        else:
+            self.runnable = RunnableQueue()
         self.computeGraphHeads()
+        if self.minFreeDisk != None:
+            self.predictAllOutputBytes()
     def continueLoop(self):
         """Returns 1 unless all stages are finished. Used in Pyro communication."""
         return(len(self.stages) > len(self.processedStages))
@@ -347,6 +1293,16 @@ class Pipeline(Pyro.core.SynchronizedObjBase):
         """Adds new client to array of registered clients."""
         print "CLIENT REGISTERED: " + str(client)
         self.clients.append(client)
+        self.heartbeatLock.acquire()
+        self.clientHeartbeats[str(client)] = time.time()
+        self.heartbeatLock.release()
+    def unregister(self, client):
+        """Removes a client which is shutting down of its own accord."""
+        print "CLIENT UNREGISTERED: " + str(client)
+        self.clients = [x for x in self.clients if str(x) != str(client)]
+        self.heartbeatLock.acquire()
+        self.clientHeartbeats.pop(str(client), None)
+        self.heartbeatLock.release()
 
 def launchPipelineExecutor(options, programName=None):
     """Launch pipeline executor directly from pipeline"""
@@ -356,7 +1312,31 @@ def launchPipelineExecutor(options, programName=None):
     else: 
         pipelineExecutor.launchExecutor()    
 
-def skip_completed_stages(pipeline):
+def skip_completed_stages(pipeline, verify=True, staleness="none", diffPlan=False):
+    """Marks the stages whose outputs are all in the output manifest as finished. If verify
+       is set, the outputs must also be unchanged since (see output_manifest.matchesOutput),
+       otherwise the files aren't looked at. Without a manifest (e.g. for backups of older
+       versions), and for stages without outputs, stages whose output files exist are 
+       finished; the outputs of the former are added to the manifest. Unless staleness is
+       "none", stages whose inputs changed since they were run (see output_manifest.isStale),
+       including finished ones, are run again together with all stages depending on them.
+       With diffPlan, so are stages whose outputs were written by a different stage, i.e. 
+       one with a different fingerprint (see getHash), e.g. because of a changed protocol."""
+    manifest = pipeline.getOutputManifest()
+    recorded = manifest.entries()
+    inputDigests = manifest.inputDigests() if staleness == "digest" else {}
+    def changed(s):
+        recordedHashes = set([recorded[f][3] for f in s.outputFiles if f in recorded])
+        return bool(recordedHashes - set([None, s.getHash()]))
+    changedStages = 0
+    def stale(s):
+        return staleness != "none" and isinstance(s, CmdStage) and isStale(s, staleness, inputDigests.get(repr(s)))
+    if staleness != "none":
+        # stages finished before a restart
+        for i in nx.topological_sort(pipeline.G):
+            if pipeline.stages[i].isFinished() and i not in pipeline.invalidated and stale(pipeline.stages[i]):
+                logger.info("Inputs of stage %i changed since it was run: %s" % (i, pipeline.stages[i]))
+                pipeline.invalidateStage(i)
     runnable = []
     while True:
         i = pipeline.getRunnableStageIndex()                
@@ -368,18 +1348,84 @@ def skip_completed_stages(pipeline):
             runnable.append(i)
             continue
         
-        if not s.is_effectively_complete():
+        if s.outputFiles and all([f in recorded for f in s.outputFiles]):
+            if verify and not all([matchesOutput(f, *recorded[f][:3]) for f in s.outputFiles]):
+                runnable.append(i)
+                continue
+        elif recorded and s.outputFiles:
+            # not finished in a run that kept the manifest
+            runnable.append(i)
+            continue
+        elif not s.is_effectively_complete():
+            runnable.append(i)
+            continue
+        elif s.outputFiles:
+            manifest.record(i, describeOutputs(s.outputFiles), s.getHash())
+        
+        if diffPlan and changed(s):
+            logger.info("Stage %i changed since its outputs were written: %s" % (i, s))
+            changedStages += 1
+            pipeline.invalidateStage(i)
             runnable.append(i)
             continue
         
-        pipeline.setStageStarted(i, "PYRO://Previous.Run")
+        if stale(s):
+            logger.info("Inputs of stage %i changed since it was run: %s" % (i, s))
+            pipeline.invalidateStage(i)
+            runnable.append(i)
+            continue
+        
+        pipeline.setStageStarted(i, "PYRO://Previous.Run", save_state = False)
         pipeline.setStageFinished(i, save_state = False)
         logger.debug("skipping stage %i" % i)
     
+    if diffPlan:
+        print "%i stages changed since their outputs were written." % changedStages
+    # closed rather than committed, as executors may be forked off next
+    manifest.close()
     for i in runnable:
         pipeline.requeue(i)
         
-def launchServer(pipeline, options, e):
+def notifyClients(pipeline):
+    """Wakes up registered executors whenever stages become runnable, and tells them
+       which copies of stages to cancel. This runs in its own thread and uses oneway 
+       calls, so the server never waits on a client."""
+    proxies = {}
+    while pipeline.continueLoop():
+        pipeline.workAvailable.wait(pe.POLLING_INTERVAL)
+        if not pipeline.workAvailable.isSet():
+            continue
+        pipeline.workAvailable.clear()
+        for c in pipeline.clients[:]:
+            try:
+                if not proxies.has_key(c):
+                    proxies[c] = Pyro.core.getProxyForURI(c)
+                    proxies[c]._setOneway(["notifyWork", "cancelStages"])
+                proxies[c].notifyWork()
+                cancelled = pipeline.takeCancellations(c)
+                if cancelled:
+                    proxies[c].cancelStages(cancelled)
+            except:
+                logger.debug("Could not notify client " + str(c), exc_info=True)
+                proxies.pop(c, None)
+
+def monitorPipeline(pipeline):
+    """Periodically returns stages held by clients that stopped sending heartbeats,
+       requeues failed stages once their retry delay has passed, and syncs journal 
+       entries which have been buffered for too long"""
+    while pipeline.continueLoop():
+        time.sleep(pe.HEARTBEAT_INTERVAL)
+        pipeline.synlock.acquire()
+        try:
+            pipeline.expireLeases()
+            pipeline.requeueDelayedStages()
+            pipeline.getJournal().syncIfDue()
+        except:
+            logger.exception("Failed to monitor the pipeline.")
+        finally:
+            pipeline.synlock.release()
+
+def launchServer(pipeline, options, e, programName=None):
     """Starts Pyro Server in a separate thread"""
     Pyro.core.initServer()
     daemon=Pyro.core.Daemon()
@@ -401,11 +1447,25 @@ def launchServer(pipeline, options, e):
     
     e.set()
     
+    notifier = threading.Thread(target=notifyClients, args=(pipeline,))
+    notifier.setDaemon(True)
+    notifier.start()
+    monitor = threading.Thread(target=monitorPipeline, args=(pipeline,))
+    monitor.setDaemon(True)
+    monitor.start()
+    if options.max_exec > 0:
+        autoscaler = threading.Thread(target=ExecutorAutoscaler(pipeline, options, programName).run)
+        autoscaler.setDaemon(True)
+        autoscaler.start()
+    
     try:
         daemon.requestLoop(pipeline.continueLoop) 
     except:
         logger.exception("Failed running server in daemon.requestLoop. Server shutting down.")
     else:
+        pipeline.getJournal().close()
+        pipeline.getStatsStore().close()
+        pipeline.getOutputManifest().close()
         try:
             print("All pipeline stages have been processed. Daemon unregistering " 
                   + str(len(pipeline.clients)) + " client(s) and shutting down...")
@@ -485,9 +1545,61 @@ def pipelineDaemon(pipeline, options=None, programName=None):
 
     if options.urifile==None:
         options.urifile = os.path.abspath(os.curdir + "/" + "uri")
+    
+    if options.max_exec > 0 and options.queue != "sge":
+        logger.warning("--max-executors is only supported with --queue=sge. Executors will not be autoscaled.")
+        options.max_exec = 0
         
-    logger.debug("Examining filesystem to determine skippable stages...")
-    skip_completed_stages(pipeline)
+    logger.debug("Examining the output manifest to determine skippable stages...")
+    pipeline.outputChecksums = options.output_checksums
+    # restarts trust the manifest; otherwise outputs may have been removed to have them rerun
+    pipeline.inputDigests = options.staleness == "digest"
+    skip_completed_stages(pipeline, verify=not options.restart or options.verify_outputs, 
+                          staleness=options.staleness, diffPlan=options.diff_plan and not options.restart)
+    
+    pipeline.setMaxStageMem(options.mem)
+    # executors keep WALLTIME_MARGIN in reserve; allow as much again for executor start up
+    try:
+        pipeline.setMaxStageRuntime(pe.parseWalltime(options.time) - 2 * pe.WALLTIME_MARGIN)
+    except ValueError:
+        print "Invalid executor wall time (--time): " + str(options.time) + ". Exiting..."
+        sys.exit()
+    overlong = pipeline.getStagesExceedingWalltime(learnedOnly=True)
+    if overlong:
+        print "The following stages took longer in earlier runs than the executor wall time (--time=%s) allows:" % options.time
+        for i in overlong:
+            print "  %i (expected %is): %s" % (i, pipeline.getExpectedRuntime(i), pipeline.stages[i])
+        print "Increase --time. Exiting..."
+        sys.exit()
+    guessed = pipeline.getStagesExceedingWalltime()
+    if guessed:
+        # guesses by stage type only, which may well be too pessimistic for this data
+        logger.warning("%i stage(s) (e.g. %i: %s) may run longer than the executor wall time (--time=%s) allows, "
+                       "judging by the default runtime of their type. They will be killed if they do."
+                       % (len(guessed), guessed[0], pipeline.stages[guessed[0]], options.time))
+    try:
+        executorResources = pe.parseResources(options.resources)
+        for name, capacity in pe.parseResources(options.global_resources).items():
+            pipeline.setGlobalResource(name, capacity)
+    except ValueError, ex:
+        print str(ex) + ". Exiting..."
+        sys.exit()
+    if options.speculation_factor > 0:
+        pipeline.setSpeculation(options.speculation_factor)
+    if options.min_free_disk > 0:
+        pipeline.setMinFreeDisk(options.min_free_disk * GB)
+    if options.output_cache:
+        pipeline.setOutputCache(StageOutputCache(options.output_cache, options.output_cache_size * GB or None))
+    oversized = (pipeline.getStagesExceedingResources(executorResources) 
+                 + pipeline.getStagesExceedingResources(pipeline.globalResources))
+    if oversized:
+        print "The following stages require more of a resource than --resource or --global-resource provide:"
+        for i in sorted(set(oversized)):
+            print "  %i (requires %s): %s" % (i, pipeline.stages[i].getResources(), pipeline.stages[i])
+        print "Increase the capacities. Exiting..."
+        sys.exit()
+    # the journal only records changes, so start it from a complete snapshot
+    pipeline.selfPickle()
     
     e = Event()
     logger.debug("Prior to starting server, total stages %i. Number processed: %i.", 
@@ -495,7 +1607,7 @@ def pipelineDaemon(pipeline, options=None, programName=None):
     logger.debug("Number of stages in runnable index (size of queue): %i",
                  pipeline.runnable.qsize())
     logger.debug("Starting server...")
-    process = Process(target=launchServer, args=(pipeline,options,e,))
+    process = Process(target=launchServer, args=(pipeline,options,e,programName,))
     process.start()
     e.wait()
     
@@ -4,25 +4,50 @@ import Pyro.core, Pyro.naming
 import time
 import sys
 import os
+import fcntl
 from optparse import OptionParser
 from datetime import datetime
 from multiprocessing import Process, Pool, Lock
+import threading
+import tempfile
+import shutil
 from subprocess import call
 import pydpiper.queueing as q
+from pydpiper.memory_limits import LIMIT_MODES, effectiveLimitMode
+from pydpiper.cpu_affinity import CpuAllocator
 import logging
 
 logger = logging.getLogger(__name__)
 
-POLLING_INTERVAL = 5 # poll for new jobs
+POLLING_INTERVAL = 5 # poll for new jobs, unless woken up earlier by the server or a finished stage
+HEARTBEAT_INTERVAL = 10 # seconds between heartbeats sent to the server to keep stage leases
+WALLTIME_MARGIN = 600 # seconds of walltime kept in reserve when deciding whether a stage still fits
+MIN_STAGE_TIMEOUT = 600 # seconds stages may always run before their watchdog kills them, see --stage-timeout-factor
 
 Pyro.config.PYRO_MOBILE_CODE=1
 
+# messages in the (tail of the) stage log that identify the kind of failure
+OOM_MESSAGES = ["out of memory", "cannot allocate memory", "bad_alloc", "memoryerror", "unable to allocate"]
+TRANSIENT_MESSAGES = ["stale file handle", "input/output error", "resource temporarily unavailable",
+                      "transport endpoint is not connected", 
+                      # the server stops handing out stages until space is freed (see Pipeline.fitsDisk)
+                      "no space left on device", "disk quota exceeded"]
+LOG_TAIL = 65536 # bytes
+
 #use Pyro.core.CallbackObjBase?? - need further review of documentation
 class clientExecutor(Pyro.core.SynchronizedObjBase):
     def __init__(self):
         Pyro.core.SynchronizedObjBase.__init__(self)
         self.continueRunning =  True
+        # set once the server has given the stages of this executor to other clients
+        self.leaseExpired = False
         self.mutex = Lock() 
+        # stages the server wants cancelled because another copy has finished
+        self.cancelled = set()
+        # self-pipe used to wake up the executor's main loop from other threads
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in [self.wakeupRead, self.wakeupWrite]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
     def continueLoop(self):
         self.mutex.acquire()
         return self.continueRunning
@@ -31,34 +56,206 @@ class clientExecutor(Pyro.core.SynchronizedObjBase):
         self.mutex.acquire()
         self.continueRunning = False
         self.mutex.release()
+        self.wakeup()
+    def leaseLost(self):
+        # called by the heartbeat thread when the server no longer knows this executor
+        self.leaseExpired = True
+        self.serverShutdownCall()
+    def notifyWork(self):
+        # receive call from server when new stages have become runnable
+        self.wakeup()
+    def cancelStages(self, indices):
+        # receive call from server when another copy of these stages has finished
+        self.cancelled.update(indices)
+        self.wakeup()
+    def takeCancelled(self):
+        cancelled, self.cancelled = self.cancelled, set()
+        return cancelled
+    def wakeup(self, *args):
+        """interrupts the main loop's wait for requests"""
+        try:
+            os.write(self.wakeupWrite, "x")
+        except OSError:
+            pass # pipe is full, so the main loop will wake up anyway
+    def clearWakeup(self, ready=None):
+        try:
+            while os.read(self.wakeupRead, 4096):
+                pass
+        except OSError:
+            pass
          
-def runStage(serverURI, clientURI, i):
-    # Proc needs its own proxy as it's independent of executor
+def parseWalltime(walltime):
+    """converts a wall time in the format [[[dd:]hh:]mm:]ss to seconds.
+       Raises ValueError if walltime is not in that format."""
+    fields = str(walltime).split(":")
+    if not 1 <= len(fields) <= 4 or not all([f.isdigit() for f in fields]):
+        raise ValueError("Wall time must be in the format [[[dd:]hh:]mm:]ss, not: " + str(walltime))
+    seconds = 0
+    for (field, multiplier) in zip(reversed(fields), [1, 60, 3600, 86400]):
+        seconds += int(field) * multiplier
+    return seconds
+
+def parseResources(specs):
+    """converts resource capacities given as name=amount (e.g. io=4) to a dictionary.
+       Raises ValueError if a capacity is not in that format."""
+    resources = {}
+    for spec in specs or []:
+        name, sep, amount = spec.partition("=")
+        if not name or not sep:
+            raise ValueError("Resources must be given as name=amount, not: " + str(spec))
+        resources[name] = float(amount)
+    return resources
+
+def fitsResources(required, free):
+    """True if the resources a stage requires fit into free. Resources missing
+       from free are not limited."""
+    for name, amount in required.items():
+        if name in free and amount > free[name]:
+            return False
+    return True
+
+def subtractResources(free, used):
+    """free minus used, for the resources in free"""
+    return dict([(name, amount - used.get(name, 0)) for (name, amount) in free.items()])
+
+def addResources(free, released):
+    """free plus released, for the resources in free"""
+    return dict([(name, amount + released.get(name, 0)) for (name, amount) in free.items()])
+
+def sendHeartbeats(serverURI, clientURI, executor):
+    """Sends heartbeats to the server from a separate thread, so that they are 
+       sent even while the main loop waits for the server"""
+    # proxies can't be shared between threads
     p = Pyro.core.getProxyForURI(serverURI)
-    s = p.getStage(i)
-    
-    # Run stage, set finished or failed accordingly  
-    try:
-        logger.info("Running stage %i: ", i)
-        p.setStageStarted(i, clientURI)
+    while executor.continueRunning:
         try:
-            r = s.execStage()
+            if not p.heartbeat(clientURI):
+                logger.error("Server no longer knows this executor (lease expired). Shutting down executor...")
+                executor.leaseLost()
+                break
         except:
-            logger.exception("Exception whilst running stage: %i ", i)   
-            p.setStageFailed(i)
-        else:
-            logger.info("Stage %i finished, return was: %i", i, r)
-            if r == 0:
-                p.setStageFinished(i)
-            else:
-                p.setStageFailed(i)
+            logger.exception("Failed to send heartbeat to the server.")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+def classifyFailure(returncode, logFile=None, memLimited=False, timedOut=False):
+    """Returns "timeout" for stages killed by their watchdog (timedOut), "oom" for 
+       stages killed by the OOM killer (SIGKILL) or failing to allocate memory - 
+       "memlimit" instead if the stage's memory was limited (memLimited), "transient" 
+       for stages which may well succeed when run again (killed by another signal, the 
+       executor failing to run them, or I/O errors), and "error" for all other failures."""
+    if timedOut:
+        return "timeout"
+    failure = classifyFailureKind(returncode, logFile)
+    if failure == "oom" and memLimited:
+        return "memlimit"
+    return failure
+
+def classifyFailureKind(returncode, logFile):
+    if returncode == -9:
+        return "oom"
+    if returncode == None or returncode < 0:
+        return "transient"
+    tail = ""
+    if logFile and os.path.isfile(str(logFile)):
+        lf = open(str(logFile))
+        lf.seek(max(0, os.path.getsize(str(logFile)) - LOG_TAIL))
+        tail = lf.read().lower()
+        lf.close()
+    for message in OOM_MESSAGES:
+        if message in tail:
+            return "oom"
+    for message in TRANSIENT_MESSAGES:
+        if message in tail:
+            return "transient"
+    return "error"
 
-        return [s.getMem(),s.getProcs()] # If completed, return mem & processes back for re-use    
+def runStage(i, s, memLimit=None, cpus=None, timeout=None, cancelFile=None):
+    """Runs stage s (with index i) in a pool process and returns its exit status,
+       or None if the stage raised an exception, together with the resource usage
+       measured by the stage (if any) and the kind of failure (see classifyFailure).
+       The stage's outcome is reported to the server by the executor in batches."""
+    try:
+        logger.info("Running stage %i: ", i)
+        # only pass what is in use, so stages overriding execStage keep working
+        kwargs = {}
+        if memLimit and memLimit != "none":
+            kwargs["memLimit"] = memLimit
+        if cpus:
+            kwargs["cpus"] = cpus
+        if timeout:
+            kwargs["timeout"] = timeout
+        if cancelFile:
+            kwargs["cancelFile"] = cancelFile
+        r = s.execStage(**kwargs)
     except:
-        logger.exception("Error communicating to server in runStage. " 
-                         "Error raised to calling thread in launchExecutor. ")
-        raise        
+        logger.exception("Exception whilst running stage: %i ", i)   
+        return (None, None, classifyFailure(None))
+    logger.info("Stage %i finished, return was: %i", i, r)
+    failure = None
+    stats = getattr(s, "stats", None)
+    if r != 0:
+        failure = classifyFailure(r, s.logFile, memLimited=bool(stats and stats.get("mem_limit")),
+                                  timedOut=bool(stats and stats.get("timed_out")))
+    return (r, stats, failure)
+
+class ChildProcess():
+    def __init__(self, stage, mem, procs, wakeup, cpus=None, resources=None):
+        self.stage = stage
+        self.mem = mem
+        self.procs = procs                 
+        self.resources = resources or {}
+        # when the stage should be done, used to plan reservations for stages that don't fit
+        self.expectedEnd = None
+        self.cpus = cpus
+        self.wakeup = wakeup
+        # the stage is killed once this file exists (see cancelStages)
+        self.cancelFile = None
+        self.result = None
+        self.done = False
+        self.returnValue = None
+        self.stats = None
+        self.failure = None
+    def setDone(self, r):
+        """pool callback - called as soon as runStage has returned"""
+        self.returnValue, self.stats, self.failure = r
+        self.done = True
+        self.wakeup()
          
+class Reservation():
+    def __init__(self, executor, stage):
+        """resources an executor reserves for stage, see pipelineExecutor.reserve"""
+        self.executor = executor
+        self.stage = stage
+        self.time = time.time()
+        # resources expected to be in use by other stages at self.time
+        self.mem = executor.runningMem
+        self.procs = executor.runningProcs
+        self.resources = dict(executor.runningResources)
+    def finish(self, child):
+        self.mem -= child.mem
+        self.procs -= child.procs
+        self.resources = subtractResources(self.resources, child.resources)
+    def fits(self, other=None):
+        """True if the reserved stage (together with other, if given) fits at self.time"""
+        mem, procs, resources = self.stage.getMem(), self.stage.getProcs(), dict(self.stage.getResources())
+        if other:
+            mem += other.getMem()
+            procs += other.getProcs()
+            for name, amount in other.getResources().items():
+                resources[name] = resources.get(name, 0) + amount
+        return self.executor.canRun(mem, procs, self.mem, self.procs, resources, self.resources)
+    def admits(self, stage):
+        """True if stage can be started now without delaying the reserved stage: it is expected
+           to finish before the reservation, or leaves enough for the reserved stage anyway"""
+        if time.time() + (stage.expectedRuntime or 0) <= self.time:
+            return True
+        if self.fits(stage):
+            self.mem += stage.getMem()
+            self.procs += stage.getProcs()
+            self.resources = addResources(self.resources, stage.getResources())
+            return True
+        return False
+
 class pipelineExecutor():
     def __init__(self, options):
         #options cannot be null when used to instantiate pipelineExecutor
@@ -70,6 +267,46 @@ class pipelineExecutor():
         self.uri = options.urifile
         if self.uri==None:
             self.uri = os.path.abspath(os.curdir + "/" + "uri")
+        # number of claimed stages kept locally in addition to those that fit right now
+        self.prefetch = options.prefetch
+        # wall time of this executor - stages expected to run past it are not claimed
+        self.time = options.time or "2:00:00:00"
+        self.deadline = None
+        # how the memory declared by each stage is enforced (see memory_limits)
+        self.memLimit = options.mem_limit
+        # hands out cores to stages if they are to be pinned (see cpu_affinity)
+        self.cpuAllocator = None
+        if options.cpu_affinity:
+            self.cpuAllocator = CpuAllocator()
+        # capacities of other consumable resources (e.g. io, scratch_gb), by name
+        self.resources = parseResources(options.resources)
+        # resources in use by running stages
+        self.runningMem = 0.0
+        self.runningProcs = 0
+        self.runningResources = dict([(name, 0) for name in self.resources])
+        # if set, the first claimed stage that doesn't fit gets a reservation, and other stages
+        # are only started if they don't delay it (see startClaimedStages)
+        self.backfill = options.backfill
+        self.reservation = None
+        # stages are killed after running stageTimeoutFactor times as long as expected (0: never),
+        # but never before MIN_STAGE_TIMEOUT or after maxStageTime seconds
+        self.stageTimeoutFactor = options.stage_timeout_factor
+        self.maxStageTime = None
+        if options.max_stage_time:
+            self.maxStageTime = parseWalltime(options.max_stage_time)
+        # holds the files that tell running stages to cancel themselves
+        self.cancelDir = None
+        self.runningChildren = [] # no scissors
+        # stages claimed from the server but not yet started, as (index, stage)
+        self.claimedStages = []
+        # stage state changes not yet reported to the server
+        self.startedStages = []
+        self.finishedStages = []
+        self.failedStages = []
+        # resource usage of completed stages and kind of failure of failed stages 
+        # not yet reported, per stage index
+        self.stageStats = {}
+        self.stageFailures = {}
         self.setLogger()
     
     def setLogger(self):
@@ -96,19 +333,177 @@ class pipelineExecutor():
             cmd = ["sge_batch", "-J", jobname, "-m", strprocs, "-l", strmem] 
             if self.sge_queue_opts:
                 cmd += ["-q", self.sge_queue_opts]
-            cmd += ["pipeline_executor.py", "--uri-file", self.uri, "--proc", strprocs, "--mem", str(self.mem)]
+            cmd += ["pipeline_executor.py", "--uri-file", self.uri, "--proc", strprocs, "--mem", str(self.mem),
+                    "--time", self.time, "--mem-limit", self.memLimit]
+            if self.cpuAllocator:
+                cmd += ["--cpu-affinity"]
+            for name, amount in self.resources.items():
+                cmd += ["--resource", "%s=%s" % (name, amount)]
+            if self.backfill:
+                cmd += ["--backfill"]
+            cmd += ["--stage-timeout-factor", str(self.stageTimeoutFactor)]
+            if self.maxStageTime:
+                cmd += ["--max-stage-time", str(self.maxStageTime)]
+            cmd += ["--prefetch", str(self.prefetch)]
             call(cmd)   
         else:
             print("Specified queueing system is: %s" % (self.queue))
             print("Only queue=sge or queue=None currently supports pipeline launching own executors.")
             print("Exiting...")
             sys.exit()
-    def canRun(self, stageMem, stageProcs, runningMem, runningProcs):
-        """Calculates if stage is runnable based on memory and processor availibility"""
-        if ( (stageMem <= (self.mem-runningMem) ) and (stageProcs<=(self.proc-runningProcs)) ):
+    def canRun(self, stageMem, stageProcs, runningMem, runningProcs, stageResources=None, runningResources=None):
+        """Calculates if stage is runnable based on memory, processor and other resource availibility"""
+        freeResources = subtractResources(self.resources, runningResources or {})
+        if ( (stageMem <= (self.mem-runningMem) ) and (stageProcs<=(self.proc-runningProcs)) 
+             and fitsResources(stageResources or {}, freeResources) ):
             return True
         else:
             return False
+    def freeResources(self):
+        """Collects completed children and frees up their resources. Returns True if any completed."""
+        completed = [x for x in self.runningChildren if x.done]
+        for child in completed:
+            logger.debug("Freeing up resources for stage %i." % child.stage)
+            if child.returnValue == 0:
+                self.finishedStages.append(child.stage)
+            else:
+                self.failedStages.append(child.stage)
+                self.stageFailures[child.stage] = child.failure
+            if child.stats:
+                self.stageStats[child.stage] = child.stats
+            self.runningMem -= child.mem
+            self.runningProcs -= child.procs
+            self.runningResources = subtractResources(self.runningResources, child.resources)
+            if child.cpus:
+                self.cpuAllocator.release(child.cpus)
+            self.runningChildren.remove(child)
+        return len(completed) > 0
+    def startStage(self, pool, executor, i, s):
+        stageMem, stageProcs = s.getMem(), s.getProcs()
+        self.runningMem += stageMem
+        self.runningProcs += stageProcs            
+        self.runningResources = addResources(self.runningResources, s.getResources())
+        cpus = None
+        if self.cpuAllocator:
+            # None if there aren't enough free cores (e.g. --proc exceeds the cores of the node)
+            cpus = self.cpuAllocator.allocate(stageProcs)
+        # wake up the main loop as soon as the stage is done
+        child = ChildProcess(i, stageMem, stageProcs, executor.wakeup, cpus, s.getResources())
+        child.expectedEnd = time.time() + (s.expectedRuntime or 0)
+        # another copy of the stage may finish first, or the executor may lose its lease
+        if not self.cancelDir:
+            self.cancelDir = tempfile.mkdtemp(prefix="pydpiper-cancel-")
+        child.cancelFile = os.path.join(self.cancelDir, str(i))
+        child.result = pool.apply_async(runStage,(i, s, self.memLimit, cpus, self.stageTimeout(s), child.cancelFile), 
+                                        callback=child.setDone)
+        self.runningChildren.append(child)
+        self.startedStages.append(i)
+        logger.debug("Added stage %i to the running pool." % i)
+    def cancelStages(self, indices):
+        """Cancels stages of which another copy has finished: claimed ones are dropped, 
+           running ones killed (see CmdStage.watch). Their failures are ignored by the server."""
+        for (i, s) in self.claimedStages[:]:
+            if i in indices:
+                self.claimedStages.remove((i, s))
+        for child in self.runningChildren:
+            if child.stage in indices and child.cancelFile:
+                logger.info("Another copy of stage %i has finished. Cancelling it." % child.stage)
+                open(child.cancelFile, "w").close()
+    def dropStages(self):
+        """Called once the server has given the stages of this executor to other clients (its
+           lease expired): claimed stages are dropped and running ones killed, and nothing
+           about them is to be reported, as the server may have handed them out again."""
+        self.claimedStages = []
+        for child in self.runningChildren:
+            logger.info("Lease expired. Killing stage %i." % child.stage)
+            open(child.cancelFile, "w").close()
+        self.startedStages = []
+        self.finishedStages = []
+        self.failedStages = []
+        self.stageStats = {}
+        self.stageFailures = {}
+    def stageTimeout(self, s):
+        """seconds after which the watchdog of stage s kills it, or None"""
+        timeout = None
+        if self.stageTimeoutFactor:
+            timeout = max((s.expectedRuntime or 0) * self.stageTimeoutFactor, MIN_STAGE_TIMEOUT)
+        if self.maxStageTime:
+            timeout = min(timeout or self.maxStageTime, self.maxStageTime)
+        return timeout
+    def startClaimedStages(self, pool, executor):
+        """Starts all claimed stages that fit into the free resources. Returns True if any started.
+           With backfilling, the first claimed stage that doesn't fit (the one the server handed out
+           first, i.e. with the highest priority) reserves the resources that running stages are 
+           expected to free up, and later stages are only started if they don't delay it."""
+        started = False
+        previous = self.reservation
+        self.reservation = None
+        for (i, s) in self.claimedStages[:]:
+            fits = self.canRun(s.getMem(), s.getProcs(), self.runningMem, self.runningProcs, 
+                               s.getResources(), self.runningResources)
+            if fits and (self.reservation == None or self.reservation.admits(s)):
+                self.claimedStages.remove((i, s))
+                self.startStage(pool, executor, i, s)
+                started = True
+            elif not fits and self.reservation == None and self.backfill:
+                self.reservation = self.reserve(s)
+                if previous == None or previous.stage is not s:
+                    logger.debug("Reserved resources for stage %i, expected to be free in %i seconds." 
+                                 % (i, self.reservation.time - time.time()))
+        return started
+    def reserve(self, stage):
+        """Returns the reservation for a stage that doesn't fit now: the time at which enough
+           running stages are expected to have finished for it to fit, and the stages expected
+           to be running still at that time."""
+        reservation = Reservation(self, stage)
+        for child in sorted(self.runningChildren, key=lambda c: c.expectedEnd):
+            reservation.time = max(reservation.time, child.expectedEnd)
+            reservation.finish(child)
+            if reservation.fits():
+                break
+        return reservation
+    def claimStages(self, p, clientURI):
+        """Claims stages fitting into the free resources, plus up to self.prefetch
+           stages to be kept locally until resources free up, in one call to the server."""
+        claimedMem = sum([s.getMem() for (i, s) in self.claimedStages])
+        claimedProcs = sum([s.getProcs() for (i, s) in self.claimedStages])
+        freeMem = self.mem - self.runningMem - claimedMem
+        freeProcs = self.proc - self.runningProcs - claimedProcs
+        freeResources = subtractResources(self.resources, self.runningResources)
+        for (i, s) in self.claimedStages:
+            freeResources = subtractResources(freeResources, s.getResources())
+        prefetch = max(0, self.prefetch - len(self.claimedStages))
+        if not (freeMem > 0 and freeProcs > 0) and prefetch == 0:
+            return False
+        maxRuntime = self.remainingTime()
+        if self.reservation:
+            # only claim stages that can be backfilled before the reservation
+            maxRuntime = min(maxRuntime, self.reservation.time - time.time())
+        claimed = p.getRunnableStagesFor(freeMem, freeProcs, prefetch=prefetch, maxMem=self.mem, maxProcs=self.proc, 
+                                         clientURI=clientURI, maxRuntime=maxRuntime,
+                                         freeResources=freeResources, maxResources=self.resources)
+        self.claimedStages += claimed
+        return len(claimed) > 0
+    def remainingTime(self):
+        """seconds of wall time left for running stages, keeping WALLTIME_MARGIN in reserve"""
+        return self.deadline - time.time() - WALLTIME_MARGIN
+    def isDrained(self, p):
+        """True if this executor is idle and should exit because its remaining wall time
+           is too short for any of the runnable stages"""
+        if self.runningChildren or self.claimedStages:
+            return False
+        remaining = self.remainingTime()
+        return remaining <= 0 or p.hasRunnableStagesLongerThan(remaining)
+    def reportStages(self, p, clientURI):
+        """Sends all stage state changes since the last report to the server in one call"""
+        if self.startedStages or self.finishedStages or self.failedStages:
+            p.reportStages(self.startedStages, self.finishedStages, self.failedStages, clientURI,
+                           stats=self.stageStats, failures=self.stageFailures)
+            self.startedStages = []
+            self.finishedStages = []
+            self.failedStages = []
+            self.stageStats = {}
+            self.stageFailures = {}
     def launchExecutor(self):  
         """Start executor that will run pipeline stages"""   
         # initialize pipeline_executor as both client and server      
@@ -135,59 +530,38 @@ class pipelineExecutor():
         p = Pyro.core.getProxyForURI(serverURI)
         p.register(clientURI)
       
-        #initialize runningMem and Procs
-        runningMem = 0.0
-        runningProcs = 0               
-
-        class ChildProcess():
-            def __init__(self, stage, result, mem, procs):
-                self.stage = stage
-                self.result = result
-                self.mem = mem
-                self.procs = procs                 
-                                
-        runningChildren = [] # no scissors
- 
         print "Connected to ", serverURI
         print "Client URI is ", clientURI
+        self.deadline = time.time() + parseWalltime(self.time)
+        heartbeat = threading.Thread(target=sendHeartbeats, args=(serverURI, clientURI, executor))
+        heartbeat.setDaemon(True)
+        heartbeat.start()
+        # before starting the pool, whose processes then share the executor's cgroup
+        self.memLimit = effectiveLimitMode(self.memLimit)
         # loop until the pipeline sets executor.continueLoop() to false
         pool = Pool(processes = self.proc)
         try:
             while executor.continueLoop(): 
                 executor.mutex.release()               
                 daemon.handleRequests(0)               
+                executor.clearWakeup()
                 # Free up resources from any completed (successful or otherwise) stages
-                for child in [x for x in runningChildren if x.result.ready()]:
-                    logger.debug("Freeing up resources for stage %i." % child.stage)
-                    runningMem -= child.mem
-                    runningProcs -= child.procs
-                    runningChildren.remove(child)
-
-                # check if we have any free processes, and even a little bit of memory
-                if not self.canRun(1, 1, runningMem, runningProcs): 
-                    time.sleep(POLLING_INTERVAL)
-                    continue
-                
-                # check for available stages
-                i = p.getRunnableStageIndex()                 
-                if i == None:
-                    logger.debug("No runnable stages. Sleeping...")
-                    time.sleep(POLLING_INTERVAL)
-                    continue
-
-                # Before running stage, check usable mem & procs
-                logger.debug("Considering stage %i" % i)
-                s = p.getStage(i)
-                stageMem, stageProcs = s.getMem(), s.getProcs()
-                if self.canRun(stageMem, stageProcs, runningMem, runningProcs):
-                    runningMem += stageMem
-                    runningProcs += stageProcs            
-                    result = pool.apply_async(runStage,(serverURI, clientURI, i))
-                    runningChildren.append(ChildProcess(i, result, stageMem, stageProcs))
-                    logger.debug("Added stage %i to the running pool." % i)
-                else:
-                    logger.debug("Not enough resources to run stage %i. " % i) 
-                    p.requeue(i)
+                progress = self.freeResources()
+                self.cancelStages(executor.takeCancelled())
+                # run what we already have, then top up from the server
+                progress = self.startClaimedStages(pool, executor) or progress
+                if self.claimStages(p, clientURI):
+                    progress = True
+                    self.startClaimedStages(pool, executor)
+                self.reportStages(p, clientURI)
+                if not progress and self.isDrained(p):
+                    logger.info("Remaining wall time is too short for the runnable stages. Shutting down executor...")
+                    p.unregister(clientURI)
+                    executor.serverShutdownCall()
+                elif not progress:
+                    # wait until the server has new stages, a stage finishes, or the polling interval passes
+                    logger.debug("No runnable stages fit the available resources. Waiting...")
+                    daemon.handleRequests(POLLING_INTERVAL, [executor.wakeupRead], executor.clearWakeup)
         except Exception:
             logger.exception("Error during executor polling loop. Shutting down executor...")
             raise
@@ -198,9 +572,25 @@ class pipelineExecutor():
                releases lock either way"""
             executor.mutex.acquire(False)
             executor.mutex.release()
+            if executor.leaseExpired:
+                self.dropStages()
             pool.close()
             pool.join()        
+            if not executor.leaseExpired:
+                self.shutdown(p, clientURI)
+            if self.cancelDir:
+                shutil.rmtree(self.cancelDir, ignore_errors=True)
             daemon.shutdown(True)
+    def shutdown(self, p, clientURI):
+        """Reports outstanding results and returns unstarted stages to the server, if it is still there"""
+        self.freeResources()
+        try:
+            self.reportStages(p, clientURI)
+            if self.claimedStages:
+                p.returnStages([i for (i, s) in self.claimedStages])
+                self.claimedStages = []
+        except:
+            logger.exception("Could not report outstanding stages to the server.")
 
 
 ##########     ---     Start of program     ---     ##########   
@@ -237,9 +627,30 @@ if __name__ == "__main__":
     parser.add_option("--queue", dest="queue", 
                       type="string", default=None,
                       help="Use specified queueing system to submit jobs. Default is None.")              
+    parser.add_option("--prefetch", dest="prefetch", 
+                      type="int", default=0,
+                      help="Number of stages each executor claims ahead of time, to start as soon as resources free up. Stages claimed ahead can't be run by other executors with free resources, so only use this with few executors or short stages. Default is 0.")
     parser.add_option("--sge-queue-opts", dest="sge_queue_opts", 
                       type="string", default=None,
                       help="For --queue=sge, allows you to specify different queues. If not specified, default is used.")
+    parser.add_option("--mem-limit", dest="mem_limit",
+                      type="choice", choices=LIMIT_MODES, default="none",
+                      help="Limit each stage to the memory it declares, with RLIMIT_AS (rlimit) or a cgroup v2 per stage (cgroup, falls back to rlimit). One of: " + ", ".join(LIMIT_MODES) + ". Default is none.")
+    parser.add_option("--cpu-affinity", dest="cpu_affinity",
+                      action="store_true", default=False,
+                      help="Pin each stage to as many cores of its own as it has processors, preferring cores of one NUMA node. Only use this if the executor has the node (or its cpuset) to itself.")
+    parser.add_option("--stage-timeout-factor", dest="stage_timeout_factor",
+                      type="float", default=0,
+                      help="Kill stages (and all processes they started) which run this many times as long as expected, but at least %i seconds, and retry them. Default is 0 (never)." % MIN_STAGE_TIMEOUT)
+    parser.add_option("--max-stage-time", dest="max_stage_time",
+                      type="string", default=None,
+                      help="Kill stages which run longer than this, in the format dd:hh:mm:ss, and retry them. Default is no limit.")
+    parser.add_option("--backfill", dest="backfill",
+                      action="store_true", default=False,
+                      help="Reserve resources for the first claimed stage that doesn't fit, and only start other stages if they are expected to finish before the reservation or leave enough for it.")
+    parser.add_option("--resource", dest="resources",
+                      action="append", default=[],
+                      help="Capacity of a consumable resource declared by stages, as name=amount (e.g. io=4 or scratch_gb=200). Can be given several times. Resources without a capacity are not limited.")
                       
     (options,args) = parser.parse_args()
 
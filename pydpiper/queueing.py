@@ -21,6 +21,13 @@ class runOnQueueingSystem():
         self.sge_queue_opts = options.sge_queue_opts
         self.ppn = options.ppn
         self.time = options.time or "2:00:00:00"      
+        self.memLimit = options.mem_limit
+        self.cpuAffinity = options.cpu_affinity
+        self.resources = options.resources
+        self.backfill = options.backfill
+        self.stageTimeoutFactor = options.stage_timeout_factor
+        self.maxStageTime = options.max_stage_time
+        self.prefetch = options.prefetch
         self.ns = options.use_ns
         self.uri = options.urifile
         if self.uri==None:
@@ -108,7 +115,20 @@ class runOnQueueingSystem():
             self.jobFile.write("sleep 1000") # sleep to ensure that PyroServer has time to start
             self.jobFile.write("\n\n")
         if launchExecs:
-            self.jobFile.write("pipeline_executor.py --uri-file=%s --proc=%d --mem=%.2f" % (self.uri, execProcs, self.mem))
+            self.jobFile.write("pipeline_executor.py --uri-file=%s --proc=%d --mem=%.2f --time=%s --mem-limit=%s" 
+                               % (self.uri, execProcs, self.mem, self.time, self.memLimit))
+            if self.cpuAffinity:
+                self.jobFile.write(" --cpu-affinity")
+            for resource in self.resources:
+                self.jobFile.write(" --resource=" + resource)
+            if self.backfill:
+                self.jobFile.write(" --backfill")
+            if self.stageTimeoutFactor:
+                self.jobFile.write(" --stage-timeout-factor=%s" % self.stageTimeoutFactor)
+            if self.maxStageTime:
+                self.jobFile.write(" --max-stage-time=" + self.maxStageTime)
+            if self.prefetch:
+                self.jobFile.write(" --prefetch=%d" % self.prefetch)
             if self.ns:
                 self.jobFile.write(" --use-ns")
             self.jobFile.write(" &\n")
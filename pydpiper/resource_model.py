@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""Estimates the memory, processors and runtime of stages from the resource usage
+   recorded for earlier stages of the same type (see stage_stats)."""
+
+SAFETY_MARGIN = 1.25 # learned memory and runtime are multiplied by this
+MIN_SAMPLES = 3 # successful runs of a stage type needed before its estimates are used
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class StageResourceModel():
+    def __init__(self, samples, margin=SAFETY_MARGIN, minSamples=MIN_SAMPLES):
+        """samples are rows from StageStatsStore.query(). Only stages that actually ran
+           (rather than being skipped) and succeeded are learned from."""
+        self.margin = margin
+        self.minSamples = minSamples
+        self.samples = {}
+        for s in samples:
+            if s["returncode"] != 0 or s["maxrss"] == None or not s["walltime"]:
+                continue
+            self.samples.setdefault(s["type"], []).append(s)
+    def knows(self, stageType):
+        return len(self.samples.get(stageType, [])) >= self.minSamples
+    def scaled(self, stageType, field, inputBytes):
+        """median of field over the past runs of stageType. Runs with smaller inputs than
+           inputBytes are scaled up in proportion, as memory and runtime of most stages
+           grow with the size of the input volumes; runs with larger inputs are not
+           scaled down, which keeps the estimate on the safe side."""
+        estimates = []
+        for s in self.samples[stageType]:
+            value = float(s[field])
+            if inputBytes and s["input_bytes"] and inputBytes > s["input_bytes"]:
+                value *= float(inputBytes) / s["input_bytes"]
+            estimates.append(value)
+        return median(estimates)
+    def estimate(self, stageType, inputBytes=0):
+        """returns (memory in G, processors, runtime in seconds) for a stage of stageType
+           whose inputs take up inputBytes (0 if unknown), or None without enough history"""
+        if not self.knows(stageType):
+            return None
+        mem = self.scaled(stageType, "maxrss", inputBytes) * self.margin / (1024.0 * 1024.0)
+        runtime = self.scaled(stageType, "walltime", inputBytes) * self.margin
+        # average number of processors kept busy while the stage ran
+        cpu = median([((s["utime"] or 0) + (s["stime"] or 0)) / s["walltime"] for s in self.samples[stageType]])
+        procs = max(1, int(math.ceil(cpu - 0.5)))
+        return (mem, procs, runtime)
+    def estimateOutputBytes(self, stageType, inputBytes=0):
+        """returns the size of the outputs of a stage of stageType whose inputs take up 
+           inputBytes (0 if unknown), or None without enough history. Outputs are assumed
+           to grow in proportion to the inputs."""
+        if not self.knows(stageType):
+            return None
+        samples = [s for s in self.samples[stageType] if s["output_bytes"] != None]
+        if not samples:
+            return None
+        ratios = [float(s["output_bytes"]) / s["input_bytes"] for s in samples if s["input_bytes"]]
+        if inputBytes and ratios:
+            return median(ratios) * inputBytes * self.margin
+        return median([s["output_bytes"] for s in samples]) * self.margin
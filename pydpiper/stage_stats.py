@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import time
+import sqlite3
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""Per-stage resource usage (wall time, CPU time, peak memory, exit status and
+   file sizes) measured by the executors, and the retries of failed stages, stored 
+   in an sqlite database in the backup directory so that they can be queried 
+   during and after a run."""
+
+STATS_FILE = "stage_stats.db"
+# measurements recorded per stage, in addition to the run, stage index, type and command
+STATS_FIELDS = [("host", "TEXT"),
+                ("start", "REAL"),      # seconds since the epoch
+                ("walltime", "REAL"),   # seconds
+                ("utime", "REAL"),      # user CPU seconds
+                ("stime", "REAL"),      # system CPU seconds
+                ("maxrss", "INTEGER"),  # peak resident set size in kilobytes
+                ("returncode", "INTEGER"),
+                ("input_bytes", "INTEGER"),
+                ("output_bytes", "INTEGER"),
+                ("mem_limit", "REAL"),     # memory limit enforced on the stage in G, if any
+                ("timeout", "REAL"),       # seconds after which the stage would be killed, if any
+                ("timed_out", "INTEGER"),  # 1 if the stage was killed for running too long
+                ("cached", "INTEGER")]     # 1 if the outputs were restored from the output cache
+
+def fileBytes(files):
+    """total size of those files that exist"""
+    return sum([os.path.getsize(f) for f in files if os.path.isfile(f)])
+
+class StageStatsStore():
+    def __init__(self, backupDir, run=None):
+        self.filename = os.path.join(str(backupDir), STATS_FILE)
+        # stages from the same server run share a run id, so that runs can be told apart
+        self.run = run or datetime.isoformat(datetime.now())
+        self.connection = None # opened lazily, so the store can cross a fork
+    def open(self):
+        if not self.connection:
+            # the server uses the store from different request threads, one at a time
+            self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stage_stats (run TEXT, stage INTEGER, type TEXT, command TEXT, "
+                                    + ", ".join(["%s %s" % f for f in STATS_FIELDS]) + ")")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS stage_stats_type ON stage_stats (type)")
+            # databases written by older versions lack the fields added since
+            existing = [row[1] for row in self.connection.execute("PRAGMA table_info(stage_stats)")]
+            for (field, fieldType) in STATS_FIELDS:
+                if field not in existing:
+                    self.connection.execute("ALTER TABLE stage_stats ADD COLUMN %s %s" % (field, fieldType))
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stage_retries (run TEXT, stage INTEGER, type TEXT, command TEXT, "
+                                    + "time REAL, failure TEXT, attempt INTEGER, mem REAL, delay REAL)")
+    def record(self, index, stageType, command, stats):
+        """adds the measurements for one stage - call commit() to make them persistent"""
+        self.open()
+        self.connection.execute("INSERT INTO stage_stats (run, stage, type, command, " + ", ".join([f for (f, t) in STATS_FIELDS])
+                                + ") VALUES (?, ?, ?, ?, " + ", ".join(["?"] * len(STATS_FIELDS)) + ")",
+                                [self.run, index, stageType, command] + [stats.get(f) for (f, t) in STATS_FIELDS])
+    def recordRetry(self, index, stageType, command, failure, attempt, mem, delay):
+        """adds a retry of a failed stage: the kind of failure, the number of the attempt
+           and the memory and delay (in seconds) it is retried with"""
+        self.open()
+        self.connection.execute("INSERT INTO stage_retries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [self.run, index, stageType, command, time.time(), failure, attempt, mem, delay])
+    def queryRetries(self, stageType=None):
+        """returns the recorded retries as a list of dicts, optionally restricted to a stage type"""
+        return self.select("stage_retries", stageType)
+    def commit(self):
+        if self.connection:
+            self.connection.commit()
+    def query(self, stageType=None, run=None):
+        """returns the recorded measurements as a list of dicts, optionally restricted
+           to a stage type and/or a run, oldest first"""
+        return self.select("stage_stats", stageType, run)
+    def select(self, table, stageType=None, run=None):
+        if not os.path.exists(self.filename):
+            return []
+        self.open()
+        conditions, values = [], []
+        if stageType != None:
+            conditions.append("type = ?")
+            values.append(stageType)
+        if run != None:
+            conditions.append("run = ?")
+            values.append(run)
+        sql = "SELECT * FROM " + table
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        cursor = self.connection.execute(sql + " ORDER BY rowid", values)
+        columns = [d[0] for d in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    def close(self):
+        if self.connection:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.autoscaler import ExecutorAutoscaler
+import pydpiper.autoscaler as autoscaler
+import os
+
+def generateFile(i):
+    return("filename_" + str(i) + ".mnc")
+
+class AutoscalerOptions():
+    def __init__(self, urifile):
+        self.queue = "sge"
+        self.sge_queue_opts = None
+        self.mem = 8.0
+        self.proc = 4
+        self.max_exec = 3
+        self.use_ns = False
+        self.urifile = urifile
+        self.prefetch = 1
+        self.time = "2:00:00:00"
+        self.mem_limit = "none"
+        self.cpu_affinity = False
+        self.resources = []
+        self.backfill = False
+        self.stage_timeout_factor = 0
+        self.max_stage_time = None
+
+class TestAutoscaler():
+    def setup_method(self, method):
+        self.p = Pipeline()
+        # ten independent stages of 2G each
+        for i in range(10):
+            self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(i)), OutputFile(generateFile(i+10))]))
+        self.p.initialize()
+
+    def fakeSgeBatch(self, tmpdir, monkeypatch):
+        """puts a fake sge_batch on the PATH which records each submission"""
+        submissions = tmpdir.join("submissions")
+        script = tmpdir.join("sge_batch")
+        script.write("#!/bin/sh\necho \"$@\" >> %s\n" % submissions)
+        script.chmod(0755)
+        monkeypatch.setenv("PATH", str(tmpdir) + os.pathsep + os.environ["PATH"])
+        monkeypatch.chdir(tmpdir)
+        return submissions
+
+    def test_scale_up_to_cap(self, tmpdir, monkeypatch):
+        """make sure that executors are submitted for the backlog, but no more than the cap"""
+        submissions = self.fakeSgeBatch(tmpdir, monkeypatch)
+        a = ExecutorAutoscaler(self.p, AutoscalerOptions(str(tmpdir.join("uri"))))
+        a.check()
+        lines = submissions.readlines()
+        assert len(lines) == 3
+        assert "pipeline_executor.py" in lines[0]
+        assert "--prefetch 1" in lines[0]
+        # pending executors count towards the cap
+        a.check()
+        assert len(submissions.readlines()) == 3
+
+    def test_scale_to_backlog(self, tmpdir, monkeypatch):
+        """make sure that only as many executors as the backlog needs are submitted"""
+        submissions = self.fakeSgeBatch(tmpdir, monkeypatch)
+        for i in range(7):
+            self.p.getRunnableStageIndex()
+        a = ExecutorAutoscaler(self.p, AutoscalerOptions(str(tmpdir.join("uri"))))
+        a.check()
+        assert len(submissions.readlines()) == 1
+
+    def test_idle_executor_shutdown(self, tmpdir, monkeypatch):
+        """make sure that idle executors are deregistered once there is no backlog"""
+        self.fakeSgeBatch(tmpdir, monkeypatch)
+        self.p.register("PYRO://idle.client")
+        self.p.register("PYRO://busy.client")
+        self.p.getRunnableStagesFor(100, 100, clientURI="PYRO://busy.client")
+        a = ExecutorAutoscaler(self.p, AutoscalerOptions(str(tmpdir.join("uri"))))
+        shutdown = []
+        a.shutdownExecutor = lambda c: shutdown.append(c)
+        a.check()
+        assert shutdown == []
+        a.idleSince["PYRO://idle.client"] -= autoscaler.IDLE_TIMEOUT
+        a.check()
+        assert shutdown == ["PYRO://idle.client"]
+
+    def test_shutdown_unregisters_executor(self, tmpdir):
+        """make sure that a shut down executor is deregistered, even if it can't be reached"""
+        self.p.register("PYRO://idle.client")
+        a = ExecutorAutoscaler(self.p, AutoscalerOptions(str(tmpdir.join("uri"))))
+        a.shutdownExecutor("PYRO://idle.client")
+        assert self.p.clients == []
+        assert not self.p.heartbeat("PYRO://idle.client")
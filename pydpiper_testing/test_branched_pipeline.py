@@ -52,7 +52,185 @@ class TestBranchedPipeline():
         s = self.p.getRunnableStageIndex()
         assert s == 3
         assert self.p.continueLoop() == True
-        
-        
 
-        
+    def test_fan_in_runnable(self):
+        """make sure that a stage with many inputs runs only once all of its predecessors are finished"""
+        leaves = [generateFile(i) for i in [2, 3, 6, 7]]
+        self.p.addStage(CmdStage(["average"] + [InputFile(f) for f in leaves] + [OutputFile(generateFile(8))]))
+        self.p.initialize()
+        assert self.p.unfinishedPredecessors[6] == 4
+        finished = []
+        s = self.p.getRunnableStageIndex()
+        while s != None and s != 6:
+            self.p.setStageFinished(s)
+            finished.append(s)
+            s = self.p.getRunnableStageIndex()
+        assert s == 6
+        assert sorted(finished) == range(6)
+        assert self.p.unfinishedPredecessors[6] == 0
+
+    def test_priority_scheduling(self):
+        """make sure that the stage on the longest remaining path is handed out first"""
+        self.p.setPriorityScheduling()
+        self.p.setStageRuntime("subcommand-5-6", 10000)
+        self.p.initialize()
+        assert self.p.priorities[3] == self.p.priorities[4] + self.p.getExpectedRuntime(3)
+        s = self.p.getRunnableStageIndex()
+        assert s == 3
+        self.p.setStageFinished(s)
+        assert self.p.getRunnableStageIndex() == 4
+        assert self.p.getRunnableStageIndex() == 0
+
+    def test_runnable_stage_for_resources(self):
+        """make sure that stages which do not fit the executor keep their place in the queue"""
+        self.p.stages[0].setMem(10)
+        r = self.p.getRunnableStageFor(4, 8)
+        assert r[0] == 3
+        assert self.p.getRunnableStageFor(4, 8) == None
+        assert self.p.getRunnableStageFor(16, 8)[0] == 0
+
+    def test_runnable_stage_for_resources_priority(self):
+        """make sure that the highest priority stage that fits is handed out"""
+        self.p.setPriorityScheduling()
+        self.p.setStageRuntime("subcommand-5-6", 10000)
+        self.p.initialize()
+        self.p.stages[3].setProcs(4)
+        assert self.p.getRunnableStageFor(2, 2)[0] == 0
+        assert self.p.getRunnableStageFor(2, 4)[0] == 3
+
+    def test_expired_lease(self):
+        """make sure that stages claimed by a client which stopped sending heartbeats are requeued"""
+        self.p.register("PYRO://dead.client")
+        self.p.register("PYRO://live.client")
+        claimed = self.p.getRunnableStagesFor(2, 1, clientURI="PYRO://dead.client")
+        assert [i for (i, s) in claimed] == [0]
+        assert self.p.getRunnableStagesFor(2, 1, clientURI="PYRO://live.client")[0][0] == 3
+        self.p.clientHeartbeats["PYRO://dead.client"] -= self.p.leaseTimeout + 1
+        self.p.expireLeases()
+        assert self.p.clients == ["PYRO://live.client"]
+        assert self.p.stages[0].status == None
+        assert self.p.stages[3].status == "running"
+        assert self.p.getRunnableStageIndex() == 0
+        # the expired client must not come back through its heartbeats
+        assert not self.p.heartbeat("PYRO://dead.client")
+        assert "PYRO://dead.client" not in self.p.clientHeartbeats
+        assert self.p.heartbeat("PYRO://live.client")
+
+    def test_runnable_stage_for_runtime(self):
+        """make sure that stages expected to run longer than the time left are not handed out"""
+        self.p.setStageRuntime("headcommand-1", 3600)
+        self.p.setStageRuntime("headcommand-5", 60)
+        assert self.p.hasRunnableStagesLongerThan(600)
+        claimed = self.p.getRunnableStagesFor(16, 8, maxRuntime=600)
+        assert [i for (i, s) in claimed] == [3]
+        # executors are told how long the stages they claim are expected to take
+        assert claimed[0][1].expectedRuntime == 60
+        assert not self.p.hasRunnableStagesLongerThan(3600)
+        assert self.p.getRunnableStagesFor(16, 8, maxRuntime=3600)[0][0] == 0
+
+    def test_runnable_stage_for_named_resources(self):
+        """make sure that stages only fit if the executor has enough of each resource they declare"""
+        self.p.stages[0].setResource("io", 1)
+        self.p.stages[3].setResource("io", 1)
+        claimed = self.p.getRunnableStagesFor(16, 8, freeResources={"io" : 1}, maxResources={"io" : 1})
+        assert [i for (i, s) in claimed] == [0]
+        self.p.returnStages([0])
+        # resources the executor has no capacity for are not limited
+        assert self.claim() == [0, 3]
+
+    def test_global_resources(self):
+        """make sure that global resources are held from claiming a stage until it is done or returned"""
+        self.p.setGlobalResource("io", 1)
+        self.p.stages[0].setResource("io", 1)
+        self.p.stages[3].setResource("io", 1)
+        assert self.claim() == [0]
+        assert self.p.getFreeGlobalResources() == {"io" : 0}
+        assert self.claim() == []
+        self.p.setStageFinished(0)
+        assert self.claim() == [1, 2, 3]
+        self.p.returnStages([3])
+        assert self.p.getFreeGlobalResources() == {"io" : 1}
+        # finished stages are not checked
+        assert self.p.getStagesExceedingResources({"io" : 0.5}) == [3]
+
+    def claim(self):
+        """claims all runnable stages, returns them by index"""
+        return sorted([i for (i, s) in self.p.getRunnableStagesFor(16, 8)])
+
+    def test_oom_retry(self, tmpdir):
+        """make sure that stages running out of memory are retried with more memory, up to a cap"""
+        self.p.setBackupFileLocation(str(tmpdir))
+        self.p.maxStageMem = 6.0
+        assert self.claim() == [0, 3]
+        for mem in [4.0, 6.0]:
+            self.p.reportStages([0], [], [0], failures={0 : "oom"})
+            assert self.p.stages[0].status == None
+            assert self.p.stages[0].getMem() == mem
+            assert 0 not in self.p.processedStages
+            assert self.claim() == [0]
+        self.p.reportStages([0], [], [0], failures={0 : "oom"})
+        assert self.p.stages[0].status == "failed"
+        assert 1 in self.p.processedStages
+        retries = self.p.getStatsStore().queryRetries("headcommand-1")
+        assert [(r["failure"], r["mem"]) for r in retries] == [("oom", 4.0), ("oom", 6.0)]
+
+    def test_transient_retry(self, tmpdir):
+        """make sure that transient failures are retried after a growing delay, and others are not"""
+        self.p.setBackupFileLocation(str(tmpdir))
+        assert self.claim() == [0, 3]
+        for attempt in range(MAX_RETRIES):
+            self.p.setStageFailed(0, "transient")
+            assert self.claim() == []
+            due, index = self.p.delayedStages[0]
+            assert index == 0
+            assert due - time.time() > RETRY_BACKOFF * 2 ** attempt - 5
+            self.p.delayedStages[0] = (time.time(), 0)
+            self.p.requeueDelayedStages()
+            assert self.p.delayedStages == []
+            assert self.claim() == [0]
+        self.p.setStageFailed(0, "transient")
+        assert self.p.stages[0].status == "failed"
+        self.p.setStageFailed(3, "error")
+        assert self.p.stages[3].status == "failed"
+        assert self.p.delayedStages == []
+
+    def test_timeout_retry(self, tmpdir):
+        """make sure that stages that timed out are retried at once, expected to take longer"""
+        self.p.setBackupFileLocation(str(tmpdir))
+        assert self.claim() == [0, 3]
+        for attempt in range(MAX_RETRIES):
+            runtime = self.p.getExpectedRuntime(0)
+            self.p.setStageFailed(0, "timeout")
+            assert self.p.getExpectedRuntime(0) == runtime * TIMEOUT_RUNTIME_FACTOR
+            assert self.claim() == [0]
+        self.p.setStageFailed(0, "timeout")
+        assert self.p.stages[0].status == "failed"
+        assert self.p.getStatsStore().queryRetries()[0]["failure"] == "timeout"
+
+    def test_speculation(self):
+        """make sure that idle clients get copies of stragglers, and that the first copy to finish wins"""
+        self.p.setSpeculation(2)
+        for c in ["PYRO://slow.client", "PYRO://idle.client"]:
+            self.p.register(c)
+        claimed = self.p.getRunnableStagesFor(16, 8, clientURI="PYRO://slow.client")
+        assert [i for (i, s) in claimed] == [0, 3]
+        assert claimed[0][1].privateOutputs
+        self.p.reportStages([0, 3], [], [], "PYRO://slow.client")
+        assert self.p.getRunnableStagesFor(16, 8, clientURI="PYRO://idle.client") == []
+        self.p.stageStarts[0] -= 1000
+        # stragglers are copied once, and not to the client running them
+        assert self.p.getRunnableStagesFor(16, 8, clientURI="PYRO://slow.client") == []
+        assert [i for (i, s) in self.p.getRunnableStagesFor(16, 8, clientURI="PYRO://idle.client")] == [0]
+        assert self.p.getRunnableStagesFor(16, 8, clientURI="PYRO://idle.client") == []
+        self.p.stageStarts[3] -= 1000
+        assert [i for (i, s) in self.p.getRunnableStagesFor(16, 8, clientURI="PYRO://idle.client")] == [3]
+        self.p.reportStages([0, 3], [0], [3], "PYRO://idle.client")
+        # the copy of 0 won, the failed copy of 3 is ignored
+        assert self.p.stages[0].isFinished()
+        assert self.p.takeCancellations("PYRO://slow.client") == [0]
+        assert self.p.takeCancellations("PYRO://slow.client") == []
+        assert self.p.stages[3].status == "running"
+        assert self.p.speculated == {}
+        self.p.reportStages([], [3], [0], "PYRO://slow.client")
+        assert self.p.stages[3].isFinished()
+        assert self.p.stages[0].isFinished()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+from pydpiper.cpu_affinity import CpuAllocator, parseCpuList
+
+class TestCpuAffinity():
+    def setup_method(self, method):
+        # two NUMA nodes of four cores each
+        self.allocator = CpuAllocator(cpus=range(8), nodes=[[0, 1, 2, 3], [4, 5, 6, 7]])
+
+    def test_parse_cpu_list(self):
+        assert parseCpuList("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+        assert parseCpuList("5") == [5]
+
+    def test_allocate_within_node(self):
+        """make sure that stages get disjoint cpus, preferably from a single NUMA node"""
+        a = self.allocator.allocate(3)
+        b = self.allocator.allocate(2)
+        c = self.allocator.allocate(1)
+        assert a == [0, 1, 2]
+        assert b == [4, 5]
+        # the node with the fewest free cpus that fits is used
+        assert c == [3]
+        assert not set(a) & set(b) and not set(b) & set(c)
+
+    def test_allocate_across_nodes(self):
+        """make sure that stages larger than any node still get cpus, and that cpus can run out"""
+        assert self.allocator.allocate(2) == [0, 1]
+        cpus = self.allocator.allocate(5)
+        assert len(cpus) == 5 and set(cpus) == set([4, 5, 6, 7, 2])
+        assert self.allocator.allocate(2) == None
+        self.allocator.release(cpus)
+        assert self.allocator.allocate(4) == [4, 5, 6, 7]
+
+    def test_restricted_cpus(self):
+        """make sure that only the cpus the executor may use are handed out"""
+        allocator = CpuAllocator(cpus=[2, 3, 4], nodes=[[0, 1, 2, 3], [4, 5, 6, 7]])
+        assert allocator.allocate(2) == [2, 3]
+        assert allocator.allocate(2) == None
+        assert allocator.allocate(1) == [4]
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import os
+import pydpiper.memory_limits as memory_limits
+from pydpiper.memory_limits import delegatedCgroup, effectiveLimitMode
+
+class TestMemoryLimits():
+    def fakeCgroups(self, tmpdir, monkeypatch, path="/job", controllers="cpu memory"):
+        """a cgroup v2 hierarchy in tmpdir, with this process in path"""
+        job = tmpdir.mkdir("cgroup").mkdir("job")
+        job.join("cgroup.controllers").write(controllers)
+        job.join("cgroup.subtree_control").write("")
+        job.join("cgroup.procs").write("123\n456\n")
+        tmpdir.join("proc_cgroup").write("0::%s\n" % path)
+        monkeypatch.setattr(memory_limits, "CGROUP_MOUNT", str(tmpdir.join("cgroup")))
+        monkeypatch.setattr(memory_limits, "PROC_CGROUP", str(tmpdir.join("proc_cgroup")))
+        return job
+
+    def test_delegated_cgroup(self, tmpdir, monkeypatch):
+        """make sure that the executor moves into a leaf before enabling the memory controller"""
+        job = self.fakeCgroups(tmpdir, monkeypatch)
+        assert delegatedCgroup() == str(job)
+        assert job.join("executor", "cgroup.procs").check(file=1)
+        assert job.join("cgroup.subtree_control").read() == "+memory"
+        # processes started later are in the leaf
+        job.join("cgroup.subtree_control").write("memory")
+        tmpdir.join("proc_cgroup").write("0::/job/executor\n")
+        assert delegatedCgroup() == str(job)
+        assert effectiveLimitMode("auto") == "cgroup"
+
+    def test_no_memory_controller(self, tmpdir, monkeypatch):
+        """make sure that executors without a memory controller fall back to RLIMIT_AS"""
+        job = self.fakeCgroups(tmpdir, monkeypatch, controllers="cpu")
+        assert delegatedCgroup() == None
+        assert not job.join("executor").check()
+        assert effectiveLimitMode("cgroup") == "rlimit"
+        assert effectiveLimitMode("none") == "none"
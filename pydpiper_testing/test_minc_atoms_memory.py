@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import sys
+import types
+try:
+    import pyminc.volumes.factory
+except ImportError:
+    # the headers are never read here (see monkeypatchSizes), registration_functions
+    # only needs pyminc to import
+    for name in ["pyminc", "pyminc.volumes", "pyminc.volumes.factory"]:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules["pyminc.volumes.factory"].volumeFromFile = None
+import atoms_and_modules.registration_functions as rf
+import atoms_and_modules.minc_atoms as ma
+from atoms_and_modules.minc_atoms import memForVoxels
+from pydpiper.pipeline import Pipeline
+
+VOXELS = 100 * 200 * 300
+
+class TestMincAtomsMemory():
+    def monkeypatchSizes(self, monkeypatch, sizes=[100, 200, 300], resolution=0.1):
+        monkeypatch.setattr(rf, "getVolumeSizes", lambda inSource: sizes)
+        monkeypatch.setattr(rf, "getFinestResolution", lambda inSource: resolution)
+
+    def test_mincANTS(self, monkeypatch, tmpdir):
+        """make sure that mincANTS accounts for its similarity metrics and the SyN fields"""
+        monkeypatch.chdir(str(tmpdir))
+        self.monkeypatchSizes(monkeypatch)
+        s = ma.mincANTS("s.mnc", "t.mnc", output="s.xfm", logFile="s.log")
+        assert s.getMem() == memForVoxels(VOXELS * (4 * 2 + 12))
+
+    def test_minctracc(self, monkeypatch, tmpdir):
+        """make sure that non-linear minctracc accounts for its deformation grid"""
+        monkeypatch.chdir(str(tmpdir))
+        self.monkeypatchSizes(monkeypatch, resolution=0.2)
+        s = ma.minctracc("s.mnc", "t.mnc", output="s.xfm", logFile="s.log", step=0.4)
+        assert s.getMem() == memForVoxels(VOXELS * (2 + 3 * 0.125))
+        s = ma.minctracc("s.mnc", "t.mnc", output="s.xfm", logFile="s.log", linearparam="lsq12")
+        assert s.getMem() == memForVoxels(VOXELS * 2)
+
+    def test_blur(self, monkeypatch, tmpdir):
+        """make sure that mincblur accounts for the padding by the kernel and for gradients"""
+        monkeypatch.chdir(str(tmpdir))
+        self.monkeypatchSizes(monkeypatch, sizes=[10, 20, 30], resolution=0.1)
+        s = ma.blur("s.mnc", 0.25)
+        assert s.getMem() == memForVoxels(16 * 26 * 36 * 2)
+        s = ma.blur("s.mnc", 0.25, gradient=True)
+        assert s.getMem() == memForVoxels(16 * 26 * 36 * 5)
+
+    def test_mincresample(self, monkeypatch, tmpdir):
+        """make sure that mincresample holds its input and output volumes"""
+        monkeypatch.chdir(str(tmpdir))
+        monkeypatch.setattr(rf, "getVolumeSizes", lambda inSource: {"s.mnc" : [10, 10, 10]}.get(inSource, [20, 20, 20]))
+        s = ma.mincresample("s.mnc", "t.mnc", likeFile="l.mnc", output="r.mnc")
+        assert s.getMem() == memForVoxels(10 ** 3 + 20 ** 3)
+
+    def test_mincAverage(self, monkeypatch, tmpdir):
+        """make sure that mincaverage buffers its inputs up to its buffer size"""
+        monkeypatch.chdir(str(tmpdir))
+        self.monkeypatchSizes(monkeypatch, sizes=[10, 10, 10])
+        s = ma.mincAverage(["a.mnc", "b.mnc"], "avg.mnc")
+        assert s.getMem() == memForVoxels(1000, 16) + 2 * 1000 * 4.0 / (1024 ** 3)
+        self.monkeypatchSizes(monkeypatch)
+        s = ma.mincAverage(["%i.mnc" % n for n in range(20)], "avg.mnc")
+        assert s.getMem() == memForVoxels(VOXELS, 16) + s.maxBufferKb * 1024.0 / (1024 ** 3)
+
+    def test_capped_at_executor_mem(self, monkeypatch, tmpdir):
+        """make sure that estimates above the memory of an executor are capped, so the stages can run"""
+        monkeypatch.chdir(str(tmpdir))
+        self.monkeypatchSizes(monkeypatch, sizes=[1000, 1000, 1000])
+        p = Pipeline()
+        p.addStage(ma.mincANTS("s.mnc", "t.mnc", output="s.xfm", logFile="s.log"))
+        assert p.stages[0].getMem() > 16
+        p.setMaxStageMem(16.0)
+        assert p.stages[0].getMem() == 16.0
+
+    def test_reestimate(self, monkeypatch, tmpdir):
+        """make sure that stages repeat their estimates from file names only"""
+        monkeypatch.chdir(str(tmpdir))
+        self.monkeypatchSizes(monkeypatch, sizes=[10, 20, 30], resolution=0.1)
+        s = ma.blur("s.mnc", 0.25, gradient=True)
+        assert s.memEstimate == ("s.mnc", 0.25, True)
+        self.monkeypatchSizes(monkeypatch, sizes=[20, 20, 30], resolution=0.1)
+        s.reestimateMem()
+        assert s.getMem() == memForVoxels(26 * 26 * 36 * 5)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+from pydpiper.pipeline import *
+from pydpiper.output_cache import StageOutputCache
+
+def copyStage(directory, inputFile):
+    s = CmdStage(["cp", InputFile(inputFile), OutputFile(str(directory.join("out.mnc")))])
+    s.setLogFile(str(directory.join("cp.log")))
+    return s
+
+def blurStage(directory, inputFile, script):
+    """like mincblur, given the base of its output, to which it adds a suffix"""
+    s = CmdStage([script, InputFile(inputFile), str(directory.join("in"))])
+    s.outputFiles = [str(directory.join("in_blur.mnc"))]
+    s.setLogFile(str(directory.join("blur.log")))
+    return s
+
+class TestOutputCache():
+    def makeRun(self, tmpdir, name, contents="x" * 100):
+        directory = tmpdir.mkdir(name)
+        directory.join("in.mnc").write(contents)
+        return directory, copyStage(directory, str(directory.join("in.mnc")))
+
+    def test_key(self, tmpdir):
+        """make sure that keys depend on the input contents, but not on the output directories"""
+        cache = StageOutputCache(str(tmpdir.join("cache")))
+        a = self.makeRun(tmpdir, "a")[1]
+        b = self.makeRun(tmpdir, "b")[1]
+        c = self.makeRun(tmpdir, "c", contents="y" * 100)[1]
+        assert cache.key(a) == cache.key(b)
+        assert cache.key(a) != cache.key(c)
+
+    def test_restore(self, tmpdir):
+        """make sure that a stage of another run with the same inputs is restored from the cache"""
+        cache = StageOutputCache(str(tmpdir.join("cache")))
+        a, stageA = self.makeRun(tmpdir, "a")
+        b, stageB = self.makeRun(tmpdir, "b")
+        stageA.outputCache = cache
+        assert stageA.execStage() == 0
+        assert a.join("out.mnc").read() == "x" * 100
+        assert not stageA.stats.get("cached")
+        assert not [f for f in os.listdir(str(a)) if f.startswith(".pydpiper")]
+        stageB.outputCache = cache
+        assert stageB.execStage() == 0
+        assert stageB.stats["cached"] == 1
+        # the outputs are copies, which can be rewritten without changing the cache
+        assert os.stat(str(a.join("out.mnc"))).st_ino != os.stat(str(b.join("out.mnc"))).st_ino
+        b.join("out.mnc").write("y" * 100)
+        a.join("out.mnc").write("z" * 100)
+        stageC = self.makeRun(tmpdir, "c")[1]
+        stageC.outputCache = cache
+        assert stageC.execStage() == 0
+        assert stageC.stats["cached"] == 1
+        assert tmpdir.join("c", "out.mnc").read() == "x" * 100
+
+    def test_eviction(self, tmpdir):
+        """make sure that the least recently used entries are evicted once the cache is too large"""
+        cache = StageOutputCache(str(tmpdir.join("cache")), maxBytes=250)
+        stages = []
+        for (n, name) in enumerate(["a", "b", "c"]):
+            stage = self.makeRun(tmpdir, name, contents=name * 100)[1]
+            stage.outputCache = cache
+            assert stage.execStage() == 0
+            os.utime(cache.entry(cache.key(stage)), (n, n))
+            stages.append(stage)
+        cache.evict()
+        assert not os.path.isdir(cache.entry(cache.key(stages[0])))
+        assert os.path.isdir(cache.entry(cache.key(stages[1])))
+        assert sum([size for (used, size, path) in cache.entries()]) <= 250
+
+    def test_output_prefix(self, tmpdir):
+        """make sure that stages given the base of their outputs rather than the outputs are cached"""
+        script = tmpdir.join("blur.sh")
+        script.write("#!/bin/sh\ncp $1 $2_blur.mnc\n")
+        script.chmod(0755)
+        cache = StageOutputCache(str(tmpdir.join("cache")))
+        stages = []
+        for name in ["a", "b"]:
+            directory = tmpdir.mkdir(name)
+            directory.join("in.mnc").write("x" * 100)
+            stage = blurStage(directory, str(directory.join("in.mnc")), str(script))
+            stage.outputCache = cache
+            assert stage.hasOutputsInCommand()
+            assert stage.execStage() == 0
+            assert directory.join("in_blur.mnc").read() == "x" * 100
+            stages.append(stage)
+        assert not stages[0].stats.get("cached")
+        assert stages[1].stats["cached"] == 1
+        assert not [f for f in os.listdir(str(tmpdir.join("a"))) if f.startswith(".pydpiper")]
+
+    def test_periodic_eviction(self, tmpdir):
+        """make sure that storing looks at the size of the cache only once in a while"""
+        cache = StageOutputCache(str(tmpdir.join("cache")), maxBytes=150)
+        stages = []
+        for name in ["a", "b"]:
+            stage = self.makeRun(tmpdir, name, contents=name * 100)[1]
+            stage.outputCache = cache
+            assert stage.execStage() == 0
+            stages.append(stage)
+        # the second store came too soon after the first one to evict
+        assert sum([size for (used, size, path) in cache.entries()]) == 200
+        marker = str(tmpdir.join("cache", ".last-eviction"))
+        os.utime(marker, (0, 0))
+        cache.evictPeriodically()
+        assert sum([size for (used, size, path) in cache.entries()]) <= 150
+        assert os.path.getmtime(marker) > 0
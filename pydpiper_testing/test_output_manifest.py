@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import os
+from pydpiper.pipeline import *
+from pydpiper.output_manifest import OutputManifest, describeOutputs, isStale
+from pydpiper.output_cache import fileDigest
+
+class TestOutputManifest():
+    def setup_method(self, method):
+        self.p = Pipeline()
+
+    def addStages(self, tmpdir):
+        """a -> b -> c, copied by two stages"""
+        tmpdir.join("a.mnc").write("x" * 100)
+        self.files = [str(tmpdir.join(f)) for f in ["a.mnc", "b.mnc", "c.mnc"]]
+        for (inputFile, outputFile) in [(self.files[0], self.files[1]), (self.files[1], self.files[2])]:
+            s = CmdStage(["cp", InputFile(inputFile), OutputFile(outputFile)])
+            s.setLogFile(outputFile + ".log")
+            self.p.addStage(s)
+        self.p.setBackupFileLocation(str(tmpdir))
+        self.p.initialize()
+
+    def test_exec_stage_outputs(self, tmpdir):
+        """make sure that a successful stage describes its outputs, with checksums if asked for"""
+        self.addStages(tmpdir)
+        s = self.p.stages[0]
+        s.outputChecksums = True
+        assert s.execStage() == 0
+        ((path, size, mtime, checksum),) = s.stats["outputs"]
+        assert path == self.files[1]
+        assert size == 100
+        assert mtime == os.path.getmtime(self.files[1])
+        assert checksum != None
+
+    def test_reported_outputs_are_recorded(self, tmpdir):
+        """make sure that the outputs of stages reported as finished end up in the manifest"""
+        self.addStages(tmpdir)
+        self.p.getRunnableStagesFor(2, 1)
+        outputs = [(self.files[1], 100, 1.0, None)]
+        self.p.reportStages([0], [0], [], stats={0 : {"returncode" : 0, "outputs" : outputs}})
+        self.p.getOutputManifest().close()
+        assert (OutputManifest(self.p.backupFileLocation).entries()
+                == {self.files[1] : (100, 1.0, None, self.p.stages[0].getHash())})
+
+    def test_skip_from_manifest(self, tmpdir):
+        """make sure that restarts trust the manifest rather than the files, unless verifying"""
+        self.addStages(tmpdir)
+        # recorded, but gone; the other output exists, but isn't recorded (e.g. truncated)
+        manifest = self.p.getOutputManifest()
+        manifest.record(0, [(self.files[1], 100, 1.0, None)])
+        manifest.commit()
+        tmpdir.join("c.mnc").write("x")
+        skip_completed_stages(self.p, verify=False)
+        assert self.p.stages[0].isFinished()
+        assert not self.p.stages[1].isFinished()
+        p = Pipeline()
+        self.p = p
+        self.addStages(tmpdir)
+        skip_completed_stages(p)
+        assert not p.stages[0].isFinished()
+
+    def test_skip_without_manifest(self, tmpdir):
+        """make sure that without a manifest, existing outputs count and are recorded"""
+        self.addStages(tmpdir)
+        tmpdir.join("b.mnc").write("x" * 100)
+        skip_completed_stages(self.p)
+        assert self.p.stages[0].isFinished()
+        assert not self.p.stages[1].isFinished()
+        assert self.p.getOutputManifest().entries().keys() == [self.files[1]]
+
+    def writeAll(self, tmpdir):
+        """all files exist, each one newer than the one it was made from"""
+        for (n, f) in enumerate(self.files):
+            tmpdir.join(os.path.basename(f)).write("x" * 100)
+            os.utime(f, (1000 + n, 1000 + n))
+
+    def test_stale_mtime(self, tmpdir):
+        """make sure that stages with inputs newer than their outputs are rerun with their descendants"""
+        self.addStages(tmpdir)
+        self.writeAll(tmpdir)
+        os.utime(self.files[0], (2000, 2000))
+        skip_completed_stages(self.p, staleness="mtime")
+        assert not self.p.stages[0].isFinished()
+        assert self.p.invalidated == set([0, 1])
+        ((index, stage),) = self.p.getRunnableStagesFor(2, 1)
+        assert index == 0 and stage.rerun
+
+    def test_stale_digest(self, tmpdir):
+        """make sure that with digests, only inputs with different contents make stages stale"""
+        self.addStages(tmpdir)
+        self.writeAll(tmpdir)
+        manifest = self.p.getOutputManifest()
+        manifest.recordInputs(repr(self.p.stages[1]), [(self.files[1], fileDigest(self.files[1]))])
+        manifest.commit()
+        os.utime(self.files[1], (2000, 2000))
+        digests = manifest.inputDigests()
+        assert not isStale(self.p.stages[1], "digest", digests[repr(self.p.stages[1])])
+        assert isStale(self.p.stages[1], "mtime")
+        tmpdir.join("b.mnc").write("y" * 100)
+        assert isStale(self.p.stages[1], "digest", digests[repr(self.p.stages[1])])
+
+    def test_invalidate_finished(self, tmpdir):
+        """make sure that stages finished before a restart are reset if an input changed"""
+        self.addStages(tmpdir)
+        self.writeAll(tmpdir)
+        for i in [0, 1]:
+            self.p.getRunnableStageIndex()
+            self.p.setStageFinished(i, save_state=False)
+        os.utime(self.files[1], (2000, 2000))
+        skip_completed_stages(self.p, staleness="mtime")
+        assert self.p.stages[0].isFinished()
+        assert not self.p.stages[1].isFinished()
+        assert self.p.processedStages == [0]
+        assert [i for (i, s) in self.p.getRunnableStagesFor(2, 1)] == [1]
+
+    def test_diff_plan(self, tmpdir):
+        """make sure that stages which differ from those that wrote their outputs are rerun with their descendants"""
+        self.addStages(tmpdir)
+        self.writeAll(tmpdir)
+        manifest = self.p.getOutputManifest()
+        for (i, s) in enumerate(self.p.stages):
+            manifest.record(i, describeOutputs(s.outputFiles), s.getHash())
+        manifest.commit()
+        p = Pipeline()
+        self.p = p
+        self.p.addStage(CmdStage(["cp", "-p", InputFile(self.files[0]), OutputFile(self.files[1])]))
+        self.p.addStage(CmdStage(["cp", InputFile(self.files[1]), OutputFile(self.files[2])]))
+        self.p.setBackupFileLocation(str(tmpdir))
+        self.p.initialize()
+        skip_completed_stages(p, diffPlan=True)
+        assert p.invalidated == set([0, 1])
+        assert [i for (i, s) in p.getRunnableStagesFor(2, 1)] == [0]
+        p = Pipeline()
+        self.p = p
+        self.addStages(tmpdir)
+        skip_completed_stages(p, diffPlan=True)
+        assert p.invalidated == set()
+        assert p.stages[1].isFinished()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.pipeline_executor import pipelineExecutor, clientExecutor, ChildProcess, MIN_STAGE_TIMEOUT, parseWalltime, parseResources, classifyFailure, runStage, sendHeartbeats, WALLTIME_MARGIN
+import pydpiper.pipeline_executor as pe
+from pydpiper.cpu_affinity import availableCpus
+import pytest
+import time
+import sys
+import os
+import signal
+
+def generateFile(i):
+    return("filename_" + str(i) + ".mnc")
+
+class ExecutorOptions():
+    def __init__(self, urifile):
+        self.queue = None
+        self.sge_queue_opts = None
+        self.mem = 8.0
+        self.proc = 4
+        self.use_ns = False
+        self.urifile = urifile
+        self.prefetch = 1
+        self.time = "2:00:00"
+        self.mem_limit = "rlimit"
+        self.cpu_affinity = False
+        self.resources = []
+        self.backfill = False
+        self.stage_timeout_factor = 0
+        self.max_stage_time = None
+
+class TestPipelineExecutor():
+    def setup_method(self, method):
+        self.p = Pipeline()
+        self.p.addStage(CmdStage(["shortcommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        self.p.addStage(CmdStage(["longcommand", InputFile(generateFile(2)), OutputFile(generateFile(3))]))
+        self.p.setStageRuntime("shortcommand", 60)
+        self.p.setStageRuntime("longcommand", 3600)
+        self.p.initialize()
+
+    def executor(self, tmpdir, monkeypatch):
+        # the executor writes its log file into the current directory
+        monkeypatch.chdir(tmpdir)
+        e = pipelineExecutor(ExecutorOptions(str(tmpdir.join("uri"))))
+        e.deadline = time.time() + parseWalltime(e.time)
+        return e
+
+    def test_parse_walltime(self):
+        """make sure that all accepted wall time formats are converted to seconds"""
+        assert parseWalltime("45") == 45
+        assert parseWalltime("10:00") == 600
+        assert parseWalltime("2:00:00") == 7200
+        assert parseWalltime("2:00:00:00") == 2*86400
+        assert parseWalltime("1:01:01:01") == 86400 + 3600 + 60 + 1
+
+    def test_parse_walltime_malformed(self):
+        """make sure that malformed wall times are rejected rather than misread"""
+        for walltime in ["", "2h", "1:2:3:4:5", "1::00", "-1:00", "1.5:00"]:
+            with pytest.raises(ValueError):
+                parseWalltime(walltime)
+
+    def test_drained_when_stage_needs_more_time(self, tmpdir, monkeypatch):
+        """make sure that an idle executor drains only for stages a new executor could run"""
+        e = self.executor(tmpdir, monkeypatch)
+        assert not e.isDrained(self.p)
+        # less time left than the long stage needs
+        e.deadline = time.time() + WALLTIME_MARGIN + 600
+        assert e.isDrained(self.p)
+        # ... but no executor could run it either, so waiting for another one doesn't help
+        self.p.setMaxStageRuntime(300)
+        assert not e.isDrained(self.p)
+        assert [i for (i, s) in self.p.getRunnableStagesFor(8, 4, maxRuntime=e.remainingTime())] == [0, 1]
+
+    def test_not_drained_while_busy(self, tmpdir, monkeypatch):
+        """make sure that executors with claimed stages or without time left behave as expected"""
+        e = self.executor(tmpdir, monkeypatch)
+        e.deadline = time.time() + WALLTIME_MARGIN + 600
+        e.claimedStages = self.p.getRunnableStagesFor(8, 4, maxRuntime=e.remainingTime())
+        assert [i for (i, s) in e.claimedStages] == [0]
+        assert not e.isDrained(self.p)
+        e.claimedStages = []
+        e.deadline = time.time()
+        assert e.isDrained(self.p)
+
+    def test_can_run_with_resources(self, tmpdir, monkeypatch):
+        """make sure that the executor's capacities for named resources are respected"""
+        e = self.executor(tmpdir, monkeypatch)
+        e.resources = parseResources(["io=2", "scratch_gb=100"])
+        assert e.resources == {"io" : 2.0, "scratch_gb" : 100.0}
+        assert e.canRun(1, 1, 0, 0, {"io" : 1, "scratch_gb" : 50}, {"io" : 1, "scratch_gb" : 50})
+        assert not e.canRun(1, 1, 0, 0, {"io" : 1}, {"io" : 2})
+        assert not e.canRun(1, 1, 0, 0, {"scratch_gb" : 101})
+        assert e.canRun(1, 1, 0, 0, {"gpu" : 1})
+        with pytest.raises(ValueError):
+            parseResources(["io"])
+
+    def test_backfill_reservation(self, tmpdir, monkeypatch):
+        """make sure that a stage that doesn't fit gets a reservation and only harmless stages are backfilled"""
+        e = self.executor(tmpdir, monkeypatch)
+        for (procs, runtime) in [(2, 100), (1, 1000)]:
+            child = ChildProcess(len(e.runningChildren), 1.0, procs, None)
+            child.expectedEnd = time.time() + runtime
+            e.runningChildren.append(child)
+            e.runningMem += 1.0
+            e.runningProcs += procs
+        big = CmdStage(["bigcommand"])
+        big.setProcs(3)
+        reservation = e.reserve(big)
+        assert 90 < reservation.time - time.time() <= 100
+        assert reservation.procs == 1
+        short = CmdStage(["shortcommand"])
+        short.expectedRuntime = 50
+        assert reservation.admits(short)
+        long = CmdStage(["longcommand"])
+        long.expectedRuntime = 500
+        assert not reservation.admits(long)
+        long.setMem(0.5)
+        big.setProcs(2)
+        # if the reserved stage leaves room, long stages can still be backfilled, but only once
+        assert reservation.admits(long)
+        assert reservation.procs == 2
+        assert not reservation.admits(long)
+
+    def test_stage_timeout(self, tmpdir, monkeypatch):
+        """make sure that the watchdog timeout follows the expected runtime within its bounds"""
+        e = self.executor(tmpdir, monkeypatch)
+        s = CmdStage(["longcommand"])
+        s.expectedRuntime = 3600
+        assert e.stageTimeout(s) == None
+        e.stageTimeoutFactor = 3
+        assert e.stageTimeout(s) == 3 * 3600
+        s.expectedRuntime = 10
+        assert e.stageTimeout(s) == MIN_STAGE_TIMEOUT
+        e.maxStageTime = 300
+        assert e.stageTimeout(s) == 300
+        e.stageTimeoutFactor = 0
+        assert e.stageTimeout(s) == 300
+
+    def test_hung_stage_killed(self, tmpdir, monkeypatch):
+        """make sure that a stage running past its timeout is killed with all its processes"""
+        monkeypatch.setattr("pydpiper.pipeline.KILL_GRACE", 0.1)
+        pidFile = tmpdir.join("child.pid")
+        hang = "'import subprocess, time; open(\"%s\", \"w\").write(str(subprocess.Popen([\"sleep\", \"60\"]).pid)); time.sleep(60)'" % str(pidFile)
+        s = CmdStage([sys.executable, "-c", hang, OutputFile(str(tmpdir.join("never.mnc")))])
+        s.setLogFile(str(tmpdir.join("hang.log")))
+        start = time.time()
+        (r, stats, failure) = runStage(0, s, timeout=1)
+        assert time.time() - start < 30
+        assert r == -signal.SIGTERM
+        assert stats["timed_out"] == 1
+        assert failure == "timeout"
+        time.sleep(0.5)
+        # the killed child is gone, or a zombie if nothing has reaped it yet
+        stat = "/proc/%s/stat" % pidFile.read()
+        assert not os.path.exists(stat) or open(stat).read().split()[2] == "Z"
+
+    def test_stages_exceeding_walltime(self):
+        """make sure that stages no executor could finish are found before the pipeline starts"""
+        assert self.p.getStagesExceedingWalltime() == []
+        self.p.setMaxStageRuntime(parseWalltime("1:00:00") - 2 * WALLTIME_MARGIN)
+        assert self.p.getStagesExceedingWalltime() == [1]
+        # a guess by stage type only is no reason to refuse to start
+        assert self.p.getStagesExceedingWalltime(learnedOnly=True) == []
+        self.p.learnedRuntimes[1] = 3600
+        assert self.p.getStagesExceedingWalltime(learnedOnly=True) == [1]
+        self.p.setStageFinished(1, save_state=False)
+        assert self.p.getStagesExceedingWalltime() == []
+
+    def test_classify_failure(self, tmpdir):
+        """make sure that failures are told apart by exit status and stage log"""
+        log = tmpdir.join("stage.log")
+        log.write("Running on: node1\nterminate called after throwing an instance of 'std::bad_alloc'\n")
+        assert classifyFailure(-9) == "oom"
+        assert classifyFailure(134, str(log)) == "oom"
+        assert classifyFailure(-15) == "transient"
+        assert classifyFailure(None) == "transient"
+        log.write("Running on: node1\nerror reading input: Stale file handle\n")
+        assert classifyFailure(1, str(log)) == "transient"
+        log.write("Running on: node1\nmincresample: No space left on device\n")
+        assert classifyFailure(1, str(log)) == "transient"
+        log.write("Running on: node1\nmincANTS: unknown option\n")
+        assert classifyFailure(1, str(log)) == "error"
+        assert classifyFailure(1) == "error"
+
+    def test_memory_limit(self, tmpdir, monkeypatch):
+        """make sure that a stage using more memory than it declares fails with a distinct failure"""
+        e = self.executor(tmpdir, monkeypatch)
+        allocate = "'x = bytearray(512 * 1024 * 1024)'"
+        s = CmdStage([sys.executable, "-c", allocate, OutputFile(str(tmpdir.join("never.mnc")))])
+        s.setLogFile(str(tmpdir.join("limited.log")))
+        s.setMem(0.25)
+        (r, stats, failure) = runStage(0, s, e.memLimit)
+        assert r != 0
+        assert stats["mem_limit"] == 0.25
+        assert failure == "memlimit"
+        # the same stage succeeds without a limit
+        (r, stats, failure) = runStage(0, s)
+        assert r == 0
+        assert failure == None
+
+    def test_thread_count_and_affinity(self, tmpdir):
+        """make sure that a stage is told its number of processors and runs on the cpus it is given"""
+        output = tmpdir.join("threads.txt")
+        report = "'import os; open(\"%s\", \"w\").write(os.environ[\"OMP_NUM_THREADS\"] + \" \" + os.environ[\"ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS\"] + \" \" + open(\"/proc/self/status\").read().split(\"Cpus_allowed_list:\")[1].split()[0])'" % str(output)
+        s = CmdStage([sys.executable, "-c", report, OutputFile(str(output))])
+        s.setLogFile(str(tmpdir.join("threads.log")))
+        s.setProcs(3)
+        cpu = availableCpus()[0]
+        (r, stats, failure) = runStage(0, s, cpus=[cpu])
+        assert r == 0
+        assert output.read() == "3 3 %d" % cpu
+
+    def test_lease_expired(self, tmpdir, monkeypatch):
+        """make sure that an executor whose lease expired kills its stages without reporting them"""
+        class RefusingServer():
+            def heartbeat(self, clientURI):
+                return False
+        monkeypatch.setattr(pe.Pyro.core, "getProxyForURI", lambda uri: RefusingServer())
+        client = clientExecutor()
+        sendHeartbeats("PYRO://server", "PYRO://client", client)
+        assert client.leaseExpired and not client.continueRunning
+        e = self.executor(tmpdir, monkeypatch)
+        e.claimedStages = self.p.getRunnableStagesFor(8, 4)
+        child = ChildProcess(0, 1.0, 1, None)
+        child.cancelFile = str(tmpdir.join("cancel-0"))
+        e.runningChildren = [child]
+        e.startedStages = [0]
+        e.dropStages()
+        assert e.claimedStages == [] and e.startedStages == []
+        assert tmpdir.join("cancel-0").check(file=1)
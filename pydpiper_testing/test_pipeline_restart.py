@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+
+def generateFile(i):
+    return("filename_" + str(i) + ".mnc")
+
+def simplePipeline(backupDir):
+    p = Pipeline()
+    p.setBackupFileLocation(backupDir)
+    p.addStage(CmdStage(["somecommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+    for i in range(2,20):
+        p.addStage(CmdStage(["somecommand", InputFile(generateFile(i-1)), OutputFile(generateFile(i))]))
+    p.initialize()
+    return p
+
+class TestPipelineRestart():
+    def setupPipeline(self, tmpdir):
+        self.p = simplePipeline(str(tmpdir))
+        self.p.selfPickle()
+
+    def test_journal_replay(self, tmpdir):
+        """make sure that stages finished after the last snapshot are restored from the journal"""
+        self.setupPipeline(tmpdir)
+        for i in range(5):
+            s = self.p.getRunnableStageIndex()
+            self.p.setStageStarted(s)
+            self.p.setStageFinished(s)
+        self.p.getJournal().close()
+        r = Pipeline()
+        r.setBackupFileLocation(str(tmpdir))
+        r.restart()
+        assert [i for i in range(len(r.stages)) if r.stages[i].isFinished()] == range(5)
+        assert r.getProcessedStageCount() == 5
+        r.initialize()
+        assert r.getRunnableStageIndex() == 5
+
+    def test_snapshot_compacts_journal(self, tmpdir):
+        """make sure that the journal is emptied once its entries are part of a snapshot"""
+        self.setupPipeline(tmpdir)
+        self.p.snapshotInterval = 0 # compact once the journal holds as many entries as there are stages
+        for i in range(9):
+            s = self.p.getRunnableStageIndex()
+            self.p.setStageStarted(s)
+            self.p.setStageFinished(s)
+        assert self.p.getJournal().entries == 18
+        s = self.p.getRunnableStageIndex()
+        self.p.setStageStarted(s)
+        assert self.p.getJournal().entries == 0
+        assert self.p.getJournal().replay() == []
+        r = Pipeline()
+        r.setBackupFileLocation(str(tmpdir))
+        r.restart()
+        assert r.getProcessedStageCount() == 9
+
+    def test_journal_sync_when_idle(self, tmpdir):
+        """make sure that buffered journal entries reach the disk once the sync interval has passed,
+           even if no further stage changes state"""
+        self.setupPipeline(tmpdir)
+        s = self.p.getRunnableStageIndex()
+        self.p.setStageFinished(s)
+        journal = self.p.getJournal()
+        assert journal.unsynced == 1
+        journal.syncIfDue()
+        assert journal.unsynced == 1
+        journal.lastSync -= journal.syncInterval
+        journal.syncIfDue()
+        assert journal.unsynced == 0
+        assert len(journal.replay()) == 1
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import sys
+from pydpiper.pipeline import *
+from pydpiper.application import AbstractApplication
+from pydpiper.file_handling import makedirsIgnoreExisting
+
+class CountingApplication(AbstractApplication):
+    runs = 0
+    def setup_appName(self):
+        return "counting"
+    def run(self):
+        CountingApplication.runs += 1
+        makedirsIgnoreExisting(os.path.join(self.outputDir, "out"))
+        for inputFile in self.args:
+            outputFile = os.path.join(self.outputDir, "out", os.path.basename(inputFile))
+            self.pipeline.addStage(CmdStage(["cp", InputFile(inputFile), OutputFile(outputFile)]))
+
+class ListApplication(CountingApplication):
+    """copies the files listed in the file given on the command line"""
+    def run(self):
+        CountingApplication.runs += 1
+        makedirsIgnoreExisting(os.path.join(self.outputDir, "out"))
+        for inputFile in open(self.args[0]).read().split():
+            outputFile = os.path.join(self.outputDir, "out", os.path.basename(inputFile))
+            self.pipeline.addStage(CmdStage(["cp", InputFile(inputFile), OutputFile(outputFile)]))
+
+# memory of SizedStage, by input file
+sizes = {}
+
+class SizedStage(CmdStage):
+    def __init__(self, inputFile, outputFile):
+        CmdStage.__init__(self, ["cp", InputFile(inputFile), OutputFile(outputFile)])
+        self.estimateMem(inputFile)
+    def estimateMem(self, inputFile):
+        self.memEstimate = (inputFile,)
+        self.setMem(sizes[inputFile])
+
+class TestPlanCache():
+    def setup_method(self, method):
+        CountingApplication.runs = 0
+
+    def launch(self, monkeypatch, *args, **kwargs):
+        monkeypatch.setattr(sys, "argv", ["counting.py", "--no-execute"] + list(args))
+        application = kwargs.get("application", CountingApplication)()
+        application.start()
+        return application
+
+    def test_plan_cache(self, tmpdir, monkeypatch):
+        """make sure that identical relaunches load the pipeline, and that changed inputs rebuild it"""
+        monkeypatch.chdir(str(tmpdir))
+        tmpdir.join("a.mnc").write("x")
+        first = self.launch(monkeypatch, str(tmpdir.join("a.mnc")))
+        assert CountingApplication.runs == 1
+        tmpdir.join("out").remove()
+        second = self.launch(monkeypatch, str(tmpdir.join("a.mnc")))
+        assert CountingApplication.runs == 1
+        assert [s.getHash() for s in second.pipeline.stages] == [s.getHash() for s in first.pipeline.stages]
+        assert tmpdir.join("out").check(dir=1)
+        os.utime(str(tmpdir.join("a.mnc")), (1000, 1000))
+        self.launch(monkeypatch, str(tmpdir.join("a.mnc")))
+        assert CountingApplication.runs == 2
+        self.launch(monkeypatch, "--no-plan-cache", str(tmpdir.join("a.mnc")))
+        assert CountingApplication.runs == 3
+        assert len(tmpdir.join("pydpiper-backups").listdir("plan-*.pkl")) == 1
+
+    def test_plan_inputs(self, tmpdir, monkeypatch):
+        """make sure that changes to inputs not named on the command line rebuild the pipeline"""
+        monkeypatch.chdir(str(tmpdir))
+        tmpdir.join("a.mnc").write("x")
+        tmpdir.join("inputs.csv").write(str(tmpdir.join("a.mnc")) + "\n")
+        self.launch(monkeypatch, str(tmpdir.join("inputs.csv")), application=ListApplication)
+        # touched, but with the same contents
+        os.utime(str(tmpdir.join("a.mnc")), (1000, 1000))
+        self.launch(monkeypatch, str(tmpdir.join("inputs.csv")), application=ListApplication)
+        assert CountingApplication.runs == 1
+        tmpdir.join("a.mnc").write("y")
+        self.launch(monkeypatch, str(tmpdir.join("inputs.csv")), application=ListApplication)
+        assert CountingApplication.runs == 2
+
+    def test_reestimate_mem(self, tmpdir):
+        """make sure that stages of a loaded plan estimate their memory anew"""
+        tmpdir.join("a.mnc").write("x")
+        a = str(tmpdir.join("a.mnc"))
+        sizes[a] = 1.0
+        p = Pipeline()
+        p.addStage(SizedStage(a, str(tmpdir.join("b.mnc"))))
+        p.savePlan(str(tmpdir.join("plan.pkl")))
+        sizes[a] = 3.0
+        p = Pipeline()
+        assert p.loadPlan(str(tmpdir.join("plan.pkl")))
+        assert p.stages[0].getMem() == 3.0
+        # inputs that appeared since the plan was saved make it invalid
+        p.addStage(SizedStage(a, str(tmpdir.join("b.mnc"))))
+        p.stages[0].inputFiles.append(str(tmpdir.join("c.mnc")))
+        p.savePlan(str(tmpdir.join("plan.pkl")))
+        tmpdir.join("c.mnc").write("z")
+        assert not Pipeline().loadPlan(str(tmpdir.join("plan.pkl")))
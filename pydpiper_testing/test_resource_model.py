@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.resource_model import StageResourceModel
+from pydpiper.stage_stats import StageStatsStore
+
+def sample(stageType, maxrss, walltime, cpu=1.0, inputBytes=1000, returncode=0, outputBytes=500):
+    return {"type" : stageType, "maxrss" : maxrss, "walltime" : walltime, "utime" : cpu * walltime,
+            "stime" : 0.0, "input_bytes" : inputBytes, "returncode" : returncode, "output_bytes" : outputBytes}
+
+class TestResourceModel():
+    def setup_method(self, method):
+        self.samples = [sample("mincANTS", 4 * 1024 * 1024, 3000, cpu=3.8),
+                        sample("mincANTS", 6 * 1024 * 1024, 4000, cpu=3.9),
+                        sample("mincANTS", 5 * 1024 * 1024, 3600, cpu=4.0),
+                        sample("xfmconcat", 1024, 1),
+                        sample("xfmconcat", 2048, 2, returncode=1)]
+
+    def test_estimate(self):
+        """make sure that estimates are the median of past runs, with the safety margin"""
+        model = StageResourceModel(self.samples, margin=1.2)
+        mem, procs, runtime = model.estimate("mincANTS")
+        assert abs(mem - 5 * 1.2) < 1e-6
+        assert procs == 4
+        assert abs(runtime - 3600 * 1.2) < 1e-6
+
+    def test_scaled_by_input_size(self):
+        """make sure that estimates grow with the input size, but don't shrink"""
+        model = StageResourceModel(self.samples, margin=1.0)
+        assert abs(model.estimate("mincANTS", 2000)[0] - 10) < 1e-6
+        assert abs(model.estimate("mincANTS", 500)[0] - 5) < 1e-6
+
+    def test_output_bytes(self):
+        """make sure that output sizes are predicted in proportion to the input sizes"""
+        model = StageResourceModel(self.samples, margin=1.0)
+        assert model.estimateOutputBytes("mincANTS", 4000) == 2000
+        assert model.estimateOutputBytes("mincANTS") == 500
+        assert model.estimateOutputBytes("xfmconcat") == None
+
+    def test_not_enough_history(self):
+        """make sure that stage types with too few successful runs are not estimated"""
+        model = StageResourceModel(self.samples)
+        assert model.estimate("xfmconcat") == None
+        assert model.estimate("mincblur") == None
+
+    def test_pipeline_estimates(self, tmpdir):
+        """make sure that the pipeline applies estimates from the stats of its backup directory"""
+        p = Pipeline()
+        p.setBackupFileLocation(str(tmpdir))
+        p.addStage(CmdStage(["mincANTS", InputFile("a.mnc"), OutputFile("a.xfm")]))
+        p.addStage(CmdStage(["mincblur", InputFile("a.mnc"), OutputFile("a_blur.mnc")]))
+        store = p.getStatsStore()
+        for s in self.samples:
+            store.record(0, s["type"], s["type"], s)
+        store.commit()
+        p.estimateResources(maxMem=6.0, maxProcs=8)
+        assert p.stages[0].getMem() == 6.0
+        assert p.stages[0].getProcs() == 4
+        assert p.getExpectedRuntime(0) > 3600
+        assert p.stages[1].getMem() == 2.0
+        assert p.getExpectedRuntime(1) == DEFAULT_STAGE_RUNTIMES["mincblur"]
+        p.setStageRuntime("mincANTS", 100)
+        assert p.getExpectedRuntime(0) == 100
+
+    def test_disk_space(self, tmpdir, monkeypatch):
+        """make sure that stages are only handed out while their predicted output fits on the disk"""
+        monkeypatch.setattr("pydpiper.pipeline.freeDiskSpace", lambda directory: (1, 2500))
+        p = Pipeline()
+        for (inputFile, outputFile) in [("a.mnc", "b.mnc"), ("c.mnc", "d.mnc")]:
+            tmpdir.join(inputFile).write("x" * 1000)
+            p.addStage(CmdStage(["mincblur", InputFile(str(tmpdir.join(inputFile))), 
+                                 OutputFile(str(tmpdir.join(outputFile)))]))
+        p.initialize()
+        p.setMinFreeDisk(1000)
+        assert p.predictOutputBytes(0) == 1000
+        assert [i for (i, s) in p.getRunnableStagesFor(16, 8)] == [0]
+        assert p.diskAlert != None
+        assert p.getRunnableStagesFor(16, 8) == []
+        p.setStageFinished(0)
+        assert [i for (i, s) in p.getRunnableStagesFor(16, 8)] == [1]
+        assert p.diskAlert == None
+        assert p.pendingDeviceBytes == {1 : 1000}
+
+    def test_predicted_output_kept(self, tmpdir, monkeypatch):
+        """make sure that output sizes are predicted once, as soon as the inputs exist"""
+        monkeypatch.setattr("pydpiper.pipeline.freeDiskSpace", lambda directory: (1, 10 ** 6))
+        tmpdir.join("a.mnc").write("x" * 1000)
+        p = Pipeline()
+        p.addStage(CmdStage(["mincblur", InputFile(str(tmpdir.join("a.mnc"))), OutputFile(str(tmpdir.join("b.mnc")))]))
+        p.addStage(CmdStage(["mincblur", InputFile(str(tmpdir.join("b.mnc"))), OutputFile(str(tmpdir.join("c.mnc")))]))
+        p.setMinFreeDisk(1000)
+        p.initialize()
+        assert p.outputBytes == {0 : 1000}
+        tmpdir.join("a.mnc").write("x" * 2000)
+        assert p.predictOutputBytes(0) == 1000
+        tmpdir.join("b.mnc").write("x" * 500)
+        assert p.predictOutputBytes(1) == 500
+        assert p.outputBytes == {0 : 1000, 1 : 500}
+
+    def test_max_stage_mem(self):
+        """make sure that stages declaring more memory than an executor has are capped"""
+        p = Pipeline()
+        p.addStage(CmdStage(["mincANTS", InputFile("a.mnc"), OutputFile("a.xfm")]))
+        p.addStage(CmdStage(["mincblur", InputFile("a.mnc"), OutputFile("a_blur.mnc")]))
+        p.stages[0].setMem(40.0)
+        p.setMaxStageMem(16.0)
+        assert p.stages[0].getMem() == 16.0
+        assert p.stages[1].getMem() == 2.0
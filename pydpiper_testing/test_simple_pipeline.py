@@ -48,3 +48,19 @@ class TestSimplePipeline():
     def test_stage_already_exists(self):
         """make sure that if a stage already exists it is not recreated"""
         assert self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(15)), OutputFile(generateFile(16))])) == None
+
+    def test_stage_fingerprint(self):
+        """make sure that stages are identified by stable digests of their commands, with paths normalized"""
+        s = CmdStage(["somecommand", InputFile("./" + generateFile(15)), OutputFile(generateFile(16))])
+        assert s.getHash() == self.p.stages[15].getHash()
+        assert len(s.getHash()) == 64
+        self.p.addStage(s)
+        assert self.p.skipped_stages == 1
+        assert CmdStage(["othercommand", InputFile(generateFile(15)), OutputFile(generateFile(16))]).getHash() != s.getHash()
+
+    def test_work_available(self):
+        """make sure that clients would be notified when a finished stage makes its successor runnable"""
+        s = self.p.getRunnableStageIndex()
+        self.p.workAvailable.clear()
+        self.p.setStageFinished(s)
+        assert self.p.workAvailable.isSet()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.stage_stats import StageStatsStore
+import sys
+
+class TestStageStats():
+    def setup_method(self, method):
+        self.p = Pipeline()
+
+    def copyStage(self, tmpdir):
+        inputFile = tmpdir.join("input.mnc")
+        inputFile.write("x" * 1000)
+        s = CmdStage(["cp", InputFile(str(inputFile)), OutputFile(str(tmpdir.join("output.mnc")))])
+        s.setLogFile(str(tmpdir.join("cp.log")))
+        return s
+
+    def test_exec_stage_stats(self, tmpdir):
+        """make sure that running a stage measures its resource usage"""
+        s = self.copyStage(tmpdir)
+        assert s.execStage() == 0
+        for field in ["host", "start", "walltime", "utime", "stime", "maxrss"]:
+            assert s.stats[field] != None
+        assert s.stats["returncode"] == 0
+        assert s.stats["input_bytes"] == 1000
+        assert s.stats["output_bytes"] == 1000
+        assert "Stage statistics:" in tmpdir.join("cp.log").read()
+
+    def test_exec_stage_failure_stats(self, tmpdir):
+        """make sure that the exit status of a failed stage is recorded"""
+        s = CmdStage(["false", OutputFile(str(tmpdir.join("never.mnc")))])
+        s.setLogFile(str(tmpdir.join("false.log")))
+        assert s.execStage() == 1
+        assert s.stats["returncode"] == 1
+
+    def test_reported_stats_are_stored(self, tmpdir):
+        """make sure that stats reported by an executor end up in the store of the run"""
+        self.p.setBackupFileLocation(str(tmpdir))
+        self.p.addStage(self.copyStage(tmpdir))
+        self.p.initialize()
+        self.p.getRunnableStagesFor(2, 1)
+        stats = {"host" : "node1", "walltime" : 2.5, "maxrss" : 2048, "returncode" : 0}
+        self.p.reportStages([0], [0], [], stats={0 : stats})
+        self.p.getStatsStore().close()
+        rows = StageStatsStore(self.p.backupFileLocation).query("cp")
+        assert len(rows) == 1
+        assert rows[0]["stage"] == 0
+        assert rows[0]["maxrss"] == 2048
+        assert rows[0]["walltime"] == 2.5
+        assert rows[0]["run"] == self.p.getStatsStore().run
+        assert StageStatsStore(self.p.backupFileLocation).query("mincANTS") == []
+
+    def test_private_outputs(self, tmpdir):
+        """make sure that stages with private outputs only move their outputs into place if they succeed"""
+        s = self.copyStage(tmpdir)
+        s.privateOutputs = True
+        assert s.execStage() == 0
+        assert tmpdir.join("output.mnc").read() == "x" * 1000
+        assert "Stage statistics:" in tmpdir.join("cp.log").read()
+        write = "'import sys; open(sys.argv[1], \"w\").write(\"x\"); sys.exit(1)'"
+        s = CmdStage([sys.executable, "-c", write, OutputFile(str(tmpdir.join("partial.mnc")))])
+        s.setLogFile(str(tmpdir.join("partial.log")))
+        s.privateOutputs = True
+        assert s.execStage() == 1
+        assert not tmpdir.join("partial.mnc").check()
+        assert sorted([f.basename for f in tmpdir.listdir()]) == ["cp.log", "input.mnc", "output.mnc", "partial.log"]